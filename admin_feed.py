@@ -0,0 +1,142 @@
+"""
+管理面板推送
+
+ConnectionManager 每次变化只把隧道ID记入 pending, 后台每个 tick 把积累的变化
+合并成一条 diff 发给所有订阅者: 同一隧道在一个 tick 内变化多次也只发送最终状态.
+
+消息格式 (JSON):
+    snapshot  {"type": "snapshot", "tunnels": [...], "stats": {...}, "traffic": {...}}
+    diff      {"type": "diff", "upserts": [...], "removed": [...], "stats": {...}, "traffic": {...}}
+
+traffic 以公网端口为键, 值为 [请求数, 接收字节, 发送字节]; diff 中只包含有变化的端口.
+订阅者处理太慢, 队列已满时丢弃它积压的 diff, 改为重新发送快照.
+"""
+import asyncio
+import json
+import logging
+from typing import Callable, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+# 队列中的 RESYNC 表示需要重新发送快照
+RESYNC = None
+
+
+class AdminFeed:
+    """
+    lookup: 根据隧道ID返回要展示的隧道信息, 隧道已删除时返回 None
+    snapshot: 返回当前全部隧道的列表
+    stats: 返回连接数等汇总信息
+    traffic: 返回 {公网端口: [请求数, 接收字节, 发送字节]}
+    """
+    def __init__(
+        self,
+        lookup: Callable[[str], dict | None],
+        snapshot: Callable[[], list],
+        stats: Callable[[], dict],
+        traffic: Callable[[], Dict[str, list]],
+        interval: float = 1.0,
+        queue_size: int = 8
+    ):
+        self._lookup = lookup
+        self._snapshot = snapshot
+        self._stats = stats
+        self._traffic = traffic
+        self.interval = interval
+        self.queue_size = queue_size
+        self.subscribers: Set[asyncio.Queue] = set()
+        self._pending: Set[str] = set()
+        self._last_stats: dict = {}
+        self._last_traffic: Dict[str, list] = {}
+        self._task: asyncio.Task | None = None
+
+    def on_change(self, tunnel_id: str):
+        """ConnectionManager 的回调, 只做记录"""
+        if self.subscribers:
+            self._pending.add(tunnel_id)
+
+    def subscribe(self) -> asyncio.Queue:
+        """新订阅者的队列中第一条是快照"""
+        queue = asyncio.Queue(self.queue_size)
+        queue.put_nowait(RESYNC)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def snapshot_message(self) -> str:
+        return json.dumps({
+            "type": "snapshot",
+            "tunnels": self._snapshot(),
+            "stats": self._stats(),
+            "traffic": self._traffic()
+        })
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error("Failed to publish admin feed update: %s", e)
+
+    def tick(self):
+        """把本 tick 积累的变化合并成一条 diff 发给所有订阅者"""
+        if not self.subscribers:
+            self._pending.clear()
+            self._last_traffic = {}
+            return
+        message = self._diff()
+        if message is None:
+            return
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 积压的 diff 已经没有意义, 清空后改发快照
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+
+    def _diff(self) -> str | None:
+        pending, self._pending = self._pending, set()
+        upserts = []
+        removed = []
+        for tunnel_id in pending:
+            tunnel = self._lookup(tunnel_id)
+            if tunnel is None:
+                removed.append(tunnel_id)
+            else:
+                upserts.append(tunnel)
+
+        stats = self._stats()
+        traffic = self._traffic()
+        changed_traffic = {
+            port: values for port, values in traffic.items()
+            if self._last_traffic.get(port) != values
+        }
+        # 隧道删除后计数被清空, 通知浏览器归零
+        for port in self._last_traffic.keys() - traffic.keys():
+            changed_traffic[port] = [0, 0, 0]
+        self._last_traffic = traffic
+
+        if not upserts and not removed and not changed_traffic and stats == self._last_stats:
+            return None
+        self._last_stats = stats
+        return json.dumps({
+            "type": "diff",
+            "upserts": upserts,
+            "removed": removed,
+            "stats": stats,
+            "traffic": changed_traffic
+        })
@@ -0,0 +1,134 @@
+"""
+隧道组的负载均衡
+
+多个客户端以相同的 group 注册同一个公网端口 (和域名) 时组成一个隧道组, 每个请求按
+LB_POLICY 从组内在线的成员中选一个:
+
+    ewma               默认. 得分 = 延迟的峰值 EWMA * (进行中请求数 + 1), 选得分最低的;
+                       变慢的成员立即被察觉 (新样本高于均值时直接取新样本), 恢复后按
+                       LB_EWMA_DECAY 秒的时间常数逐渐回落
+    least_outstanding  选进行中请求最少的成员
+    round_robin        依次轮流, 不看负载 (用于对比)
+
+被动健康检查: 成员连续 LB_FAILURE_THRESHOLD 次失败 (5xx 或转发出错) 后摘除
+LB_EJECT_TIME 秒, 连续被摘除时时间成倍增加 (最多 10 倍); 组内成员全部被摘除时仍然
+照常选择, 不会让整个隧道不可用.
+慢启动: 新加入或摘除结束的成员在 LB_SLOW_START 秒内权重从 0.1 线性升到 1, 得分除以权重,
+避免冷启动的实例一上线就承担全部流量. round_robin 不做慢启动.
+
+状态只在本进程内, 多 worker 部署时每个 worker 各自统计.
+"""
+import logging
+import math
+import os
+import random
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+LB_POLICY = os.getenv("LB_POLICY", "ewma")
+LB_FAILURE_THRESHOLD = int(os.getenv("LB_FAILURE_THRESHOLD", 5))
+LB_EJECT_TIME = float(os.getenv("LB_EJECT_TIME", 10))
+LB_SLOW_START = float(os.getenv("LB_SLOW_START", 10))
+LB_EWMA_DECAY = float(os.getenv("LB_EWMA_DECAY", 10))
+
+POLICIES = ("ewma", "least_outstanding", "round_robin")
+
+# 还没有延迟样本时使用的延迟 (秒), 组内其他成员有样本时取它们的平均值
+_DEFAULT_LATENCY = 0.001
+_MIN_WEIGHT = 0.1
+_MAX_EJECTION_MULTIPLIER = 10
+
+
+class Backend:
+    """组内的一个成员, key 是隧道ID"""
+    __slots__ = ("key", "outstanding", "latency", "updated", "failures", "ejections", "ejected_until", "warm_from")
+
+    def __init__(self, key: str, now: float):
+        self.key = key
+        self.outstanding = 0
+        self.latency = 0.0  # 峰值 EWMA, 0 表示还没有样本
+        self.updated = now
+        self.failures = 0  # 连续失败次数
+        self.ejections = 0  # 连续被摘除的次数
+        self.ejected_until = 0.0
+        self.warm_from = now  # 慢启动的起点
+
+    def weight(self, now: float) -> float:
+        if LB_SLOW_START <= 0:
+            return 1.0
+        return min(1.0, max(_MIN_WEIGHT, (now - self.warm_from) / LB_SLOW_START))
+
+
+class TunnelGroup:
+    def __init__(self, policy: str = LB_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown load balancing policy: {policy}")
+        self.policy = policy
+        self.backends: Dict[str, Backend] = {}
+        self.on_eject: Callable[[Backend], None] | None = None
+        self._next = 0  # round_robin 的位置
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def add(self, key: str):
+        if key not in self.backends:
+            self.backends[key] = Backend(key, time.monotonic())
+
+    def remove(self, key: str):
+        """移除成员; 它进行中的请求照常完成, 之后的统计不再影响组"""
+        self.backends.pop(key, None)
+
+    def pick(self, available: Callable[[str], bool] = lambda key: True) -> Backend | None:
+        """从 available 的成员中选一个, 都不可用时返回 None"""
+        candidates = [backend for backend in self.backends.values() if available(backend.key)]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healthy = [backend for backend in candidates if backend.ejected_until <= now] or candidates
+        if self.policy == "round_robin":
+            self._next += 1
+            return healthy[self._next % len(healthy)]
+        if self.policy == "least_outstanding":
+            score = lambda backend: (backend.outstanding + 1) / backend.weight(now)
+        else:
+            sampled = [backend.latency for backend in healthy if backend.latency > 0]
+            default = sum(sampled) / len(sampled) if sampled else _DEFAULT_LATENCY
+            score = lambda backend: (
+                (backend.latency or default) * (backend.outstanding + 1) / backend.weight(now)
+            )
+        # 得分相同时随机选择, 避免总是压在第一个成员上
+        return min(healthy, key=lambda backend: (score(backend), random.random()))
+
+    def start(self, backend: Backend):
+        backend.outstanding += 1
+
+    def done(self, backend: Backend):
+        backend.outstanding -= 1
+
+    def observe(self, backend: Backend, latency: float, ok: bool):
+        """记录一次请求的结果, latency 为收到响应头的耗时"""
+        now = time.monotonic()
+        if ok:
+            if backend.latency == 0 or latency > backend.latency:
+                backend.latency = latency
+            else:
+                alpha = 1 - math.exp(-(now - backend.updated) / LB_EWMA_DECAY)
+                backend.latency += alpha * (latency - backend.latency)
+            backend.updated = now
+            backend.failures = 0
+            if backend.ejections and backend.weight(now) >= 1:
+                backend.ejections = 0
+            return
+        backend.failures += 1
+        if backend.failures >= LB_FAILURE_THRESHOLD and backend.ejected_until <= now:
+            backend.failures = 0
+            backend.ejections += 1
+            duration = LB_EJECT_TIME * min(backend.ejections, _MAX_EJECTION_MULTIPLIER)
+            backend.ejected_until = now + duration
+            backend.warm_from = backend.ejected_until
+            logger.warning("Tunnel %s ejected from its group for %ss after repeated failures", backend.key, duration)
+            if self.on_eject is not None:
+                self.on_eject(backend)
@@ -0,0 +1,2201 @@
+"""
+性能基准测试
+
+用法:
+    python bench.py proxy --requests 2000 --concurrency 50 [--tunnels 1000]
+    python bench.py stream --sizes 64 512
+    python bench.py routing --tunnels 10000 --domains 1000 10000 50000
+    python bench.py mux --requests 2000 --concurrency 1 10 50
+    python bench.py tcp --megabytes 256 --connections 2000
+    python bench.py users --users 100000
+    python bench.py logins --requests 1000 --login-concurrency 20
+    python bench.py auth --calls 20000
+    python bench.py metrics --requests 2000 --rounds 3
+    python bench.py admin --tunnels 10000 --changes 20
+    python bench.py cluster --workers 1 2 4 --requests 4000
+    python bench.py websocket --messages 20000 --connections 1 10
+    python bench.py cache --requests 4000 --assets 200 --delay 0.005
+    python bench.py limits --requests 500 --flood-rate 800
+    python bench.py faults --drops 5 --interval 2
+    python bench.py client --requests 50 --delay 0.2
+    python bench.py tunnels --tunnels 50
+    python bench.py groups --requests 4000 --rate 300 --latencies 0.01 0.01 0.01 0.1
+    python bench.py codec --iterations 20000
+    python bench.py startup --tunnels 1000 10000
+    python bench.py deploy [--compare]
+    python bench.py diagnostics --requests 2000 --rounds 3 --idle 10
+    python bench.py suite --output results.json [--compare old.json]
+
+proxy:  启动 test_server.py 作为上游, 启动 server.py, 创建隧道后
+        通过 /proxy/{port} 压测, 输出 req/s 与延迟分位数
+stream: 通过隧道上传/下载大文件, 输出服务端峰值 RSS 与首字节时间,
+        用于确认内存占用不随请求体大小增长
+routing: 进程内对 ConnectionManager 做注册/查找/删除的微基准,
+         并与线性扫描的查找方式对比; 另测不同域名数量下按 Host 匹配
+         (精确域名, 通配符, 未命中) 的耗时
+mux:     启动 server.py 和 client.py, 请求经客户端 WebSocket 上的
+         多路复用流转发到 test_server.py, 输出不同并发下的吞吐
+tcp:     经公网端口的 TCP 隧道访问本地 echo 服务, 输出 MB/s 和每秒新建连接数,
+         --via-client 时经客户端 WebSocket 转发
+logins:  先单独压测 /proxy, 再在并发登录的同时压测, 对比代理的 p99 延迟
+auth:    进程内调用 get_current_user, 对比开启/关闭令牌缓存时每次调用的 CPU 时间
+users:   各用户存储后端的注册/查找耗时, 并与每次注册重写 users.json 的旧方式对比
+metrics: 进程内测量每个代理请求记录指标的耗时, 再交替以 METRICS_ENABLED=false/true
+         启动 server.py 压测 /proxy, 输出吞吐差异
+admin:   进程内模拟管理面板每秒刷新一次, 对比重新获取整个 /api/tunnels
+         与推送通道每个 tick 的 diff 在序列化耗时和字节数上的差异
+cluster: 以 uvicorn --workers N 启动 server.py, 共享 SQLite 隧道注册表,
+         分别压测直连隧道和经客户端的隧道 (请求多半落在不持有客户端连接的
+         worker 上, 经内部连接转交), 输出不同 worker 数下的吞吐
+websocket: 本地 echo WebSocket 服务分别直连, 经直连隧道和经客户端隧道访问,
+           输出逐条往返的延迟分位数, 以及多连接同时收发时的 msgs/s
+cache:   上游对每个静态资源模拟固定耗时并计数, 分别经未开启和开启边缘缓存的隧道压测,
+         输出吞吐, 延迟与上游实际收到的请求数; 另比较压缩前后的响应大小
+limits:  一个隧道被以固定速率持续请求的同时, 以低并发请求另一个安静的隧道, 对比给吵闹的隧道
+         设置限额前后安静隧道的延迟和吞吐, 以及吵闹隧道被 429 拒绝的比例;
+         另测设置 bytes_per_second 后下载的实际速率
+faults:  客户端经一个会定时切断所有连接的本地 TCP 代理连到服务端, 同时持续经客户端隧道请求,
+         分别在开启会话续传和 SESSION_GRACE_PERIOD=0 时统计失败的请求数和每次断线后的恢复时间
+client:  同时经客户端发出 N 个上游耗时 delay 的请求, 比较 CLIENT_MAX_CONCURRENT=1 (逐个处理)
+         和默认并发上限下的总耗时, 以及客户端到本地服务建立的连接数
+tunnels: N 个隧道分别由一个读取配置文件的客户端进程, 以及每个隧道一个客户端进程承载,
+         比较全部上线的耗时, 客户端进程的总 RSS, 连接数和轮流访问各隧道的吞吐
+groups:  进程内模拟一个隧道组, 每个成员只能同时处理 --capacity 个请求, 平均耗时各不相同
+         (默认其中一个慢十倍), 请求按固定速率到达 (开环), 比较 round_robin, least_outstanding
+         和 ewma 三种策略的延迟分位数; --failing 时再加一个总是返回 5xx 的成员, 比较错误数
+codec:   进程内比较控制消息以 JSON 和二进制编码 (codec.py) 编解码的耗时与字节数; 另以典型的请求头
+         和不同的请求体, 比较把整个请求放进 JSON (请求体 base64) 与多路复用帧的编解码耗时,
+         以及开启 FRAME_COMPRESSION 后数据帧的大小和压缩耗时
+startup: 分别向 journal 和 sqlite 注册表写入 N 个隧道, 进程内测量载入和建立索引的耗时, 再启动
+         server.py 测量从启动进程到最后一个隧道可以访问的时间; 与空注册表的启动时间, 以及重启后
+         经 API 重新创建全部隧道 (不超过 --cold-limit 个时) 的耗时对比
+deploy:  持续经直连隧道, 客户端隧道 (快请求和耗时 --slow 秒的慢请求) 和 TCP 隧道请求的同时,
+         向旧进程发送 SIGUSR1, 再以 SERVER_HANDOFF=true 启动新的 server.py (SERVER_RELOAD=false,
+         同一端口), 它开始监听后向旧进程发送 SIGTERM, 统计整个过程中失败的请求数, 有失败时以非零状态
+         退出; --compare 时再测先停止旧进程再启动新进程的普通重启
+diagnostics: 进程内测量 TimingGate 给每个请求增加的耗时, 并以 time.sleep 阻塞事件循环确认卡顿检测
+         抓到了阻塞的调用栈; 再分别以 DIAGNOSTICS_ENABLED=false/true 启动 server.py, 比较空闲
+         --idle 秒的 CPU 时间, 以及交替压测 /proxy 的吞吐差异
+suite:   在一个 server.py, 一个上游进程和 --clients 个客户端进程上依次运行固定的一组工作负载
+         (小/大请求体经直连隧道和客户端, 高并发, WebSocket, 登录风暴, 隧道 API, 大量隧道),
+         每项记录 req/s, p50/p99 延迟, 服务端和客户端的 CPU 时间与 RSS, 连同提交号和参数写入 JSON;
+         --compare 指定之前的结果文件时逐项打印变化, 用于比较不同提交
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def start_client(server_port, local_port, public_port, env=None):
+    """在子进程中启动隧道客户端"""
+    return subprocess.Popen(
+        [sys.executable, "client.py"],
+        cwd=ROOT,
+        env={
+            **os.environ,
+            "SERVER_URL": f"ws://127.0.0.1:{server_port}",
+            "LOCAL_PORT": str(local_port),
+            "PUBLIC_PORT": str(public_port),
+            "CUSTOM_DOMAIN": "",
+            **(env or {}),
+        },
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_for_url(url, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not become ready")
+
+
+def start_uvicorn(app, port, env=None, workers=1):
+    """在子进程中启动一个 uvicorn 应用"""
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning", "--workers", str(workers)],
+        cwd=ROOT,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def peak_rss_mb(pid):
+    """读取进程的峰值 RSS (VmHWM), 单位 MB"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def start_stream_upstream(port, host="127.0.0.1"):
+    """按需生成任意大小响应、并丢弃上传内容的上游服务"""
+    async def download(request):
+        remaining = int(request.query["n"])
+        chunk = b"x" * 65536
+        resp = web.StreamResponse()
+        resp.content_length = remaining
+        await resp.prepare(request)
+        while remaining > 0:
+            piece = chunk[:remaining]
+            await resp.write(piece)
+            remaining -= len(piece)
+        return resp
+
+    async def upload(request):
+        total = 0
+        async for chunk in request.content.iter_any():
+            total += len(chunk)
+        return web.json_response({"received": total})
+
+    upstream = web.Application()
+    upstream.router.add_get("/bytes", download)
+    upstream.router.add_post("/upload", upload)
+    runner = web.AppRunner(upstream)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def start_echo_server(port):
+    async def echo(reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(echo, "127.0.0.1", port)
+
+
+async def start_ws_echo_server(port):
+    """原样返回每条消息的 WebSocket 服务, GET / 用于确认隧道可用"""
+    async def echo(request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                await ws.send_str(msg.data)
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                await ws.send_bytes(msg.data)
+        return ws
+
+    async def index(request):
+        return web.Response(text="ok")
+
+    upstream = web.Application()
+    upstream.router.add_get("/echo", echo)
+    upstream.router.add_get("/", index)
+    runner = web.AppRunner(upstream)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"port {port} did not come up")
+
+
+async def login(session, base_url, username="admin", password="admin"):
+    async with session.post(f"{base_url}/api/login",
+                            json={"username": username, "password": password}) as resp:
+        data = await resp.json()
+        return {"Authorization": f"Bearer {data['access_token']}"}
+
+
+async def create_tunnel(session, base_url, headers, local_port, public_port):
+    async with session.post(f"{base_url}/api/tunnels", headers=headers,
+                            json={"local_port": local_port, "public_port": public_port}) as resp:
+        resp.raise_for_status()
+        return await resp.json()
+
+
+async def drive(url, total, concurrency, method="GET", data=None):
+    """并发请求 url, 返回 (耗时, 延迟列表, 失败数); url 为列表时依次轮流请求"""
+    urls = [url] if isinstance(url, str) else url
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def worker():
+            nonlocal errors
+            for n in remaining:
+                start = time.perf_counter()
+                try:
+                    async with session.request(method, urls[n % len(urls)], data=data) as resp:
+                        await resp.read()
+                        if resp.status >= 400:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, errors
+
+
+def report(name, total, elapsed, latencies, errors):
+    print(f"{name}: {total} requests in {elapsed:.2f}s, "
+          f"{total / elapsed:.1f} req/s, "
+          f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"errors={errors}")
+
+
+async def bench_proxy(args, env=None):
+    """返回测得的 req/s"""
+    upstream_port = free_port()
+    server_port = free_port()
+    public_port = free_port()
+    upstream = start_uvicorn("test_server:app", upstream_port)
+    # 额外的隧道只用于撑大隧道表, 不需要真正监听
+    server = start_uvicorn("server:app", server_port, {"TCP_TUNNELS_ENABLED": "false", **(env or {})})
+    try:
+        await wait_for_port(upstream_port)
+        await wait_for_port(server_port)
+        base_url = f"http://127.0.0.1:{server_port}"
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            await create_tunnel(session, base_url, headers, upstream_port, public_port)
+            for i in range(args.tunnels - 1):
+                await create_tunnel(session, base_url, headers, upstream_port,
+                                    20000 + i if 20000 + i != public_port else 40000 + i)
+
+        url = f"{base_url}/proxy/{public_port}/"
+        # 预热
+        await drive(url, args.concurrency, args.concurrency)
+        elapsed, latencies, errors = await drive(url, args.requests, args.concurrency)
+        report(f"proxy {' '.join(f'{k}={v}' for k, v in (env or {}).items())}".strip(),
+               args.requests, elapsed, latencies, errors)
+        return args.requests / elapsed
+    finally:
+        for proc in (server, upstream):
+            proc.terminate()
+            proc.wait()
+
+
+async def bench_stream(args):
+    upstream_port = free_port()
+    server_port = free_port()
+    public_port = free_port()
+    upstream = await start_stream_upstream(upstream_port)
+    server = start_uvicorn("server:app", server_port)
+    try:
+        await wait_for_port(server_port)
+        base_url = f"http://127.0.0.1:{server_port}"
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            await create_tunnel(session, base_url, headers, upstream_port, public_port)
+        print(f"server baseline peak RSS: {peak_rss_mb(server.pid):.1f}MB")
+
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            for size_mb in args.sizes:
+                size = size_mb * 1024 * 1024
+                url = f"{base_url}/proxy/{public_port}/bytes?n={size}"
+                start = time.perf_counter()
+                received = 0
+                ttfb = None
+                async with session.get(url) as resp:
+                    async for chunk in resp.content.iter_chunked(65536):
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - start
+                        received += len(chunk)
+                elapsed = time.perf_counter() - start
+                print(f"download {size_mb}MB: {received / elapsed / 1e6:.1f} MB/s, "
+                      f"ttfb={ttfb * 1000:.1f}ms, "
+                      f"server peak RSS={peak_rss_mb(server.pid):.1f}MB")
+
+                async def body():
+                    chunk = b"y" * 65536
+                    for _ in range(size // len(chunk)):
+                        yield chunk
+
+                start = time.perf_counter()
+                async with session.post(f"{base_url}/proxy/{public_port}/upload",
+                                        data=body()) as resp:
+                    result = await resp.json()
+                elapsed = time.perf_counter() - start
+                print(f"upload {size_mb}MB: {result['received'] / elapsed / 1e6:.1f} MB/s, "
+                      f"server peak RSS={peak_rss_mb(server.pid):.1f}MB")
+    finally:
+        server.terminate()
+        server.wait()
+        await upstream.cleanup()
+
+
+async def bench_mux(args):
+    upstream_port = free_port()
+    server_port = free_port()
+    public_port = free_port()
+    upstream = start_uvicorn("test_server:app", upstream_port)
+    server = start_uvicorn("server:app", server_port)
+    client = None
+    try:
+        await wait_for_port(upstream_port)
+        await wait_for_port(server_port)
+        client = start_client(server_port, upstream_port, public_port)
+        url = f"http://127.0.0.1:{server_port}/proxy/{public_port}/"
+        await wait_for_url(url)
+
+        for concurrency in args.concurrency:
+            await drive(url, concurrency, concurrency)
+            elapsed, latencies, errors = await drive(url, args.requests, concurrency)
+            report(f"mux c={concurrency}", args.requests, elapsed, latencies, errors)
+    finally:
+        for proc in (client, server, upstream):
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+
+
+async def tcp_echo_roundtrip(port, payload, total):
+    """发送 total 字节并读回, 发送与读取并行进行"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    async def send():
+        remaining = total
+        while remaining > 0:
+            piece = payload[:remaining]
+            writer.write(piece)
+            await writer.drain()
+            remaining -= len(piece)
+        writer.write_eof()
+
+    async def receive():
+        received = 0
+        while received < total:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+        return received
+
+    _, received = await asyncio.gather(send(), receive())
+    writer.close()
+    return received
+
+
+async def bench_tcp(args):
+    echo_port = free_port()
+    server_port = free_port()
+    public_port = free_port()
+    echo = await start_echo_server(echo_port)
+    server = start_uvicorn("server:app", server_port)
+    client = None
+    try:
+        await wait_for_port(server_port)
+        if args.via_client:
+            client = start_client(server_port, echo_port, public_port)
+        else:
+            base_url = f"http://127.0.0.1:{server_port}"
+            async with aiohttp.ClientSession() as session:
+                headers = await login(session, base_url)
+                await create_tunnel(session, base_url, headers, echo_port, public_port)
+        await wait_for_port(public_port)
+        # 监听先于客户端注册完成时, 等到能真正回显为止
+        deadline = time.monotonic() + 15
+        while await tcp_echo_roundtrip(public_port, b"x", 1) != 1:
+            if time.monotonic() > deadline:
+                raise RuntimeError("TCP tunnel did not become ready")
+            await asyncio.sleep(0.1)
+
+        payload = b"x" * 65536
+        per_stream = args.megabytes * 1024 * 1024 // args.streams
+        start = time.perf_counter()
+        received = await asyncio.gather(*(
+            tcp_echo_roundtrip(public_port, payload, per_stream) for _ in range(args.streams)
+        ))
+        elapsed = time.perf_counter() - start
+        print(f"tcp throughput: {sum(received) / elapsed / 1e6:.1f} MB/s echoed "
+              f"({args.streams} streams, {args.megabytes}MB)")
+
+        remaining = iter(range(args.connections))
+        failures = 0
+
+        async def connector():
+            nonlocal failures
+            for _ in remaining:
+                try:
+                    if await tcp_echo_roundtrip(public_port, b"ping", 4) != 4:
+                        failures += 1
+                except OSError:
+                    failures += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(connector() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        print(f"tcp connections: {args.connections / elapsed:.1f} conn/s "
+              f"(concurrency {args.concurrency}, failures={failures})")
+    finally:
+        for proc in (client, server):
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+        echo.close()
+
+
+async def bench_logins(args):
+    upstream_port = free_port()
+    server_port = free_port()
+    public_port = free_port()
+    upstream = start_uvicorn("test_server:app", upstream_port)
+    server = start_uvicorn("server:app", server_port)
+    try:
+        await wait_for_port(upstream_port)
+        await wait_for_port(server_port)
+        base_url = f"http://127.0.0.1:{server_port}"
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            await create_tunnel(session, base_url, headers, upstream_port, public_port)
+
+        url = f"{base_url}/proxy/{public_port}/"
+        await drive(url, args.concurrency, args.concurrency)
+        elapsed, latencies, errors = await drive(url, args.requests, args.concurrency)
+        report("proxy (idle)", args.requests, elapsed, latencies, errors)
+
+        stop = asyncio.Event()
+        outcomes = {}
+
+        async def storm(session):
+            while not stop.is_set():
+                async with session.post(f"{base_url}/api/login",
+                                        json={"username": "admin", "password": "admin"}) as resp:
+                    await resp.read()
+                    outcomes[resp.status] = outcomes.get(resp.status, 0) + 1
+
+        async with aiohttp.ClientSession() as session:
+            storms = [asyncio.create_task(storm(session)) for _ in range(args.login_concurrency)]
+            await asyncio.sleep(0.5)
+            elapsed, latencies, errors = await drive(url, args.requests, args.concurrency)
+            stop.set()
+            await asyncio.gather(*storms)
+        report("proxy (login storm)", args.requests, elapsed, latencies, errors)
+        print(f"login responses by status: {dict(sorted(outcomes.items()))}")
+    finally:
+        for proc in (server, upstream):
+            proc.terminate()
+            proc.wait()
+
+
+async def bench_users(args):
+    logging.disable(logging.INFO)
+    from user_store import BACKENDS
+
+    # 注册耗时只看存储本身, 用固定的哈希代替 bcrypt
+    fake_hash = "$2b$12$" + "x" * 53
+
+    def user(i):
+        return {"username": f"user{i}", "hashed_password": fake_hash, "disabled": False}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 旧方式: 每次注册同步重写整个 users.json
+        path = os.path.join(tmp, "legacy.json")
+        users = {}
+        start = time.perf_counter()
+        for i in range(args.legacy_users):
+            users[f"user{i}"] = user(i)
+            with open(path, "w") as f:
+                json.dump(users, f, indent=4)
+        elapsed = time.perf_counter() - start
+        print(f"legacy json: {args.legacy_users} registrations in {elapsed:.2f}s "
+              f"({args.legacy_users / elapsed:.0f}/s, cost grows with user count)")
+
+        for kind, (cls, _) in BACKENDS.items():
+            store = cls(os.path.join(tmp, f"users-{kind}")).open(dict)
+            n = args.users if kind != "json" else args.legacy_users
+            start = time.perf_counter()
+            # 注册请求并发到达, 后台线程合并提交
+            for offset in range(0, n, args.batch):
+                await asyncio.gather(*(
+                    store.create(user(i)) for i in range(offset, min(n, offset + args.batch))
+                ))
+            elapsed = time.perf_counter() - start
+            lookup_start = time.perf_counter()
+            for i in range(n):
+                store.get(f"user{i}")
+            lookup = (time.perf_counter() - lookup_start) / n * 1e6
+            await store.close()
+            print(f"{kind}: {n} registrations in {elapsed:.2f}s ({n / elapsed:.0f}/s), "
+                  f"lookup {lookup:.3f}us")
+
+
+def import_server():
+    """进程内导入 server, 使用只读的 users.json 以免生成数据文件"""
+    logging.disable(logging.INFO)
+    os.environ.setdefault("USER_STORE", "json")
+    os.chdir(ROOT)
+    import server
+    return server
+
+
+async def bench_auth(args):
+    server = import_server()
+    from datetime import timedelta
+
+    token = server.create_access_token({"sub": "admin"}, timedelta(minutes=30))
+
+    async def run(label):
+        start = time.process_time()
+        for _ in range(args.calls):
+            await server.get_current_user(token)
+        per_call = (time.process_time() - start) / args.calls * 1e6
+        print(f"get_current_user ({label}): {per_call:.1f}us CPU per call")
+        return per_call
+
+    cache_size = server.auth_cache.maxsize
+    server.auth_cache.maxsize = 0
+    uncached = await run("no cache")
+    server.auth_cache.maxsize = cache_size
+    cached = await run("cached")
+    print(f"saved {uncached - cached:.1f}us CPU per authenticated request")
+
+
+async def bench_metrics(args):
+    server = import_server()
+    n = 100000
+
+    def record():
+        # 与 proxy_request 中每个请求的记录步骤相同
+        for i in range(n):
+            server.tunnel_bytes_received.labels(8000, "http").inc(512)
+            server.upstream_latency.labels(8000).observe(0.003)
+            server.tunnel_bytes_sent.labels(8000, "http").inc(4096)
+            server.tunnel_requests.labels(8000, "2xx").inc()
+
+    print(f"recording per request: {timed(record, n):.2f}us")
+    start = time.perf_counter()
+    server.metrics.render()
+    print(f"render /metrics: {(time.perf_counter() - start) * 1000:.2f}ms")
+
+    # 交替运行以抵消机器负载的波动
+    results = {"false": [], "true": []}
+    for _ in range(args.rounds):
+        for enabled in results:
+            results[enabled].append(await bench_proxy(args, {"METRICS_ENABLED": enabled}))
+    off = sum(results["false"]) / args.rounds
+    on = sum(results["true"]) / args.rounds
+    print(f"mean over {args.rounds} rounds: off {off:.1f} req/s, on {on:.1f} req/s, "
+          f"overhead {(off - on) / off * 100:.1f}%")
+
+
+async def bench_admin(args):
+    server = import_server()
+    manager = server.manager
+    feed = server.admin_feed
+    for i in range(args.tunnels):
+        await manager.register_tunnel(f"client-{i}", 3000, 20000 + i)
+    feed.subscribe()
+
+    def refetch():
+        # 旧方式: 每次变化后重新获取并序列化整个隧道表
+        return json.dumps(manager.list_tunnels())
+
+    async def churn(tick):
+        for j in range(args.changes):
+            i = (tick * args.changes + j) % args.tunnels
+            await manager.register_tunnel(f"client-{i}", 3000, 20000 + i)
+            manager.remove_tunnel(f"client-{i}")
+            await manager.register_tunnel(f"client-{i}", 3001, 20000 + i)
+
+    snapshot = feed.snapshot_message()
+    rounds = 20
+    start = time.perf_counter()
+    for _ in range(rounds):
+        full = refetch()
+    full_ms = (time.perf_counter() - start) / rounds * 1000
+
+    diff_bytes = 0
+    diff_time = 0.0
+    for tick in range(rounds):
+        await churn(tick)
+        start = time.perf_counter()
+        message = feed._diff()
+        diff_time += time.perf_counter() - start
+        diff_bytes += len(message)
+    diff_ms = diff_time / rounds * 1000
+    print(f"{args.tunnels} tunnels, {args.changes} changed per tick")
+    print(f"full refetch: {full_ms:.2f}ms, {len(full) / 1024:.0f}KB per refresh")
+    print(f"feed diff: {diff_ms:.3f}ms, {diff_bytes / rounds / 1024:.1f}KB per tick "
+          f"(snapshot once per connection: {len(snapshot) / 1024:.0f}KB)")
+
+
+async def wait_for_tunnel(url, timeout=15):
+    """等待经客户端的隧道可用, 所有 worker 都同步到之后才返回 200"""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        ok = 0
+        while time.monotonic() < deadline:
+            async with session.get(url) as resp:
+                await resp.read()
+                ok = ok + 1 if resp.status == 200 else 0
+            if ok >= 20:
+                return
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"{url} did not become ready")
+
+
+async def bench_cluster(args):
+    print(f"{os.cpu_count()} CPUs available")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            upstream_port = free_port()
+            server_port = free_port()
+            env = {
+                "TUNNEL_REGISTRY": "sqlite",
+                "TUNNEL_REGISTRY_PATH": os.path.join(tmp, "tunnels.db"),
+                "TCP_TUNNELS_ENABLED": "false",
+            }
+            upstream = start_uvicorn("test_server:app", upstream_port, workers=workers)
+            server = start_uvicorn("server:app", server_port, env, workers=workers)
+            client = None
+            try:
+                await wait_for_port(upstream_port)
+                await wait_for_port(server_port)
+                base_url = f"http://127.0.0.1:{server_port}"
+                direct_port = free_port()
+                async with aiohttp.ClientSession() as session:
+                    headers = await login(session, base_url)
+                    await create_tunnel(session, base_url, headers, upstream_port, direct_port)
+
+                url = f"{base_url}/proxy/{direct_port}/"
+                await drive(url, args.concurrency, args.concurrency)
+                elapsed, latencies, errors = await drive(url, args.requests, args.concurrency)
+                report(f"{workers} workers, direct", args.requests, elapsed, latencies, errors)
+
+                client_port = free_port()
+                client = start_client(server_port, upstream_port, client_port)
+                url = f"{base_url}/proxy/{client_port}/"
+                await wait_for_tunnel(url)
+                elapsed, latencies, errors = await drive(url, args.requests, args.concurrency)
+                report(f"{workers} workers, via client", args.requests, elapsed, latencies, errors)
+            finally:
+                for proc in (client, server, upstream):
+                    if proc is not None:
+                        proc.terminate()
+                        proc.wait()
+
+
+async def ws_latency(session, url, payload, count):
+    """一条连接上逐条发送并等待回显, 返回每条的往返时间"""
+    latencies = []
+    async with session.ws_connect(url) as ws:
+        for _ in range(count):
+            start = time.perf_counter()
+            await ws.send_bytes(payload)
+            msg = await ws.receive()
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                raise RuntimeError(f"unexpected message {msg.type}")
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def ws_throughput(session, url, payload, count):
+    """一条连接上连续发送 count 条, 同时读取回显, 返回收到的条数"""
+    async with session.ws_connect(url) as ws:
+        async def send():
+            for _ in range(count):
+                await ws.send_bytes(payload)
+
+        async def receive():
+            received = 0
+            while received < count:
+                msg = await ws.receive()
+                if msg.type != aiohttp.WSMsgType.BINARY:
+                    break
+                received += 1
+            return received
+
+        _, received = await asyncio.gather(send(), receive())
+    return received
+
+
+async def bench_websocket(args):
+    echo_port = free_port()
+    server_port = free_port()
+    direct_port = free_port()
+    client_port = free_port()
+    echo = await start_ws_echo_server(echo_port)
+    server = start_uvicorn("server:app", server_port, {"TCP_TUNNELS_ENABLED": "false"})
+    client = None
+    try:
+        await wait_for_port(server_port)
+        base_url = f"http://127.0.0.1:{server_port}"
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            await create_tunnel(session, base_url, headers, echo_port, direct_port)
+        client = start_client(server_port, echo_port, client_port)
+        await wait_for_url(f"{base_url}/proxy/{client_port}/")
+
+        targets = [
+            ("no tunnel", f"ws://127.0.0.1:{echo_port}/echo"),
+            ("direct tunnel", f"ws://127.0.0.1:{server_port}/proxy/{direct_port}/echo"),
+            ("via client", f"ws://127.0.0.1:{server_port}/proxy/{client_port}/echo"),
+        ]
+        payload = b"x" * args.size
+        async with aiohttp.ClientSession() as session:
+            for name, url in targets:
+                await ws_latency(session, url, payload, 100)
+                latencies = await ws_latency(session, url, payload, args.roundtrips)
+                print(f"{name}: round trip p50={percentile(latencies, 50) * 1000:.3f}ms "
+                      f"p99={percentile(latencies, 99) * 1000:.3f}ms")
+                for connections in args.connections:
+                    per_connection = args.messages // connections
+                    start = time.perf_counter()
+                    received = await asyncio.gather(*(
+                        ws_throughput(session, url, payload, per_connection) for _ in range(connections)
+                    ))
+                    elapsed = time.perf_counter() - start
+                    print(f"{name}: {connections} connections, {sum(received) / elapsed:.0f} msgs/s "
+                          f"({args.size}B messages, {sum(received)}/{per_connection * connections} echoed)")
+    finally:
+        for proc in (client, server):
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+        await echo.cleanup()
+
+
+async def start_asset_upstream(port, delay, counter):
+    """模拟带 Cache-Control 和 ETag 的静态资源服务, 每个请求耗时 delay 秒"""
+    body = ("function f(){return 'tunnel asset';}\n" * 600).encode()
+
+    async def asset(request):
+        counter[0] += 1
+        await asyncio.sleep(delay)
+        return web.Response(body=body, content_type="application/javascript",
+                            headers={"Cache-Control": "max-age=300",
+                                     "ETag": f'"{request.match_info["n"]}"'})
+
+    upstream = web.Application()
+    upstream.router.add_get("/asset/{n}", asset)
+    runner = web.AppRunner(upstream)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, len(body)
+
+
+async def bench_cache(args):
+    upstream_port = free_port()
+    server_port = free_port()
+    counter = [0]
+    upstream, asset_size = await start_asset_upstream(upstream_port, args.delay, counter)
+    server = start_uvicorn("server:app", server_port, {"TCP_TUNNELS_ENABLED": "false"})
+    try:
+        await wait_for_port(server_port)
+        base_url = f"http://127.0.0.1:{server_port}"
+        ports = {}
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            for name, options in (("no cache", {}), ("cache", {"cache": True}),
+                                  ("cache+compress", {"cache": True, "compress": True})):
+                ports[name] = free_port()
+                async with session.post(f"{base_url}/api/tunnels", headers=headers, json={
+                    "local_port": upstream_port, "public_port": ports[name], **options
+                }) as resp:
+                    resp.raise_for_status()
+
+        for name in ("no cache", "cache"):
+            urls = [f"{base_url}/proxy/{ports[name]}/asset/{n}" for n in range(args.assets)]
+            counter[0] = 0
+            elapsed, latencies, errors = await drive(urls, args.requests, args.concurrency)
+            report(name, args.requests, elapsed, latencies, errors)
+            print(f"{name}: upstream received {counter[0]} of {args.requests} requests "
+                  f"({100 * (1 - counter[0] / args.requests):.1f}% offloaded)")
+
+        url = f"{base_url}/proxy/{ports['cache+compress']}/asset/0"
+        async with aiohttp.ClientSession(auto_decompress=False) as session:
+            for encoding in ("identity", "gzip", "br"):
+                async with session.get(url, headers={"Accept-Encoding": encoding}) as resp:
+                    size = len(await resp.read())
+                    print(f"compress {encoding}: {size} bytes on the wire "
+                          f"({asset_size} uncompressed, content-encoding={resp.headers.get('content-encoding')})")
+    finally:
+        server.terminate()
+        server.wait()
+        await upstream.cleanup()
+
+
+def flood_process(url, rate, concurrency, stop, results):
+    """在子进程中以固定速率 (开环) 请求 url, 同时进行中的请求最多 concurrency 个, 超出的记为 dropped;
+    stop 设置后把 ({状态码: 次数}, 耗时) 放入 results"""
+    async def flood():
+        outcomes = {}
+        pending = set()
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def request():
+                try:
+                    async with session.get(url) as resp:
+                        await resp.read()
+                        outcomes[resp.status] = outcomes.get(resp.status, 0) + 1
+                except aiohttp.ClientError:
+                    outcomes["error"] = outcomes.get("error", 0) + 1
+
+            start = time.perf_counter()
+            sent = 0
+            while not stop.is_set():
+                # 按经过的时间补发应发出的请求, 不受响应快慢影响
+                due = int((time.perf_counter() - start) * rate) - sent
+                for _ in range(due):
+                    if len(pending) >= concurrency:
+                        outcomes["dropped"] = outcomes.get("dropped", 0) + 1
+                    else:
+                        task = asyncio.create_task(request())
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                sent += due
+                await asyncio.sleep(0.005)
+            elapsed = time.perf_counter() - start
+            await asyncio.gather(*pending)
+            return outcomes, elapsed
+
+    results.put(asyncio.run(flood()))
+
+
+async def bench_limits(args):
+    upstream_port = free_port()
+    server_port = free_port()
+    upstream = await start_stream_upstream(upstream_port)
+    server = start_uvicorn("server:app", server_port, {"TCP_TUNNELS_ENABLED": "false"})
+    try:
+        await wait_for_port(server_port)
+        base_url = f"http://127.0.0.1:{server_port}"
+        noisy_port, quiet_port = free_port(), free_port()
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            noisy = await create_tunnel(session, base_url, headers, upstream_port, noisy_port)
+            await create_tunnel(session, base_url, headers, upstream_port, quiet_port)
+
+        noisy_url = f"{base_url}/proxy/{noisy_port}/bytes?n={args.size}"
+        quiet_url = f"{base_url}/proxy/{quiet_port}/bytes?n={args.size}"
+        limits = {"requests_per_second": args.rate, "concurrent": args.concurrent}
+
+        await drive(quiet_url, args.quiet_concurrency, args.quiet_concurrency)
+        elapsed, latencies, errors = await drive(quiet_url, args.requests, args.quiet_concurrency)
+        report("quiet tunnel alone", args.requests, elapsed, latencies, errors)
+
+        for name, tunnel_limits in (("no limits", None), (f"limits {json.dumps(limits)}", limits)):
+            async with aiohttp.ClientSession() as session:
+                async with session.put(f"{base_url}/api/tunnels/{noisy['tunnel_id']}/limits",
+                                       headers=headers, json=tunnel_limits or {}) as resp:
+                    resp.raise_for_status()
+            # 吵闹的请求方在独立进程中, 不与本进程中测量安静隧道的事件循环争抢
+            stop = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            flooder = multiprocessing.Process(
+                target=flood_process, args=(noisy_url, args.flood_rate, args.flood_concurrency, stop, results)
+            )
+            flooder.start()
+            await asyncio.sleep(1)
+            elapsed, latencies, errors = await drive(quiet_url, args.requests, args.quiet_concurrency)
+            stop.set()
+            outcomes, flood_elapsed = await asyncio.to_thread(results.get)
+            flooder.join()
+            report(f"quiet tunnel, noisy tunnel with {name}", args.requests, elapsed, latencies, errors)
+            served = outcomes.get(200, 0)
+            print(f"noisy tunnel with {name}: {served / flood_elapsed:.1f} req/s served, "
+                  f"responses by status {dict(sorted(outcomes.items(), key=str))}")
+
+        rate = args.bandwidth * 1024
+        async with aiohttp.ClientSession() as session:
+            async with session.put(f"{base_url}/api/tunnels/{noisy['tunnel_id']}/limits",
+                                   headers=headers, json={"bytes_per_second": rate}) as resp:
+                resp.raise_for_status()
+            size = rate * 4
+            started = time.perf_counter()
+            async with session.get(f"{base_url}/proxy/{noisy_port}/bytes?n={size}") as resp:
+                received = len(await resp.read())
+            elapsed = time.perf_counter() - started
+        print(f"bandwidth limit {args.bandwidth} KB/s: downloaded {received // 1024} KB in {elapsed:.2f}s, "
+              f"{received / 1024 / elapsed:.0f} KB/s (the first second is a burst)")
+    finally:
+        server.terminate()
+        server.wait()
+        await upstream.cleanup()
+
+
+class FaultyProxy:
+    """转发到 target_port 的 TCP 代理, drop() 立即中断所有已建立的连接 (RST)"""
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.transports = set()
+        self.server = None
+
+    async def start(self, port):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+
+    async def _handle(self, reader, writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        except OSError:
+            writer.transport.abort()
+            return
+        pair = (writer.transport, upstream_writer.transport)
+        self.transports.update(pair)
+
+        async def pipe(src, dst):
+            try:
+                while True:
+                    data = await src.read(65536)
+                    if not data:
+                        break
+                    dst.write(data)
+                    await dst.drain()
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                dst.transport.abort()
+
+        try:
+            await asyncio.gather(pipe(reader, upstream_writer), pipe(upstream_reader, writer))
+        except asyncio.CancelledError:
+            # 压测结束时事件循环取消仍在转发的连接
+            pass
+        finally:
+            self.transports.difference_update(pair)
+
+    def drop(self):
+        for transport in list(self.transports):
+            transport.abort()
+        self.transports.clear()
+
+    def close(self):
+        self.drop()
+        self.server.close()
+
+
+async def start_slow_upstream(port, delay, peers=None, host="127.0.0.1"):
+    """每个请求等待 delay 秒后返回; peers 为集合时记录每个请求的来源地址, 用于统计建立过的连接数"""
+    async def slow(request):
+        if peers is not None:
+            peers.add(request.transport.get_extra_info("peername"))
+        await asyncio.sleep(delay)
+        return web.Response(text="ok")
+
+    upstream = web.Application()
+    upstream.router.add_get("/", slow)
+    runner = web.AppRunner(upstream)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def bench_faults(args):
+    upstream_port = free_port()
+    upstream = await start_slow_upstream(upstream_port, args.delay)
+    try:
+        for name, grace in (("resume", "30"), ("no resume", "0")):
+            server_port = free_port()
+            proxy_port = free_port()
+            public_port = free_port()
+            # 客户端不在线时服务端会直连本地端口, 指向不监听的地址, 使这类请求失败而不是绕过客户端
+            server = start_uvicorn("server:app", server_port, {
+                "TCP_TUNNELS_ENABLED": "false", "SESSION_GRACE_PERIOD": grace, "UPSTREAM_HOST": "127.0.0.2"
+            })
+            proxy = FaultyProxy(server_port)
+            client = None
+            try:
+                await wait_for_port(server_port)
+                await proxy.start(proxy_port)
+                client = start_client(proxy_port, upstream_port, public_port)
+                url = f"http://127.0.0.1:{server_port}/proxy/{public_port}/"
+                await wait_for_url(url)
+
+                completions = []  # (完成时间, 是否成功)
+                stop = asyncio.Event()
+                connector = aiohttp.TCPConnector(limit=args.concurrency)
+                async with aiohttp.ClientSession(connector=connector) as session:
+                    async def worker():
+                        while not stop.is_set():
+                            try:
+                                async with session.get(url) as resp:
+                                    await resp.read()
+                                    ok = resp.status == 200
+                            except aiohttp.ClientError:
+                                ok = False
+                            completions.append((time.perf_counter(), ok))
+                            if not ok:
+                                await asyncio.sleep(0.01)
+
+                    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+                    drops = []
+                    for _ in range(args.drops):
+                        await asyncio.sleep(args.interval)
+                        drops.append(time.perf_counter())
+                        proxy.drop()
+                    await asyncio.sleep(args.interval)
+                    stop.set()
+                    await asyncio.gather(*workers)
+
+                # 恢复时间: 断线后到最后一个失败请求之后的第一个成功请求 (没有失败时为第一个成功请求)
+                recoveries = []
+                for start in drops:
+                    window = [(t, ok) for t, ok in completions if start <= t < start + args.interval]
+                    last_failure = max((t for t, ok in window if not ok), default=start)
+                    recovered = min((t for t, ok in window if ok and t >= last_failure), default=None)
+                    if recovered is not None:
+                        recoveries.append(recovered - start)
+                failed = sum(1 for _, ok in completions if not ok)
+                print(f"{name}: {len(completions)} requests, {failed} failed across {args.drops} drops; "
+                      f"recovery p50={percentile(recoveries, 50) * 1000:.0f}ms "
+                      f"max={max(recoveries, default=0) * 1000:.0f}ms "
+                      f"({len(recoveries)}/{args.drops} recovered within {args.interval}s)")
+            finally:
+                for proc in (client, server):
+                    if proc is not None:
+                        proc.terminate()
+                        proc.wait()
+                proxy.close()
+    finally:
+        await upstream.cleanup()
+
+
+async def bench_client(args):
+    upstream_port = free_port()
+    peers = set()
+    upstream = await start_slow_upstream(upstream_port, args.delay, peers)
+    try:
+        for name, limit in (("serial", "1"), ("concurrent", str(args.requests))):
+            server_port = free_port()
+            public_port = free_port()
+            # 逐个处理时最后一个请求要等 requests * delay, 服务端等待响应头的超时需要更长
+            server = start_uvicorn("server:app", server_port, {
+                "TCP_TUNNELS_ENABLED": "false", "UPSTREAM_TIMEOUT": str(args.requests * args.delay * 2 + 10)
+            })
+            client = None
+            peers.clear()
+            try:
+                await wait_for_port(server_port)
+                client = start_client(server_port, upstream_port, public_port, {"CLIENT_MAX_CONCURRENT": limit})
+                url = f"http://127.0.0.1:{server_port}/proxy/{public_port}/"
+                await wait_for_url(url)
+                connector = aiohttp.TCPConnector(limit=args.requests)
+                timeout = aiohttp.ClientTimeout(total=None)
+                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                    async def one():
+                        async with session.get(url) as resp:
+                            await resp.read()
+                            return resp.status
+
+                    for round_ in range(args.rounds):
+                        start = time.perf_counter()
+                        statuses = await asyncio.gather(*(one() for _ in range(args.requests)))
+                        elapsed = time.perf_counter() - start
+                        ok = sum(1 for status in statuses if status == 200)
+                        print(f"{name} (CLIENT_MAX_CONCURRENT={limit}) round {round_ + 1}: "
+                              f"{args.requests} x {args.delay * 1000:.0f}ms requests in {elapsed:.2f}s "
+                              f"({ok} ok, {len(peers)} local connections opened so far)")
+            finally:
+                for proc in (client, server):
+                    if proc is not None:
+                        proc.terminate()
+                        proc.wait()
+    finally:
+        await upstream.cleanup()
+
+
+def rss_kb(pid) -> int:
+    """进程当前的 RSS (KB), 只支持 Linux"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+async def bench_tunnels(args):
+    upstream_port = free_port()
+    upstream = await start_slow_upstream(upstream_port, 0)
+    workdir = tempfile.mkdtemp()
+    try:
+        for name in ("one client", "client per tunnel"):
+            server_port = free_port()
+            public_ports = [free_port() for _ in range(args.tunnels)]
+            server = start_uvicorn("server:app", server_port, {"TCP_TUNNELS_ENABLED": "false"})
+            clients = []
+            try:
+                await wait_for_port(server_port)
+                start = time.perf_counter()
+                if name == "one client":
+                    config = os.path.join(workdir, "tunnels.json")
+                    with open(config, "w") as f:
+                        json.dump({"tunnels": {
+                            f"t{i}": {"local_port": upstream_port, "public_port": port}
+                            for i, port in enumerate(public_ports)
+                        }}, f)
+                    clients.append(start_client(server_port, upstream_port, 0, {"CLIENT_CONFIG": config}))
+                else:
+                    clients.extend(start_client(server_port, upstream_port, port) for port in public_ports)
+                urls = [f"http://127.0.0.1:{server_port}/proxy/{port}/" for port in public_ports]
+                for url in urls:
+                    await wait_for_url(url, timeout=60)
+                ready = time.perf_counter() - start
+                rss = sum(rss_kb(client.pid) for client in clients)
+
+                async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+                    async def one(url):
+                        async with session.get(url) as resp:
+                            await resp.read()
+                            return resp.status == 200
+
+                    start = time.perf_counter()
+                    results = await asyncio.gather(*(
+                        one(urls[i % len(urls)]) for i in range(args.requests)
+                    ))
+                    elapsed = time.perf_counter() - start
+                print(f"{name}: {args.tunnels} tunnels over {len(clients)} websockets, ready in {ready:.2f}s, "
+                      f"client RSS {rss / 1024:.1f}MB, {args.requests / elapsed:.0f} req/s "
+                      f"({sum(results)}/{args.requests} ok)")
+            finally:
+                for proc in (*clients, server):
+                    proc.terminate()
+                for proc in (*clients, server):
+                    proc.wait()
+    finally:
+        await upstream.cleanup()
+
+
+async def bench_groups(args):
+    import random
+    from balancer import POLICIES, TunnelGroup
+
+    logging.disable(logging.WARNING)
+    latencies = list(args.latencies)
+    if args.failing:
+        latencies.append(None)  # 立即返回 5xx 的成员
+
+    for policy in POLICIES:
+        random.seed(1)
+        group = TunnelGroup(policy)
+        slots = {}
+        served = {}
+        for i, latency in enumerate(latencies):
+            group.add(f"m{i}")
+            slots[f"m{i}"] = asyncio.Semaphore(args.capacity)
+            served[f"m{i}"] = 0
+
+        async def one(results):
+            start = time.perf_counter()
+            backend = group.pick()
+            group.start(backend)
+            served[backend.key] += 1
+            latency = latencies[int(backend.key[1:])]
+            try:
+                if latency is None:
+                    ok = False
+                else:
+                    # 成员内部排队: 同时只处理 capacity 个请求
+                    async with slots[backend.key]:
+                        await asyncio.sleep(random.expovariate(1 / latency))
+                    ok = True
+                group.observe(backend, time.perf_counter() - start, ok)
+            finally:
+                group.done(backend)
+            results.append((time.perf_counter() - start, ok))
+
+        results = []
+        tasks = []
+        interval = 1 / args.rate
+        begin = time.perf_counter()
+        for i in range(args.requests):
+            # 开环到达: 不等前面的请求完成
+            delay = begin + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(results)))
+        await asyncio.gather(*tasks)
+        ok = sorted(latency for latency, success in results if success)
+        errors = len(results) - len(ok)
+        share = " ".join(f"{served[key] * 100 // args.requests}%" for key in served)
+        print(f"{policy:>17}: p50 {percentile(ok, 50) * 1000:.1f}ms, p99 {percentile(ok, 99) * 1000:.1f}ms, "
+              f"max {ok[-1] * 1000:.1f}ms, errors {errors}, share per member {share}")
+
+
+async def bench_codec(args):
+    import base64
+    import zlib
+    from codec import decode_message, encode_message
+    from protocol import (
+        FRAME_DATA, FRAME_HEADERS, MAX_FRAME_SIZE, decode_frame, decode_request_head, encode_frame,
+        encode_request_head
+    )
+
+    n = args.iterations
+    messages = {
+        "ack": {"type": "ack", "received": 123456},
+        "ping": {"type": "ping", "id": 42, "received": 123456},
+        "tunnel_request": {
+            "type": "tunnel_request", "tunnel_id": "web", "local_port": 3000, "public_port": 8001,
+            "custom_domain": "app.example.com", "cache": False, "compress": True, "group": None
+        },
+    }
+    for name, message in messages.items():
+        sizes = []
+        for version in (0, 1):
+            encoded = encode_message(message, version)
+            encode_us = timed(lambda: [encode_message(message, version) for _ in range(n)], n)
+            decode_us = timed(lambda: [decode_message(encoded) for _ in range(n)], n)
+            sizes.append(f"{'json' if version == 0 else 'binary'} {len(encoded)}B "
+                         f"encode {encode_us:.2f}us decode {decode_us:.2f}us")
+        print(f"{name}: " + ", ".join(sizes))
+
+    # 浏览器发出的典型请求头, 约 700 字节
+    headers = [
+        ("host", "app.example.com"), ("user-agent", "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+         "(KHTML, like Gecko) Chrome/120.0 Safari/537.36"),
+        ("accept", "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"),
+        ("accept-language", "zh-CN,zh;q=0.9,en;q=0.8"), ("accept-encoding", "gzip, deflate, br"),
+        ("cookie", "session=" + "a" * 120 + "; theme=dark; _ga=GA1.1.123456789.1700000000"),
+        ("referer", "https://app.example.com/dashboard"), ("content-type", "application/json"),
+        ("x-forwarded-for", "203.0.113.7"), ("x-request-id", "0f8fad5b-d9cb-469f-a165-70867728950e"),
+        ("sec-fetch-mode", "navigate"), ("cache-control", "no-cache"),
+    ]
+    bodies = {
+        "1KB json": json.dumps([{"id": i, "name": f"item {i}", "done": i % 2 == 0} for i in range(25)]).encode(),
+        "16KB html": ("<tr><td class='cell'>row %d</td><td>value</td></tr>\n" * 320 % tuple(range(320))).encode(),
+        "64KB binary": os.urandom(64 * 1024),
+    }
+    for name, body in bodies.items():
+        def json_encode():
+            return json.dumps({
+                "method": "POST", "path": "/api/items", "headers": dict(headers),
+                "body": base64.b64encode(body).decode("ascii")
+            })
+
+        def frame_encode():
+            frames = [encode_frame(FRAME_HEADERS, 1, encode_request_head("POST", "/api/items", headers))]
+            view = memoryview(body)
+            for offset in range(0, len(body), MAX_FRAME_SIZE):
+                frames.append(encode_frame(FRAME_DATA, 1, view[offset:offset + MAX_FRAME_SIZE]))
+            return frames
+
+        text = json_encode()
+        frames = frame_encode()
+
+        def json_decode():
+            request = json.loads(text)
+            return base64.b64decode(request["body"])
+
+        def frame_decode():
+            _, _, _, payload = decode_frame(frames[0])
+            decode_request_head(payload)
+            return [decode_frame(frame)[3] for frame in frames[1:]]
+
+        rounds = max(100, n // 10)
+        print(
+            f"request with {name} body: json+base64 {len(text)}B encode {timed(lambda: [json_encode() for _ in range(rounds)], rounds):.1f}us "
+            f"decode {timed(lambda: [json_decode() for _ in range(rounds)], rounds):.1f}us; "
+            f"frames {sum(map(len, frames))}B encode {timed(lambda: [frame_encode() for _ in range(rounds)], rounds):.1f}us "
+            f"decode {timed(lambda: [frame_decode() for _ in range(rounds)], rounds):.1f}us"
+        )
+        compressed = zlib.compress(body, 1)
+        compress_us = timed(lambda: [zlib.compress(body, 1) for _ in range(rounds)], rounds)
+        decompress_us = timed(lambda: [zlib.decompress(compressed) for _ in range(rounds)], rounds)
+        print(f"    compressed frame {len(compressed)}B ({len(compressed) * 100 // len(body)}% of body), "
+              f"compress {compress_us:.1f}us, decompress {decompress_us:.1f}us")
+
+
+async def bench_startup(args):
+    from registry import open_registry
+    from server import ConnectionManager
+
+    logging.disable(logging.INFO)
+    upstream_port = free_port()
+    upstream = await start_slow_upstream(upstream_port, 0)
+    workdir = tempfile.mkdtemp()
+
+    def tunnel(i):
+        return {
+            "tunnel_id": f"t{i}", "client_id": f"t{i}", "name": None, "group": None,
+            "local_port": upstream_port, "public_port": 10000 + i, "custom_domain": f"t{i}.example.com",
+            "cache": False, "compress": False, "owner": "admin", "limits": None,
+            "created_at": "2024-01-01T00:00:00"
+        }
+
+    async def serving(env, url):
+        """启动 server.py, 返回 (进程, 从启动到 url 返回 200 的秒数)"""
+        port = free_port()
+        start = time.perf_counter()
+        server = start_uvicorn("server:app", port, {"TCP_TUNNELS_ENABLED": "false", **env})
+        await wait_for_url(f"http://127.0.0.1:{port}{url}", timeout=120)
+        return server, port, time.perf_counter() - start
+
+    try:
+        server, _, elapsed = await serving({"TUNNEL_REGISTRY": "memory"}, "/login")
+        server.terminate()
+        server.wait()
+        print(f"empty registry: serving after {elapsed:.2f}s")
+        for n in args.tunnels:
+            for backend in ("journal", "sqlite"):
+                path = os.path.join(workdir, f"{backend}-{n}")
+                registry = open_registry(backend, path)
+                for i in range(n):
+                    registry.put_tunnel(tunnel(i))
+                registry.close()
+
+                start = time.perf_counter()
+                registry = open_registry(backend, path)
+                registry.load()
+                read = time.perf_counter() - start
+                registry.close()
+                start = time.perf_counter()
+                registry = open_registry(backend, path)
+                ConnectionManager(None, registry).restore()
+                restored = time.perf_counter() - start
+                registry.close()
+
+                env = {"TUNNEL_REGISTRY": backend, "TUNNEL_REGISTRY_PATH": path}
+                server, _, elapsed = await serving(env, f"/proxy/{10000 + n - 1}/")
+                rss = rss_kb(server.pid)
+                server.terminate()
+                server.wait()
+                print(f"{backend}, {n} tunnels: restore {restored * 1000:.0f}ms (reading {read * 1000:.0f}ms), "
+                      f"last tunnel serving {elapsed:.2f}s after start, server RSS {rss / 1024:.0f}MB")
+
+            if n > args.cold_limit:
+                continue
+            # 不保存隧道时, 重启后只能逐个重新创建
+            server, port, _ = await serving({"TUNNEL_REGISTRY": "memory"}, "/login")
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                async with aiohttp.ClientSession() as session:
+                    headers = await login(session, base_url)
+                    semaphore = asyncio.Semaphore(50)
+
+                    async def create(i):
+                        async with semaphore:
+                            await create_tunnel(session, base_url, headers, upstream_port, 10000 + i)
+
+                    start = time.perf_counter()
+                    await asyncio.gather(*(create(i) for i in range(n)))
+                    elapsed = time.perf_counter() - start
+                print(f"memory, {n} tunnels: re-creating them through the API after a restart takes {elapsed:.2f}s")
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        await upstream.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def start_server_script(env, log_path):
+    """以 python server.py 启动服务端 (SERVER_RELOAD=false 时由 drain.py 的 serve 运行), 输出追加到 log_path"""
+    with open(log_path, "ab") as log:
+        return subprocess.Popen(
+            [sys.executable, "server.py"],
+            cwd=ROOT,
+            env={**os.environ, **env},
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+async def wait_for_log(path, marker, offset=0, timeout=30):
+    """等待日志文件 offset 之后出现 marker"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            if marker.encode() in f.read():
+                return
+        await asyncio.sleep(0.05)
+    raise RuntimeError(f"{marker!r} did not appear in {path}")
+
+
+async def tcp_get(port, size):
+    """经 TCP 隧道发一个 HTTP/1.0 请求, 返回是否完整收到 200 响应"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(f"GET /bytes?n={size} HTTP/1.0\r\nHost: localhost\r\n\r\n".encode())
+        data = await asyncio.wait_for(reader.read(), 10)
+    finally:
+        writer.close()
+    head, _, body = data.partition(b"\r\n\r\n")
+    return head.split(b" ", 2)[1:2] == [b"200"] and len(body) == size
+
+
+async def deploy_once(name, args, workdir, upstreams):
+    """在持续的负载下替换服务端进程一次, 返回失败的请求数"""
+    direct_port, direct_slow_port, client_port, client_slow_port = upstreams
+    server_port = free_port()
+    public = [free_port() for _ in range(4)]
+    base_url = f"http://127.0.0.1:{server_port}"
+    log_path = os.path.join(workdir, f"{name}.log")
+    # 共享注册表: 客户端改连之前, 新进程经内部连接把请求转给仍持有客户端的旧进程;
+    # 直连隧道的上游只在 127.0.0.2 上监听, 客户端隧道退回直连时会失败而不是绕过客户端
+    env = {
+        "SERVER_HOST": "127.0.0.1", "SERVER_PORT": str(server_port), "SERVER_RELOAD": "false",
+        "TUNNEL_REGISTRY": "sqlite", "TUNNEL_REGISTRY_PATH": os.path.join(workdir, f"{name}.db"),
+        "UPSTREAM_HOST": "127.0.0.2", "DRAIN_TIMEOUT": str(args.drain_timeout),
+    }
+    config_path = os.path.join(workdir, f"{name}-client.json")
+    with open(config_path, "w") as f:
+        json.dump({"tunnels": {
+            "fast": {"local_port": client_port, "public_port": public[2]},
+            "slow": {"local_port": client_slow_port, "public_port": public[3]},
+        }}, f)
+
+    def start_server(handoff=False):
+        if name == "handoff":
+            return start_server_script({**env, "SERVER_HANDOFF": str(handoff).lower()}, log_path)
+        return start_uvicorn("server:app", server_port, env)
+
+    old = start_server()
+    new = client = None
+    try:
+        await wait_for_url(f"{base_url}/login")
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            await create_tunnel(session, base_url, headers, direct_port, public[0])
+            await create_tunnel(session, base_url, headers, direct_slow_port, public[1])
+        client = start_client(server_port, client_port, public[2], {"CLIENT_CONFIG": config_path})
+        urls = {
+            "direct": f"{base_url}/proxy/{public[0]}/bytes?n={args.size}",
+            "direct slow": f"{base_url}/proxy/{public[1]}/",
+            "client": f"{base_url}/proxy/{public[2]}/bytes?n={args.size}",
+            "client slow": f"{base_url}/proxy/{public[3]}/",
+        }
+        for url in urls.values():
+            await wait_for_url(url)
+
+        counts = {kind: [0, 0] for kind in (*urls, "tcp")}  # [成功, 失败]
+        failures = []
+        stop = asyncio.Event()
+
+        def record(kind, ok, detail):
+            counts[kind][0 if ok else 1] += 1
+            if not ok and len(failures) < 5:
+                failures.append(f"{kind}: {detail}")
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            async def http_worker(kind):
+                while not stop.is_set():
+                    try:
+                        async with session.get(urls[kind]) as resp:
+                            await resp.read()
+                            record(kind, resp.status == 200, resp.status)
+                    except aiohttp.ClientError as e:
+                        record(kind, False, repr(e))
+                        await asyncio.sleep(0.01)
+
+            async def tcp_worker():
+                while not stop.is_set():
+                    try:
+                        record("tcp", await tcp_get(public[2], args.size), "incomplete response")
+                    except (OSError, asyncio.TimeoutError) as e:
+                        record("tcp", False, repr(e))
+                        await asyncio.sleep(0.01)
+
+            workers = [
+                *(http_worker(kind) for kind in ("direct", "client") for _ in range(args.concurrency)),
+                *(http_worker(kind) for kind in ("direct slow", "client slow") for _ in range(args.slow_concurrency)),
+                *(tcp_worker() for _ in range(2)),
+            ]
+            tasks = [asyncio.create_task(worker) for worker in workers]
+            await asyncio.sleep(args.settle)
+            start = time.perf_counter()
+            if name == "handoff":
+                # 旧进程准备交接, 新进程开始监听后再让旧进程排空退出
+                offset = os.path.getsize(log_path)
+                old.send_signal(signal.SIGUSR1)
+                await wait_for_log(log_path, "Ready to hand off", offset)
+                offset = os.path.getsize(log_path)
+                new = start_server(handoff=True)
+                await wait_for_log(log_path, "Listening on", offset)
+                ready = time.perf_counter() - start
+                old.terminate()
+                await asyncio.to_thread(old.wait)
+            else:
+                # 先停止旧进程, 端口空出后才能启动新进程
+                old.terminate()
+                await asyncio.to_thread(old.wait)
+                new = start_server()
+                await wait_for_port(server_port)
+                ready = time.perf_counter() - start
+            replaced = time.perf_counter() - start
+            await asyncio.sleep(args.settle)
+            stop.set()
+            await asyncio.gather(*tasks)
+
+        failed = sum(fail for _, fail in counts.values())
+        summary = ", ".join(f"{kind} {ok}/{ok + fail}" for kind, (ok, fail) in counts.items())
+        print(f"{name}: new process serving after {ready:.2f}s, old process gone after {replaced:.2f}s; "
+              f"{failed} requests failed ({summary} ok)")
+        for failure in failures:
+            print(f"    {failure}")
+        return failed
+    finally:
+        for proc in (client, new, old):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+
+
+async def bench_deploy(args):
+    workdir = tempfile.mkdtemp()
+    upstreams = [free_port() for _ in range(4)]
+    runners = [
+        await start_stream_upstream(upstreams[0], "127.0.0.2"),
+        await start_slow_upstream(upstreams[1], args.slow, host="127.0.0.2"),
+        await start_stream_upstream(upstreams[2]),
+        await start_slow_upstream(upstreams[3], args.slow),
+    ]
+    try:
+        failed = await deploy_once("handoff", args, workdir, upstreams)
+        if args.compare:
+            await deploy_once("restart", args, workdir, upstreams)
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        sys.exit(f"{failed} requests failed during the zero-downtime deploy")
+
+
+def timed(fn, count):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+async def bench_diagnostics(args):
+    import diagnostics
+
+    async def endpoint(scope, receive, send):
+        # 与转发一个请求时的记录步骤相同
+        diagnostics.tag_tunnel(8000)
+        diagnostics.mark_forward()
+        diagnostics.mark_connected()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    async def run(app, n):
+        scope = {"type": "http", "path": "/proxy/8000/", "endpoint": endpoint}
+        start = time.perf_counter()
+        for _ in range(n):
+            await app(scope, None, send)
+        return (time.perf_counter() - start) / n * 1e6
+
+    n = 100000
+    gate = diagnostics.TimingGate(endpoint, diagnostics.Timings(2048))
+    base = await run(endpoint, n)
+    timed_cost = await run(gate, n)
+    print(f"TimingGate per request: {timed_cost - base:.2f}us ({base:.2f}us without, {timed_cost:.2f}us with)")
+    start = time.perf_counter()
+    gate.timings.summary()
+    print(f"summarize {len(gate.timings.records)} timings: {(time.perf_counter() - start) * 1000:.2f}ms")
+
+    def blocking_call():
+        time.sleep(args.block)
+
+    logging.disable(logging.WARNING)
+    detector = diagnostics.StallDetector(0.05)
+    detector.start()
+    await asyncio.sleep(0.2)
+    blocking_call()
+    await asyncio.sleep(0.1)
+    detector.stop()
+    logging.disable(logging.NOTSET)
+    for stall in detector.stalls:
+        where = stall["stack"][-1].strip().splitlines()[0] if stall["stack"] else "stack not captured"
+        print(f"stall of {stall['duration'] * 1000:.0f}ms (blocked {args.block * 1000:.0f}ms): {where}")
+    if not detector.stalls:
+        print("stall detector missed the blocking call")
+
+    for enabled in ("false", "true"):
+        port = free_port()
+        server = start_uvicorn("server:app", port, {"TCP_TUNNELS_ENABLED": "false", "DIAGNOSTICS_ENABLED": enabled})
+        try:
+            await wait_for_port(port)
+            await asyncio.sleep(1)
+            before = cpu_seconds(server.pid)
+            await asyncio.sleep(args.idle)
+            used = cpu_seconds(server.pid) - before
+            print(f"idle DIAGNOSTICS_ENABLED={enabled}: {used * 1000:.0f}ms CPU in {args.idle}s "
+                  f"({used / args.idle * 100:.2f}%)")
+        finally:
+            server.terminate()
+            server.wait()
+
+    # 交替运行以抵消机器负载的波动
+    results = {"false": [], "true": []}
+    for _ in range(args.rounds):
+        for enabled in results:
+            results[enabled].append(await bench_proxy(args, {"DIAGNOSTICS_ENABLED": enabled}))
+    off = sum(results["false"]) / args.rounds
+    on = sum(results["true"]) / args.rounds
+    print(f"mean over {args.rounds} rounds: off {off:.1f} req/s, on {on:.1f} req/s, "
+          f"overhead {(off - on) / off * 100:.1f}%")
+
+
+async def bench_routing(args):
+    logging.disable(logging.INFO)
+    from server import ConnectionManager
+
+    n = args.tunnels
+    manager = ConnectionManager()
+    ports = [10000 + i for i in range(n)]
+    lookups = ports * (args.lookups // n + 1)
+    lookups = lookups[:args.lookups]
+
+    async def register():
+        for i, port in enumerate(ports):
+            await manager.register_tunnel(f"client-{i}", 8000, port, f"t{i}.example.com")
+
+    def indexed_lookup():
+        for port in lookups:
+            manager.find_tunnel_by_port(port)
+
+    # 线性扫描太慢, 只取 1% 的查找次数
+    sampled = lookups[:max(1, len(lookups) // 100)]
+
+    def linear_lookup():
+        for port in sampled:
+            for tunnel in manager.tunnels.values():
+                if tunnel["public_port"] == port:
+                    break
+
+    def teardown():
+        for i in range(n):
+            manager.disconnect(f"client-{i}")
+            manager.remove_tunnel(f"client-{i}")
+
+    # disconnect 只处理已连接的客户端
+    manager.active_connections = {f"client-{i}": None for i in range(n)}
+    start = time.perf_counter()
+    await register()
+    print(f"register: {(time.perf_counter() - start) / n * 1e6:.2f}us/tunnel ({n} tunnels)")
+    print(f"lookup by port (index): {timed(indexed_lookup, len(lookups)):.3f}us")
+    print(f"lookup by port (linear scan): {timed(linear_lookup, len(sampled)):.3f}us")
+    print(f"teardown: {timed(teardown, n):.2f}us/tunnel")
+
+    from fnmatch import fnmatch
+    from host_router import DomainTrie
+
+    for count in args.domains:
+        trie = DomainTrie()
+        patterns = []
+        for i in range(count):
+            # 每十个域名中有一个通配符
+            domain = f"*.w{i}.example.com" if i % 10 == 0 else f"app{i}.example{i % 100}.com"
+            trie.add(domain, i)
+            patterns.append(domain)
+        hosts = []
+        for i in range(0, count, max(1, count // 1000)):
+            hosts.append(f"x.w{i}.example.com" if i % 10 == 0 else f"app{i}.example{i % 100}.com")
+            hosts.append(f"missing{i}.example.org")
+        hosts = hosts * (args.lookups // len(hosts) + 1)
+
+        def trie_lookup():
+            for host in hosts:
+                trie.match(host)
+
+        # 线性匹配太慢, 只取少量主机名
+        sampled = hosts[:20]
+
+        def linear_match():
+            for host in sampled:
+                for pattern in patterns:
+                    if fnmatch(host, pattern):
+                        break
+
+        print(f"host match, {count} domains: trie {timed(trie_lookup, len(hosts)):.3f}us, "
+              f"linear fnmatch {timed(linear_match, len(sampled)):.1f}us")
+
+
+def cpu_seconds(pid) -> float:
+    """进程累计的用户态加内核态 CPU 时间 (秒), 只支持 Linux"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def git_revision():
+    """返回 (当前提交, 工作区是否有未提交的修改), 不在 git 仓库中时为 (None, None)"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def serve_suite_upstreams(stream_port, ws_port):
+    """suite 的上游服务, 在单独的进程中运行, 不与压测端争用事件循环"""
+    async def serve():
+        await start_stream_upstream(stream_port)
+        await start_ws_echo_server(ws_port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+SUITE_WORKLOADS = (
+    "proxy_small", "proxy_download", "proxy_upload", "proxy_high_concurrency", "client_small",
+    "client_download", "client_websocket", "login_storm", "api_create_tunnels", "api_list_tunnels",
+    "proxy_many_tunnels",
+)
+
+
+def compare_results(old, new):
+    """逐项打印两次 suite 结果的吞吐和 p99 变化"""
+    print(f"compared with {old['meta'].get('commit') or 'unknown commit'}:")
+    for name, result in new["workloads"].items():
+        before = old["workloads"].get(name)
+        if before is None:
+            continue
+        change = (result["req_per_s"] / before["req_per_s"] - 1) * 100 if before["req_per_s"] else 0.0
+        print(f"  {name}: {before['req_per_s']:.1f} -> {result['req_per_s']:.1f} req/s ({change:+.1f}%), "
+              f"p99 {before['p99_ms']:.1f} -> {result['p99_ms']:.1f}ms")
+
+
+async def bench_suite(args):
+    selected = args.only or SUITE_WORKLOADS
+    unknown = set(selected) - set(SUITE_WORKLOADS)
+    if unknown:
+        raise SystemExit(f"unknown workloads: {', '.join(sorted(unknown))}")
+    stream_port = free_port()
+    ws_port = free_port()
+    server_port = free_port()
+    direct_port = free_port()
+    client_ports = [free_port() for _ in range(args.clients)]
+    ws_client_port = free_port()
+    base_url = f"http://127.0.0.1:{server_port}"
+    large = args.large_size * 1024
+
+    upstreams = multiprocessing.Process(target=serve_suite_upstreams, args=(stream_port, ws_port), daemon=True)
+    upstreams.start()
+    server = start_uvicorn("server:app", server_port, {"TCP_TUNNELS_ENABLED": "false"})
+    clients = []
+    workdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        await wait_for_port(stream_port)
+        await wait_for_port(server_port)
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, base_url)
+            await create_tunnel(session, base_url, headers, stream_port, direct_port)
+        for i, public_port in enumerate(client_ports):
+            tunnels = {"http": {"local_port": stream_port, "public_port": public_port}}
+            if i == 0:
+                tunnels["ws"] = {"local_port": ws_port, "public_port": ws_client_port}
+            config = os.path.join(workdir, f"client{i}.json")
+            with open(config, "w") as f:
+                json.dump({"tunnels": tunnels}, f)
+            clients.append(start_client(server_port, stream_port, 0, {"CLIENT_CONFIG": config}))
+        for public_port in client_ports:
+            await wait_for_url(f"{base_url}/proxy/{public_port}/bytes?n=1")
+        await wait_for_url(f"{base_url}/proxy/{ws_client_port}/")
+
+        def direct(size):
+            return f"{base_url}/proxy/{direct_port}/bytes?n={size}"
+
+        def via_clients(size):
+            return [f"{base_url}/proxy/{port}/bytes?n={size}" for port in client_ports]
+
+        async def run_drive(url, total, concurrency, method="GET", data=None, size=0):
+            await drive(url, min(total, concurrency), concurrency, method, data)
+            elapsed, latencies, errors = await drive(url, total, concurrency, method, data)
+            result = {"requests": total, "errors": errors, "seconds": elapsed, "latencies": latencies}
+            if size:
+                result["mb_per_s"] = total * size / elapsed / 1024 / 1024
+            return result
+
+        async def login_storm():
+            stop = asyncio.Event()
+            outcomes = {}
+
+            async def storm(session):
+                while not stop.is_set():
+                    async with session.post(f"{base_url}/api/login",
+                                            json={"username": "admin", "password": "admin"}) as resp:
+                        await resp.read()
+                        outcomes[str(resp.status)] = outcomes.get(str(resp.status), 0) + 1
+
+            async with aiohttp.ClientSession() as session:
+                storms = [asyncio.create_task(storm(session)) for _ in range(args.login_concurrency)]
+                await asyncio.sleep(0.5)
+                result = await run_drive(direct(args.small_size), args.requests, args.concurrency)
+                stop.set()
+                await asyncio.gather(*storms)
+            result["logins_by_status"] = dict(sorted(outcomes.items()))
+            return result
+
+        created_ports = []
+
+        async def create_tunnels():
+            used = {direct_port, ws_client_port, *client_ports}
+            candidates = (port for port in range(20000, 65536) if port not in used)
+            ports = [next(candidates) for _ in range(args.tunnels)]
+            latencies = []
+            errors = 0
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.api_concurrency)) as session:
+                headers = await login(session, base_url)
+                remaining = iter(ports)
+
+                async def worker():
+                    nonlocal errors
+                    for port in remaining:
+                        start = time.perf_counter()
+                        async with session.post(f"{base_url}/api/tunnels", headers=headers,
+                                                json={"local_port": stream_port, "public_port": port}) as resp:
+                            await resp.read()
+                            if resp.status >= 400:
+                                errors += 1
+                            else:
+                                created_ports.append(port)
+                        latencies.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(worker() for _ in range(args.api_concurrency)))
+                elapsed = time.perf_counter() - start
+            return {"requests": len(ports), "errors": errors, "seconds": elapsed, "latencies": latencies}
+
+        async def list_tunnels():
+            # 每次返回全部隧道, 响应很大, 逐个请求
+            latencies = []
+            errors = 0
+            count = max(1, args.requests // 20)
+            async with aiohttp.ClientSession() as session:
+                headers = await login(session, base_url)
+                start = time.perf_counter()
+                for _ in range(count):
+                    request_start = time.perf_counter()
+                    async with session.get(f"{base_url}/api/tunnels", headers=headers) as resp:
+                        await resp.read()
+                        if resp.status >= 400:
+                            errors += 1
+                    latencies.append(time.perf_counter() - request_start)
+                elapsed = time.perf_counter() - start
+            return {"requests": count, "errors": errors, "seconds": elapsed, "latencies": latencies,
+                    "tunnels": len(created_ports) + 1 + len(client_ports) + 1}
+
+        async def client_websocket():
+            url = f"ws://127.0.0.1:{server_port}/proxy/{ws_client_port}/echo"
+            payload = b"x" * args.small_size
+            count = max(1, args.requests // 2)
+            async with aiohttp.ClientSession() as session:
+                await ws_latency(session, url, payload, min(count, 100))
+                start = time.perf_counter()
+                latencies = await ws_latency(session, url, payload, count)
+                elapsed = time.perf_counter() - start
+            return {"requests": count, "errors": 0, "seconds": elapsed, "latencies": latencies}
+
+        async def many_tunnels():
+            if not created_ports:
+                await create_tunnels()
+            urls = [f"{base_url}/proxy/{port}/bytes?n={args.small_size}" for port in created_ports]
+            return await run_drive(urls, args.requests, args.concurrency)
+
+        workloads = {
+            "proxy_small": lambda: run_drive(direct(args.small_size), args.requests, args.concurrency),
+            "proxy_download": lambda: run_drive(direct(large), max(1, args.requests // 10),
+                                                min(args.concurrency, 10), size=large),
+            "proxy_upload": lambda: run_drive(f"{base_url}/proxy/{direct_port}/upload", max(1, args.requests // 10),
+                                              min(args.concurrency, 10), "POST", b"x" * large, large),
+            "proxy_high_concurrency": lambda: run_drive(direct(args.small_size), args.requests,
+                                                        args.high_concurrency),
+            "client_small": lambda: run_drive(via_clients(args.small_size), args.requests, args.concurrency),
+            "client_download": lambda: run_drive(via_clients(large), max(1, args.requests // 10),
+                                                 min(args.concurrency, 10), size=large),
+            "client_websocket": client_websocket,
+            "login_storm": login_storm,
+            "api_create_tunnels": create_tunnels,
+            "api_list_tunnels": list_tunnels,
+            "proxy_many_tunnels": many_tunnels,
+        }
+        processes = {"server": server.pid, "clients": [client.pid for client in clients]}
+        # 按 SUITE_WORKLOADS 的顺序执行, 隧道多的放在最后, 不影响前面的结果
+        for name in SUITE_WORKLOADS:
+            if name not in selected:
+                continue
+            # CPU 时间包括预热, 占用率按整个工作负载的耗时计算
+            cpu_before = {pid: cpu_seconds(pid) for pid in (server.pid, *processes["clients"])}
+            start = time.perf_counter()
+            result = await workloads[name]()
+            wall = time.perf_counter() - start
+            cpu = {pid: cpu_seconds(pid) - before for pid, before in cpu_before.items()}
+            latencies = result.pop("latencies")
+            elapsed = result["seconds"]
+            report(name, result["requests"], elapsed, latencies, result["errors"])
+            client_cpu = sum(cpu[pid] for pid in processes["clients"])
+            results[name] = {
+                **result,
+                "req_per_s": result["requests"] / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "server_cpu_s": cpu[server.pid],
+                "server_cpu_pct": cpu[server.pid] / wall * 100,
+                "server_rss_mb": rss_kb(server.pid) / 1024,
+                "clients_cpu_s": client_cpu,
+                "clients_rss_mb": sum(rss_kb(pid) for pid in processes["clients"]) / 1024,
+            }
+        peak_rss = peak_rss_mb(server.pid)
+    finally:
+        for proc in (*clients, server):
+            proc.terminate()
+        for proc in (*clients, server):
+            proc.wait()
+        upstreams.terminate()
+        upstreams.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit, dirty = git_revision()
+    output = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+            "server_peak_rss_mb": peak_rss,
+            "args": {key: value for key, value in vars(args).items() if key not in ("func", "compare", "output")},
+        },
+        "workloads": results,
+    }
+    if args.output == "-":
+        print(json.dumps(output, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zhitrend_cpolar benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    proxy = sub.add_parser("proxy", help="HTTP proxy throughput through /proxy/{port}")
+    proxy.add_argument("--requests", type=int, default=2000)
+    proxy.add_argument("--concurrency", type=int, default=50)
+    proxy.add_argument("--tunnels", type=int, default=1,
+                       help="total tunnels registered on the server")
+    proxy.set_defaults(func=bench_proxy)
+
+    stream = sub.add_parser("stream", help="peak server RSS while streaming large bodies")
+    stream.add_argument("--sizes", type=int, nargs="+", default=[64, 512],
+                        help="body sizes in MB")
+    stream.set_defaults(func=bench_stream)
+
+    routing = sub.add_parser("routing", help="ConnectionManager index micro-benchmark")
+    routing.add_argument("--tunnels", type=int, default=10000)
+    routing.add_argument("--lookups", type=int, default=100000)
+    routing.add_argument("--domains", type=int, nargs="+", default=[1000, 10000, 50000])
+    routing.set_defaults(func=bench_routing)
+
+    mux = sub.add_parser("mux", help="throughput through the client WebSocket tunnel")
+    mux.add_argument("--requests", type=int, default=2000)
+    mux.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    mux.set_defaults(func=bench_mux)
+
+    tcp = sub.add_parser("tcp", help="raw TCP tunnel throughput against a local echo server")
+    tcp.add_argument("--megabytes", type=int, default=256)
+    tcp.add_argument("--streams", type=int, default=4)
+    tcp.add_argument("--connections", type=int, default=2000)
+    tcp.add_argument("--concurrency", type=int, default=20)
+    tcp.add_argument("--via-client", action="store_true")
+    tcp.set_defaults(func=bench_tcp)
+
+    logins = sub.add_parser("logins", help="proxy latency while /api/login is hammered")
+    logins.add_argument("--requests", type=int, default=1000)
+    logins.add_argument("--concurrency", type=int, default=10)
+    logins.add_argument("--login-concurrency", type=int, default=20)
+    logins.set_defaults(func=bench_logins)
+
+    auth = sub.add_parser("auth", help="per-request CPU of get_current_user")
+    auth.add_argument("--calls", type=int, default=20000)
+    auth.set_defaults(func=bench_auth)
+
+    metrics = sub.add_parser("metrics", help="overhead of metrics recording on /proxy")
+    metrics.add_argument("--requests", type=int, default=2000)
+    metrics.add_argument("--concurrency", type=int, default=50)
+    metrics.add_argument("--rounds", type=int, default=3)
+    metrics.set_defaults(func=bench_metrics, tunnels=1)
+
+    admin = sub.add_parser("admin", help="admin dashboard refresh: full refetch vs feed diffs")
+    admin.add_argument("--tunnels", type=int, default=10000)
+    admin.add_argument("--changes", type=int, default=20,
+                       help="tunnels changed per tick, each several times")
+    admin.set_defaults(func=bench_admin)
+
+    cluster = sub.add_parser("cluster", help="throughput with several uvicorn workers sharing a registry")
+    cluster.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    cluster.add_argument("--requests", type=int, default=4000)
+    cluster.add_argument("--concurrency", type=int, default=64)
+    cluster.set_defaults(func=bench_cluster)
+
+    websocket = sub.add_parser("websocket", help="WebSocket messages/s and latency through the tunnel")
+    websocket.add_argument("--messages", type=int, default=20000,
+                           help="messages per throughput run, split across connections")
+    websocket.add_argument("--roundtrips", type=int, default=2000)
+    websocket.add_argument("--connections", type=int, nargs="+", default=[1, 10])
+    websocket.add_argument("--size", type=int, default=128, help="message size in bytes")
+    websocket.set_defaults(func=bench_websocket)
+
+    cache = sub.add_parser("cache", help="upstream offload and throughput with the edge cache")
+    cache.add_argument("--requests", type=int, default=4000)
+    cache.add_argument("--concurrency", type=int, default=50)
+    cache.add_argument("--assets", type=int, default=200, help="distinct cacheable URLs")
+    cache.add_argument("--delay", type=float, default=0.005, help="simulated upstream time per request")
+    cache.set_defaults(func=bench_cache)
+
+    limits = sub.add_parser("limits", help="fairness between a flooding tunnel and a quiet one")
+    limits.add_argument("--requests", type=int, default=500, help="requests sent to the quiet tunnel")
+    limits.add_argument("--quiet-concurrency", type=int, default=2)
+    limits.add_argument("--flood-rate", type=float, default=800, help="requests/s offered to the noisy tunnel")
+    limits.add_argument("--flood-concurrency", type=int, default=200,
+                        help="outstanding requests at most on the noisy tunnel")
+    limits.add_argument("--size", type=int, default=1024, help="response size in bytes")
+    limits.add_argument("--rate", type=float, default=100, help="requests_per_second for the noisy tunnel")
+    limits.add_argument("--concurrent", type=int, default=10, help="concurrent limit for the noisy tunnel")
+    limits.add_argument("--bandwidth", type=int, default=256, help="bytes_per_second in KB for the shaping run")
+    limits.set_defaults(func=bench_limits)
+
+    faults = sub.add_parser("faults", help="tunnel recovery when the client connection keeps dropping")
+    faults.add_argument("--drops", type=int, default=5)
+    faults.add_argument("--interval", type=float, default=2, help="seconds between drops")
+    faults.add_argument("--concurrency", type=int, default=10)
+    faults.add_argument("--delay", type=float, default=0.05, help="upstream time per request")
+    faults.set_defaults(func=bench_faults)
+
+    client = sub.add_parser("client", help="concurrent slow requests through one tunnel client")
+    client.add_argument("--requests", type=int, default=50)
+    client.add_argument("--delay", type=float, default=0.2, help="upstream time per request")
+    client.add_argument("--rounds", type=int, default=2, help="later rounds reuse pooled local connections")
+    client.set_defaults(func=bench_client)
+
+    tunnels = sub.add_parser("tunnels", help="many tunnels in one client process versus one process each")
+    tunnels.add_argument("--tunnels", type=int, default=50)
+    tunnels.add_argument("--requests", type=int, default=2000)
+    tunnels.add_argument("--concurrency", type=int, default=50)
+    tunnels.set_defaults(func=bench_tunnels)
+
+    groups = sub.add_parser("groups", help="load balancing policies over a simulated uneven tunnel group")
+    groups.add_argument("--requests", type=int, default=4000)
+    groups.add_argument("--rate", type=float, default=300, help="arrivals per second")
+    groups.add_argument("--latencies", type=float, nargs="+", default=[0.01, 0.01, 0.01, 0.1],
+                        help="mean service time of each member")
+    groups.add_argument("--capacity", type=int, default=4, help="requests a member handles at once")
+    groups.add_argument("--failing", action="store_true", help="add a member that always fails")
+    groups.set_defaults(func=bench_groups)
+
+    codec = sub.add_parser("codec", help="control message and frame encoding: JSON versus binary")
+    codec.add_argument("--iterations", type=int, default=20000)
+    codec.set_defaults(func=bench_codec)
+
+    startup = sub.add_parser("startup", help="warm restart time with a persisted tunnel registry")
+    startup.add_argument("--tunnels", type=int, nargs="+", default=[1000, 10000])
+    startup.add_argument("--cold-limit", type=int, default=2000,
+                         help="largest size for the re-create-through-the-API baseline")
+    startup.set_defaults(func=bench_startup)
+
+    deploy = sub.add_parser("deploy", help="replace the server process under load and count failed requests")
+    deploy.add_argument("--concurrency", type=int, default=10, help="workers per fast tunnel")
+    deploy.add_argument("--slow-concurrency", type=int, default=5, help="workers per slow tunnel")
+    deploy.add_argument("--slow", type=float, default=1.0, help="seconds each slow request takes")
+    deploy.add_argument("--size", type=int, default=16384, help="bytes per fast response")
+    deploy.add_argument("--settle", type=float, default=2.0, help="seconds of load before and after the deploy")
+    deploy.add_argument("--drain-timeout", type=float, default=30)
+    deploy.add_argument("--compare", action="store_true", help="also measure a plain stop-then-start restart")
+    deploy.set_defaults(func=bench_deploy)
+
+    diagnostics = sub.add_parser("diagnostics", help="overhead of the stall detector and request timings")
+    diagnostics.add_argument("--requests", type=int, default=2000)
+    diagnostics.add_argument("--concurrency", type=int, default=50)
+    diagnostics.add_argument("--rounds", type=int, default=3)
+    diagnostics.add_argument("--idle", type=float, default=10)
+    diagnostics.add_argument("--block", type=float, default=0.3)
+    diagnostics.set_defaults(func=bench_diagnostics, tunnels=1)
+
+    suite = sub.add_parser("suite", help="fixed set of workloads with JSON results for comparing commits")
+    suite.add_argument("--only", nargs="+", metavar="WORKLOAD", help=f"subset of: {', '.join(SUITE_WORKLOADS)}")
+    suite.add_argument("--requests", type=int, default=2000)
+    suite.add_argument("--concurrency", type=int, default=50)
+    suite.add_argument("--high-concurrency", type=int, default=500)
+    suite.add_argument("--clients", type=int, default=1, help="tunnel client processes sharing the client workloads")
+    suite.add_argument("--tunnels", type=int, default=1000, help="tunnels created for the API and many-tunnel runs")
+    suite.add_argument("--api-concurrency", type=int, default=10)
+    suite.add_argument("--login-concurrency", type=int, default=20)
+    suite.add_argument("--small-size", type=int, default=128, help="small body size in bytes")
+    suite.add_argument("--large-size", type=int, default=1024, help="large body size in KB")
+    suite.add_argument("--output", default="bench_suite.json", help="JSON results file, - for stdout")
+    suite.add_argument("--compare", metavar="OLD_JSON", help="print changes against an earlier results file")
+    suite.set_defaults(func=bench_suite)
+
+    users = sub.add_parser("users", help="user store registration and lookup")
+    users.add_argument("--users", type=int, default=100000)
+    users.add_argument("--legacy-users", type=int, default=2000,
+                       help="registrations for the rewrite-everything baselines")
+    users.add_argument("--batch", type=int, default=100,
+                       help="concurrent registrations in flight")
+    users.set_defaults(func=bench_users)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,32 @@
 import asyncio
 import json
 import logging
+import random
+import time
 import websockets
 import aiohttp
 import os
+import re
+import signal
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+from protocol import (
+    HOP_BY_HOP_HEADERS, MAX_FRAME_SIZE, Multiplexer, StreamReset,
+    decode_request_head, decode_routed_head, encode_response_head
+)
+from session import ResumableLink
+from codec import (
+    CODEC_VERSIONS, FRAME_COMPRESSION, FRAME_COMPRESSION_LEVEL, decode_message, encode_message, is_control
+)
+from ws_bridge import (
+    WEBSOCKET_METHOD, WS_MAX_MESSAGE_SIZE, WS_PROXY_HEARTBEAT,
+    AiohttpEndpoint, StreamEndpoint, bridge, handshake_headers
+)
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 # 加载环境变量
 load_dotenv()
@@ -13,109 +35,510 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 重连退避: 第 n 次重试前等待 [0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2^n)] 内的随机时长
+RECONNECT_BASE_DELAY = float(os.getenv("RECONNECT_BASE_DELAY", 0.5))
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY", 30))
+# 应用层心跳, 超过 HEARTBEAT_TIMEOUT 没有收到任何消息时认为连接已断开并重连
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 10))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", 30))
+# 同时转发给本地服务的 HTTP 请求数, 超出的请求等待; WebSocket 和 TCP 连接不计入
+CLIENT_MAX_CONCURRENT = int(os.getenv("CLIENT_MAX_CONCURRENT", 100))
+LOCAL_KEEPALIVE_TIMEOUT = float(os.getenv("LOCAL_KEEPALIVE_TIMEOUT", 30))
+# 隧道配置文件 (YAML 或 JSON), 不设置时只有一个由 LOCAL_PORT/PUBLIC_PORT 等环境变量描述的隧道
+CLIENT_CONFIG = os.getenv("CLIENT_CONFIG")
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", 2))  # 检查配置文件修改的间隔, 为 0 时不重新载入
+# 收到 SIGTERM/SIGINT 后先删除隧道, 最多等这么久让进行中的请求完成再断开
+CLIENT_DRAIN_TIMEOUT = float(os.getenv("CLIENT_DRAIN_TIMEOUT", 30))
+
+TUNNEL_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def backoff_delay(attempt: int) -> float:
+    """带完全抖动的指数退避, 避免大量客户端在服务端重启后同时重连"""
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(attempt, 32)))
+
+def tunnel_spec(name, data) -> dict:
+    """校验配置中的一个隧道, 返回补全默认值的隧道描述; 不合法时抛出 ValueError"""
+    if not TUNNEL_NAME_PATTERN.fullmatch(str(name)):
+        raise ValueError(f"Invalid tunnel id: {name}")
+    if not isinstance(data, dict):
+        raise ValueError(f"Tunnel {name} must be a mapping")
+    spec = {
+        "local_port": data.get("local_port"),
+        "public_port": data.get("public_port"),
+        "custom_domain": data.get("custom_domain") or None,
+        "cache": data.get("cache", False),
+        "compress": data.get("compress", False),
+        "group": data.get("group") or None  # 同一隧道组的多个客户端分担同一个公网端口的请求
+    }
+    for field in ("local_port", "public_port"):
+        value = spec[field]
+        if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= 65535:
+            raise ValueError(f"Tunnel {name}: {field} must be a port number")
+    if not isinstance(spec["cache"], bool) or not isinstance(spec["compress"], bool):
+        raise ValueError(f"Tunnel {name}: cache and compress must be booleans")
+    if spec["group"] is not None and not TUNNEL_NAME_PATTERN.fullmatch(str(spec["group"])):
+        raise ValueError(f"Tunnel {name}: invalid group {spec['group']}")
+    return spec
+
+def load_config(path: str) -> dict:
+    """读取隧道配置文件, 返回 {"server_url": ..., "tunnels": {隧道ID: 隧道描述}}
+
+    文件格式 (YAML 需要安装 pyyaml, 否则只能用 JSON):
+        server_url: ws://tunnel.example.com
+        tunnels:
+          web: {local_port: 3000, public_port: 8001, custom_domain: app.example.com, compress: true}
+          api: {local_port: 8000, public_port: 8002, group: api}
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        if yaml is None:
+            raise ValueError("YAML config requires pyyaml (pip install pyyaml)")
+        data = yaml.safe_load(text) or {}
+    else:
+        data = json.loads(text)
+    tunnels = data.get("tunnels") or {}
+    if not isinstance(tunnels, dict):
+        raise ValueError("tunnels must be a mapping from tunnel id to tunnel")
+    return {
+        "server_url": data.get("server_url"),
+        "tunnels": {str(name): tunnel_spec(name, tunnel) for name, tunnel in tunnels.items()}
+    }
+
 class TunnelClient:
-    def __init__(self, server_url, local_port, public_port, custom_domain=None):
+    """一条 WebSocket 承载 tunnels 中的所有隧道, tunnels 为 {隧道ID: tunnel_spec 返回的描述}"""
+    def __init__(self, server_url, tunnels, config_path=None):
         self.server_url = server_url
-        self.local_port = local_port
-        self.public_port = public_port
-        self.custom_domain = custom_domain
+        self.tunnels = dict(tunnels)
+        self.config_path = config_path
+        self._resync = False  # 断开期间隧道有变化, 续传后需要重新注册
         self.websocket = None
+        self.mux = None
+        self.link = None
+        self.session_token = None  # 服务端发放的会话令牌, 重连时用于续传
         self.client_id = None
         self.running = False
+        self.rtt = None  # 最近一次心跳的往返时间 (秒)
+        self.rtt_avg = None  # RTT 的指数加权平均
+        self.codec = 0  # 当前连接协商的控制消息编码版本, 0 为 JSON
+        self.last_received = 0.0  # 最近一次收到任何消息的时间
+        self._pings = {}  # 心跳 id 到发送时间
+        self._retired = set()  # 服务端排空时留给进行中的流的旧连接
+        self._local_session = None  # 到本地服务的共享连接池
+        self._request_slots = asyncio.Semaphore(CLIENT_MAX_CONCURRENT)
+        
+    def local_session(self) -> aiohttp.ClientSession:
+        """所有请求和 WebSocket 共用的到本地服务的会话, 保持长连接; 并发由 _request_slots 限制"""
+        if self._local_session is None or self._local_session.closed:
+            connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=LOCAL_KEEPALIVE_TIMEOUT)
+            self._local_session = aiohttp.ClientSession(connector=connector, auto_decompress=False)
+        return self._local_session
+        
+    def new_session(self):
+        """开始新会话: 旧会话中未完成的流全部失败"""
+        if self.mux is not None:
+            self.mux.close()
+        if self.link is not None:
+            self.link.close()
+        self.link = ResumableLink()
+        self.mux = Multiplexer(self.link.send, self.handle_stream)
+        
+    def session_url(self) -> str:
+        # 旧服务端忽略 codec 和 compression, 双方继续使用 JSON
+        params = {"codec": ",".join(map(str, CODEC_VERSIONS))}
+        if FRAME_COMPRESSION:
+            params["compression"] = "zlib"
+        if self.session_token is not None:
+            params.update(session=self.session_token, received=self.link.received)
+        return f"{self.server_url}/ws/{self.client_id}?{urlencode(params)}"
         
     async def connect_websocket(self):
-        while True:
+        attempt = 0
+        while self.running:
+            websocket = None
             try:
-                async with websockets.connect(f"{self.server_url}/ws/{self.client_id}") as websocket:
-                    self.websocket = websocket
-                    logger.info("Connected to server")
-                    
-                    # 发送隧道请求
-                    await self.send_tunnel_request()
-                    
-                    # 保持连接并处理消息
-                    while True:
-                        message = await websocket.recv()
-                        await self.handle_message(message)
-                        
-            except websockets.exceptions.ConnectionClosed:
-                logger.warning("Connection closed, attempting to reconnect...")
-                await asyncio.sleep(5)
+                websocket = await websockets.connect(self.session_url())
+                self.websocket = websocket
+                await self.start_session(websocket)
+                attempt = 0
+                if await self.receive_loop(websocket):
+                    # 服务端正在排空: 旧连接留给进行中的流, 立即以新会话连接 (到达新进程)
+                    self.retire(websocket)
+                    websocket = None
+                    continue
+            except websockets.exceptions.ConnectionClosed as e:
+                logger.warning(f"Connection closed: {str(e)}")
             except Exception as e:
                 logger.error(f"Error in websocket connection: {str(e)}")
-                await asyncio.sleep(5)
+            finally:
+                self.websocket = None
+                if websocket is not None:
+                    await websocket.close()
+                if self.link is not None:
+                    self.link.detach()
+            if not self.running:
+                break
+            delay = backoff_delay(attempt)
+            attempt += 1
+            logger.info(f"Reconnecting in {delay:.2f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
+        if self.mux is not None:
+            self.mux.close()
+            self.link.close()
                 
-    async def send_tunnel_request(self):
-        request = {
-            "type": "tunnel_request",
-            "local_port": self.local_port,
-            "public_port": self.public_port,
-            "custom_domain": self.custom_domain
-        }
-        await self.websocket.send(json.dumps(request))
+    async def start_session(self, websocket):
+        """处理服务端的第一条消息: 续传成功时补发对方缺少的帧, 否则开始新会话并注册隧道"""
+        message = json.loads(await asyncio.wait_for(websocket.recv(), timeout=HEARTBEAT_TIMEOUT))
+        if message.get("type") != "session":
+            raise RuntimeError(f"Unexpected first message: {message.get('type')}")
+        resumed = message["resumed"] and self.link is not None
+        if not resumed:
+            if self.session_token is not None:
+                logger.warning("Session could not be resumed, starting a new one")
+            self.new_session()
+        self.session_token = message["token"]
+        self.codec = message.get("codec") or 0
+        self.mux.compress_level = FRAME_COMPRESSION_LEVEL if message.get("compression") == "zlib" else None
+        self.last_received = time.monotonic()
+        await self.link.attach(websocket.send, message["received"] if resumed else 0)
+        if resumed:
+            logger.info("Session resumed")
+        else:
+            logger.info("Connected to server")
+        if not resumed or self._resync:
+            await self.register_tunnels()
+            
+    async def receive_loop(self, websocket):
+        """处理消息直到连接断开, 二进制消息是转发请求的数据帧; 服务端要求改连时返回 True"""
+        heartbeat = asyncio.create_task(self.heartbeat(websocket))
+        try:
+            while True:
+                message = await websocket.recv()
+                self.last_received = time.monotonic()
+                if isinstance(message, bytes) and not is_control(message):
+                    self.link.on_frame()
+                    self.mux.feed(message)
+                    if self.link.ack_due():
+                        await self.send_control({"type": "ack", "received": self.link.received})
+                elif await self.handle_message(message):
+                    return True
+        finally:
+            heartbeat.cancel()
+
+    def retire(self, websocket):
+        """把当前连接和会话交给后台, 之后以新会话重新连接"""
+        task = asyncio.create_task(self.drain_retired(websocket, self.link, self.mux, self.codec))
+        self._retired.add(task)
+        task.add_done_callback(self._retired.discard)
+        self.link = self.mux = self.session_token = None
+
+    async def drain_retired(self, websocket, link, mux, codec):
+        """旧连接上进行中的流照常收发, 直到服务端在它们完成后关闭连接"""
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes) and not is_control(message):
+                    link.on_frame()
+                    mux.feed(message)
+                    if link.ack_due():
+                        await link.send_message(encode_message({"type": "ack", "received": link.received}, codec))
+                    continue
+                try:
+                    data = decode_message(message)
+                except ValueError:
+                    continue
+                if data["type"] in ("ack", "pong"):
+                    link.ack(data.get("received", 0))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            mux.close()
+            link.close()
+            await websocket.close()
+            
+    async def heartbeat(self, websocket):
+        """定时发送 ping 测量 RTT; 太久没有收到任何消息时关闭连接, 由重连逻辑接手"""
+        ping_id = 0
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if time.monotonic() - self.last_received > HEARTBEAT_TIMEOUT:
+                logger.warning(f"No message from server for {HEARTBEAT_TIMEOUT}s, reconnecting")
+                await websocket.close()
+                return
+            ping_id += 1
+            self._pings = {ping_id: time.monotonic()}  # 只等最近一次, 丢失的 pong 不再计算
+            await self.send_control({"type": "ping", "id": ping_id, "received": self.link.acknowledged()})
+            
+    def on_pong(self, data):
+        sent = self._pings.pop(data.get("id"), None)
+        self.link.ack(data.get("received", 0))
+        if sent is None:
+            return
+        self.rtt = time.monotonic() - sent
+        self.rtt_avg = self.rtt if self.rtt_avg is None else 0.8 * self.rtt_avg + 0.2 * self.rtt
+        logger.debug(f"Heartbeat RTT {self.rtt * 1000:.1f}ms (avg {self.rtt_avg * 1000:.1f}ms)")
+                
+    async def send_control(self, message):
+        """按协商的编码发送控制消息, 断开期间丢弃"""
+        await self.link.send_message(encode_message(message, self.codec))
+        
+    async def send_tunnel_request(self, name):
+        await self.send_control({"type": "tunnel_request", "tunnel_id": name, **self.tunnels[name]})
+        
+    async def register_tunnels(self):
+        """注册全部隧道; 服务端先删除不在其中的隧道 (断开期间从配置中移除的)"""
+        self._resync = False
+        await self.send_control({"type": "tunnel_sync", "tunnel_ids": list(self.tunnels)})
+        for name in list(self.tunnels):
+            await self.send_tunnel_request(name)
+        if not self.link.attached:
+            self._resync = True
+            
+    async def update_tunnels(self, tunnels):
+        """换成新的隧道配置: 只注册新增或修改了的隧道, 删除移除了的隧道, 其余隧道不受影响"""
+        removed = [name for name in self.tunnels if name not in tunnels]
+        changed = [name for name, spec in tunnels.items() if self.tunnels.get(name) != spec]
+        if not removed and not changed:
+            return
+        logger.info(f"Tunnel config changed: added or updated {changed}, removed {removed}")
+        self.tunnels = dict(tunnels)
+        if self.link is None or not self.link.attached:
+            # 未连接时记下, 连接后统一注册
+            self._resync = True
+            return
+        for name in removed:
+            await self.send_control({"type": "tunnel_remove", "tunnel_id": name})
+        for name in changed:
+            await self.send_tunnel_request(name)
+        if not self.link.attached:
+            self._resync = True
+            
+    async def watch_config(self):
+        """定时检查配置文件, 修改后重新载入; 文件有误时保留原来的隧道"""
+        last_modified = os.stat(self.config_path).st_mtime_ns
+        while self.running:
+            await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+            try:
+                modified = os.stat(self.config_path).st_mtime_ns
+                if modified == last_modified:
+                    continue
+                last_modified = modified
+                config = load_config(self.config_path)
+            except (OSError, ValueError) as e:
+                logger.error(f"Cannot reload {self.config_path}: {str(e)}")
+                continue
+            await self.update_tunnels(config["tunnels"])
         
     async def handle_message(self, message):
+        """控制消息, JSON 文本或二进制编码 (见 codec.py); 服务端要求改连时返回 True"""
         try:
-            data = json.loads(message)
-            if data["type"] == "tunnel_request":
-                # 处理新的隧道请求
-                await self.handle_tunnel_request(data)
-            elif data["type"] == "tunnel_response":
-                logger.info(f"Tunnel response received: {data['status']}")
-        except json.JSONDecodeError:
-            logger.error(f"Invalid JSON received: {message}")
+            data = decode_message(message)
+        except ValueError:
+            logger.error(f"Invalid control message received: {message[:200]!r}")
+            return
+        if data["type"] == "pong":
+            self.on_pong(data)
+        elif data["type"] == "ack":
+            self.link.ack(data["received"])
+        elif data["type"] == "tunnel_response":
+            name = data.get("tunnel_id")
+            if data["status"] == "success":
+                logger.info(f"Tunnel {name} registered")
+            else:
+                logger.error(f"Tunnel {name} registration failed: {data.get('detail')}")
+        elif data["type"] == "reconnect":
+            # 服务端即将退出 (见服务端的 drain.py), 新连接会到达接替它的进程
+            logger.info("Server is draining, moving to a new connection")
+            return True
             
-    async def handle_tunnel_request(self, data):
+    async def handle_stream(self, stream):
+        """处理服务端经多路复用流转发来的一个请求, 头部前面总是目标隧道的名称 (没有名称时为空字符串)"""
+        head_sent = False
         try:
-            # 创建到本地服务的连接
-            async with aiohttp.ClientSession() as session:
-                async with session.request(
-                    method=data["method"],
-                    url=f"http://localhost:{self.local_port}{data['path']}",
-                    headers=data["headers"],
-                    data=data.get("body")
+            name, head = decode_routed_head(await stream.wait_head())
+            tunnel = self.tunnels.get(name)
+            if tunnel is None:
+                # 隧道刚从配置中移除
+                head_sent = True
+                await stream.send_head(encode_response_head(404, []), end_stream=True)
+                return
+            local_port = tunnel["local_port"]
+            method, path, headers = decode_request_head(head)
+            if method == "CONNECT":
+                head_sent = True
+                await self.handle_connect(stream, local_port)
+                return
+            if method == WEBSOCKET_METHOD:
+                head_sent = True
+                await self.handle_websocket(stream, local_port, path, headers)
+                return
+            has_body = not stream.head_end_stream
+            
+            async with self._request_slots:
+                async with self.local_session().request(
+                    method=method,
+                    url=f"http://localhost:{local_port}{path}",
+                    headers=headers,
+                    data=stream.iter_chunks() if has_body else None,
+                    allow_redirects=False
                 ) as response:
-                    # 将响应发送回服务器
-                    response_data = {
-                        "type": "tunnel_response",
-                        "status": response.status,
-                        "headers": dict(response.headers),
-                        "body": await response.text()
-                    }
-                    await self.websocket.send(json.dumps(response_data))
+                    # 将响应按原始字节发送回服务器
+                    response_headers = [
+                        (k, v) for k, v in response.headers.items()
+                        if k.lower() not in HOP_BY_HOP_HEADERS
+                    ]
+                    await stream.send_head(encode_response_head(response.status, response_headers))
+                    head_sent = True
+                    async for chunk in response.content.iter_chunked(MAX_FRAME_SIZE):
+                        await stream.write(chunk)
+                    await stream.end()
+        except StreamReset as e:
+            logger.info(f"Stream {stream.id} reset: {str(e)}")
         except Exception as e:
             logger.error(f"Error handling tunnel request: {str(e)}")
-            error_response = {
-                "type": "tunnel_response",
-                "status": 500,
-                "error": str(e)
-            }
-            await self.websocket.send(json.dumps(error_response))
+            try:
+                if head_sent:
+                    await stream.reset(str(e))
+                else:
+                    await stream.send_head(encode_response_head(502, []), end_stream=True)
+            except StreamReset:
+                pass
+        finally:
+            # 本地服务没有读完请求体时重置流, 避免服务端一直等待发送窗口
+            if not stream.remote_closed:
+                await stream.reset("request body not consumed")
+            
+    async def handle_connect(self, stream, local_port):
+        """原始 TCP 隧道: 在流和本地端口之间双向转发字节"""
+        try:
+            reader, writer = await asyncio.open_connection("localhost", local_port)
+        except OSError as e:
+            logger.error(f"Cannot connect to local port {local_port}: {str(e)}")
+            await stream.send_head(encode_response_head(502, []), end_stream=True)
+            return
+        await stream.send_head(encode_response_head(200, []))
+        
+        async def upload():
+            async for chunk in stream.iter_chunks():
+                writer.write(chunk)
+                await writer.drain()
+            # 服务端半关闭时同样只关闭写方向
+            if writer.can_write_eof():
+                writer.write_eof()
+        
+        async def download():
+            while True:
+                chunk = await reader.read(MAX_FRAME_SIZE)
+                if not chunk:
+                    break
+                await stream.write(chunk)
+            await stream.end()
+        
+        tasks = [asyncio.create_task(upload()), asyncio.create_task(download())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            # 一个方向出错时另一个方向不会自己结束
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            
+    async def handle_websocket(self, stream, local_port, path, headers):
+        """WebSocket: 与本地服务握手后在流和本地 WebSocket 之间逐条转发消息"""
+        headers, protocols = handshake_headers(headers)
+        endpoint = StreamEndpoint(stream)
+        try:
+            try:
+                ws = await self.local_session().ws_connect(
+                    f"ws://localhost:{local_port}{path}",
+                    headers=headers,
+                    protocols=protocols,
+                    heartbeat=WS_PROXY_HEARTBEAT,
+                    max_msg_size=WS_MAX_MESSAGE_SIZE
+                )
+            except aiohttp.WSServerHandshakeError as e:
+                await stream.send_head(encode_response_head(e.status, []), end_stream=True)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Cannot open WebSocket to local port {local_port}: {str(e)}")
+                await stream.send_head(encode_response_head(502, []), end_stream=True)
+                return
+            
+            response_headers = [("sec-websocket-protocol", ws.protocol)] if ws.protocol else []
+            await stream.send_head(encode_response_head(101, response_headers))
+            local = AiohttpEndpoint(ws)
+            try:
+                await bridge(endpoint, local)
+            finally:
+                await local.release()
+        finally:
+            await endpoint.release()
             
     async def start(self):
         self.running = True
         self.client_id = os.urandom(16).hex()
-        await self.connect_websocket()
+        watcher = None
+        if self.config_path and CONFIG_RELOAD_INTERVAL > 0:
+            watcher = asyncio.create_task(self.watch_config())
+        try:
+            await self.connect_websocket()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            for task in self._retired:
+                task.cancel()
+            if self._local_session is not None:
+                await self._local_session.close()
         
     async def stop(self):
+        """平滑退出: 先让服务端删除全部隧道, 新请求不再转发过来, 等进行中的请求完成
+        (最多 CLIENT_DRAIN_TIMEOUT 秒) 再断开; 再次调用时立即断开"""
+        draining = self.running
         self.running = False
+        if draining and self.link is not None and self.link.attached:
+            logger.info("Removing tunnels and waiting for requests in flight")
+            for name in self.tunnels:
+                await self.send_control({"type": "tunnel_remove", "tunnel_id": name})
+            deadline = time.monotonic() + CLIENT_DRAIN_TIMEOUT
+            while (self.websocket is not None and self.mux is not None and self.mux.streams
+                   and time.monotonic() < deadline):
+                await asyncio.sleep(0.1)
         if self.websocket:
             await self.websocket.close()
 
 async def main():
     # 从环境变量或配置文件获取这些值
     server_url = os.getenv("SERVER_URL", "ws://localhost:8080")
-    local_port = int(os.getenv("LOCAL_PORT", "8000"))
-    public_port = int(os.getenv("PUBLIC_PORT", "8888"))
-    custom_domain = os.getenv("CUSTOM_DOMAIN")
+    if CLIENT_CONFIG:
+        config = load_config(CLIENT_CONFIG)
+        server_url = config["server_url"] or server_url
+        tunnels = config["tunnels"]
+    else:
+        tunnels = {"default": tunnel_spec("default", {
+            "local_port": int(os.getenv("LOCAL_PORT", "8000")),
+            "public_port": int(os.getenv("PUBLIC_PORT", "8888")),
+            "custom_domain": os.getenv("CUSTOM_DOMAIN"),
+            "cache": os.getenv("TUNNEL_CACHE", "false").lower() == "true",
+            "compress": os.getenv("TUNNEL_COMPRESS", "false").lower() == "true",
+            "group": os.getenv("TUNNEL_GROUP")
+        })}
     
-    client = TunnelClient(server_url, local_port, public_port, custom_domain)
-    
-    try:
-        await client.start()
-    except KeyboardInterrupt:
-        logger.info("Shutting down client...")
-        await client.stop()
+    client = TunnelClient(server_url, tunnels, CLIENT_CONFIG)
+    stopping = []
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: stopping.append(asyncio.create_task(client.stop())))
+        except NotImplementedError:
+            # Windows 不支持, Ctrl+C 直接中断
+            pass
+    await client.start()
 
 if __name__ == "__main__":
     asyncio.run(main())
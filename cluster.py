@@ -0,0 +1,117 @@
+"""
+worker 之间的内部连接
+
+多个 worker 共享隧道注册表时, 请求可能落在没有持有目标客户端 WebSocket 的 worker 上.
+每个 worker 监听一个内部端口, 并把自己的地址作为所持客户端的 owner 写入注册表;
+其他 worker 按需连到 owner, 在这条 TCP 连接上运行与客户端相同的多路复用协议,
+每帧前加 4 字节长度. 两个 worker 之间只保持一条连接, 所有转发的请求复用它.
+
+环境变量:
+    CLUSTER_HOST  内部监听及对外公布的地址, 多台机器时设为本机内网地址
+    CLUSTER_PORT  内部监听端口, 默认 0 即每个 worker 随机选择
+"""
+import asyncio
+import logging
+import os
+import struct
+from typing import Awaitable, Callable, Dict
+
+from protocol import Multiplexer, Stream
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_HOST = os.getenv("CLUSTER_HOST", "127.0.0.1")
+CLUSTER_PORT = int(os.getenv("CLUSTER_PORT", 0))
+CLUSTER_CONNECT_TIMEOUT = float(os.getenv("CLUSTER_CONNECT_TIMEOUT", 3))
+
+_LENGTH = struct.Struct("!I")
+
+
+def _frame_sender(writer: asyncio.StreamWriter):
+    async def send(frame):
+        writer.writelines((_LENGTH.pack(len(frame)), frame))
+        await writer.drain()
+    return send
+
+
+async def _read_frames(reader: asyncio.StreamReader, mux: Multiplexer):
+    try:
+        while True:
+            size, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+            mux.feed(await reader.readexactly(size))
+    except (asyncio.IncompleteReadError, OSError):
+        pass
+    finally:
+        mux.close()
+
+
+class PeerLinks:
+    """到其他 worker 的内部连接
+
+    on_stream: 其他 worker 转来一个流时调用的协程函数
+    """
+    def __init__(self, on_stream: Callable[[Stream], Awaitable[None]]):
+        self.address: str | None = None
+        self._on_stream = on_stream
+        self._server: asyncio.AbstractServer | None = None
+        self._peers: Dict[str, Multiplexer] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._writers = set()
+        self._tasks = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._accept, CLUSTER_HOST, CLUSTER_PORT)
+        port = self._server.sockets[0].getsockname()[1]
+        self.address = f"{CLUSTER_HOST}:{port}"
+        logger.info("Cluster link listening on %s", self.address)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # 对端主动建立的连接只接收流, 发起方用奇数编号, 这里用偶数避免冲突
+        mux = Multiplexer(_frame_sender(writer), self._on_stream, first_stream_id=2)
+        self._writers.add(writer)
+        try:
+            await _read_frames(reader, mux)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def connect(self, address: str) -> Multiplexer:
+        """返回到 address 的连接, 没有时建立; 失败抛出 OSError 或 TimeoutError"""
+        mux = self._peers.get(address)
+        if mux is not None and not mux.closed:
+            return mux
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        async with lock:
+            mux = self._peers.get(address)
+            if mux is not None and not mux.closed:
+                return mux
+            host, port = address.rsplit(":", 1)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port)), CLUSTER_CONNECT_TIMEOUT
+            )
+            mux = Multiplexer(_frame_sender(writer))
+            self._peers[address] = mux
+            self._writers.add(writer)
+            task = asyncio.create_task(self._run_peer(address, reader, writer, mux))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            logger.info("Connected to worker %s", address)
+            return mux
+
+    async def _run_peer(self, address, reader, writer, mux):
+        try:
+            await _read_frames(reader, mux)
+        finally:
+            if self._peers.get(address) is mux:
+                del self._peers[address]
+            self._writers.discard(writer)
+            writer.close()
+            logger.info("Connection to worker %s closed", address)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for task in self._tasks:
+            task.cancel()
+        for writer in self._writers:
+            writer.close()
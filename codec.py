@@ -0,0 +1,216 @@
+"""
+控制消息的二进制编码
+
+隧道连接上的控制消息 (ack, ping, tunnel_request 等) 最初是 JSON 文本消息. 客户端连接时在
+查询参数 codec 中列出支持的编码版本, 服务端在第一条 session 消息 (始终为 JSON) 中回复选定的版本:
+0 或没有该字段表示双方继续使用 JSON, 这样新旧客户端和服务端可以任意搭配.
+
+版本 1 中控制消息是一个 CONTROL 帧 (protocol.py 的帧头, 流ID 为 0), 不计入续传的帧数:
+
+    +---------+-----------------------------------
+    | type: 1 | key: 1 | value | key: 1 | value ...
+    +---------+-----------------------------------
+
+type 是消息类型在 MESSAGE_TYPES 中的序号加一, 为 0 时类型名作为普通字段 "type" 出现;
+key 是字段名在 FIELDS 中的序号, 表外的字段名以 0xff + 长度 (1 字节) + 名称表示.
+值以 1 字节标记开头:
+
+    NONE / TRUE / FALSE
+    INT     zigzag 变长整数
+    FLOAT   8 字节双精度
+    STR     变长长度 + UTF-8
+    BYTES   变长长度 + 原始字节
+    LIST    变长数量 + 值 ...
+    MAP     变长数量 + (STR 键, 值) ...
+
+两个表只能在末尾追加, 改变已有的序号需要新的版本号.
+
+同一次协商还决定 DATA 帧是否压缩: 双方都设置 FRAME_COMPRESSION=true 时, 发送方把可以压缩的
+数据帧以 zlib 压缩并设置 FLAG_COMPRESSED (见 protocol.py), 接收方按标志解压.
+"""
+import json
+import os
+import struct
+
+from protocol import FRAME_CONTROL, encode_frame
+
+FRAME_COMPRESSION = os.getenv("FRAME_COMPRESSION", "false").lower() == "true"
+FRAME_COMPRESSION_LEVEL = int(os.getenv("FRAME_COMPRESSION_LEVEL", 1))
+
+# 本端支持的编码版本, 0 为 JSON
+CODEC_VERSIONS = (0, 1)
+
+MESSAGE_TYPES = (
+    "session", "ack", "ping", "pong", "tunnel_request", "tunnel_response", "tunnel_remove", "tunnel_sync"
+)
+FIELDS = (
+    "token", "resumed", "received", "grace", "id", "tunnel_id", "local_port", "public_port", "custom_domain",
+    "cache", "compress", "group", "status", "detail", "tunnel_ids", "codec", "compression", "type"
+)
+
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _BYTES, _LIST, _MAP = range(9)
+_OTHER_FIELD = 0xFF
+
+_TYPE_CODES = {name: index + 1 for index, name in enumerate(MESSAGE_TYPES)}
+_FIELD_CODES = {name: index for index, name in enumerate(FIELDS)}
+_DOUBLE = struct.Struct("!d")
+_CONTROL_HEADER = encode_frame(FRAME_CONTROL, 0)
+
+
+def negotiate(offer: str | None) -> int:
+    """服务端从客户端的 codec 参数 (逗号分隔的版本号) 中选出双方都支持的最高版本"""
+    if not offer:
+        return 0
+    offered = set()
+    for part in offer.split(","):
+        if part.strip().isdigit():
+            offered.add(int(part))
+    return max(offered.intersection(CODEC_VERSIONS), default=0)
+
+
+def is_control(data) -> bool:
+    """二进制消息是否是 CONTROL 帧 (不是多路复用的数据帧)"""
+    return len(data) > 0 and data[0] == FRAME_CONTROL
+
+
+def encode_message(message: dict, version: int):
+    """按版本编码一条控制消息, 版本 0 返回 JSON 文本, 否则返回 CONTROL 帧"""
+    if version == 0:
+        return json.dumps(message)
+    out = bytearray(_CONTROL_HEADER)
+    type_code = _TYPE_CODES.get(message.get("type"), 0)
+    out.append(type_code)
+    for key, value in message.items():
+        if key == "type" and type_code:
+            continue
+        code = _FIELD_CODES.get(key)
+        if code is None:
+            raw = key.encode("utf-8")
+            out.append(_OTHER_FIELD)
+            out.append(len(raw))
+            out += raw
+        else:
+            out.append(code)
+        _encode_value(out, value)
+    return bytes(out)
+
+
+def decode_message(data) -> dict:
+    """解码 CONTROL 帧或 JSON 文本; 格式不对时抛出 ValueError"""
+    if isinstance(data, str):
+        return json.loads(data)
+    view = memoryview(data)
+    offset = len(_CONTROL_HEADER)
+    try:
+        type_code = view[offset]
+        offset += 1
+        message = {}
+        if type_code:
+            message["type"] = MESSAGE_TYPES[type_code - 1]
+        while offset < len(view):
+            code = view[offset]
+            offset += 1
+            if code == _OTHER_FIELD:
+                size = view[offset]
+                key = str(view[offset + 1:offset + 1 + size], "utf-8")
+                offset += 1 + size
+            else:
+                key = FIELDS[code]
+            message[key], offset = _decode_value(view, offset)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed control frame: {e}") from None
+    return message
+
+
+def _encode_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(view, offset: int):
+    value = shift = 0
+    while True:
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode_value(out: bytearray, value):
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        _encode_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode("utf-8")
+        out.append(_STR)
+        _encode_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(_BYTES)
+        _encode_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _encode_varint(out, len(value))
+        for item in value:
+            _encode_value(out, item)
+    elif isinstance(value, dict):
+        out.append(_MAP)
+        _encode_varint(out, len(value))
+        for key, item in value.items():
+            _encode_value(out, str(key))
+            _encode_value(out, item)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} in a control message")
+
+
+def _decode_value(view, offset: int):
+    tag = view[offset]
+    offset += 1
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _INT:
+        raw, offset = _decode_varint(view, offset)
+        return (raw >> 1) ^ -(raw & 1), offset
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(view, offset)[0], offset + _DOUBLE.size
+    if tag in (_STR, _BYTES):
+        size, offset = _decode_varint(view, offset)
+        end = offset + size
+        if end > len(view):
+            raise IndexError("value runs past the end of the frame")
+        if tag == _STR:
+            return str(view[offset:end], "utf-8"), end
+        return bytes(view[offset:end]), end
+    if tag == _LIST:
+        count, offset = _decode_varint(view, offset)
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(view, offset)
+            items.append(item)
+        return items, offset
+    if tag == _MAP:
+        count, offset = _decode_varint(view, offset)
+        items = {}
+        for _ in range(count):
+            key, offset = _decode_value(view, offset)
+            items[key], offset = _decode_value(view, offset)
+        return items, offset
+    raise ValueError(f"Unknown value tag {tag}")
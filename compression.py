@@ -0,0 +1,135 @@
+"""
+响应压缩
+
+上游返回未压缩的文本类响应时, 按浏览器的 Accept-Encoding 选择 br 或 gzip, 边转发边压缩.
+brotli 是可选依赖 (pip install brotli), 未安装时只提供 gzip.
+头部都是 starlette raw_headers 形式的 [(小写名称 bytes, 值 bytes)].
+"""
+import os
+import zlib
+from typing import AsyncIterator, List, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 4))
+
+# 值得压缩的内容类型, 图片视频等已压缩的格式不在其中; text/event-stream 需要逐条送达, 不压缩
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/javascript", "application/xml",
+    "application/wasm", "image/svg+xml"
+)
+COMPRESSIBLE_SUFFIXES = ("+json", "+xml")
+
+RawHeaders = List[Tuple[bytes, bytes]]
+
+
+def header_value(headers: RawHeaders, name: bytes) -> str | None:
+    for key, value in headers:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    """按 Accept-Encoding 选择 br 或 gzip, 都不接受时返回 None"""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name] = quality
+    wildcard = accepted.get("*", 0.0)
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(status: int, headers: RawHeaders) -> bool:
+    """未编码的完整文本类响应才压缩"""
+    if status != 200:
+        return False
+    content_type = (header_value(headers, b"content-type") or "").split(";")[0].strip().lower()
+    if not (content_type.startswith(COMPRESSIBLE_TYPES) or content_type.endswith(COMPRESSIBLE_SUFFIXES)):
+        return False
+    if header_value(headers, b"content-encoding") not in (None, "identity"):
+        return False
+    if "no-transform" in (header_value(headers, b"cache-control") or "").lower():
+        return False
+    length = header_value(headers, b"content-length")
+    return length is None or not length.isdigit() or int(length) >= COMPRESS_MIN_SIZE
+
+
+def add_vary(headers: RawHeaders) -> RawHeaders:
+    """响应随 Accept-Encoding 变化, 让下游缓存分开保存"""
+    vary = header_value(headers, b"vary")
+    if vary is None:
+        return headers + [(b"vary", b"Accept-Encoding")]
+    if "accept-encoding" in vary.lower() or vary.strip() == "*":
+        return headers
+    return [
+        (k, v + b", Accept-Encoding" if k == b"vary" else v) for k, v in headers
+    ]
+
+
+def encoded_headers(headers: RawHeaders, encoding: str, length: int | None = None) -> RawHeaders:
+    """压缩后的头部: 换掉长度, 加上编码, 强 ETag 改为弱 ETag (内容已不是逐字节相同)"""
+    result = []
+    for key, value in headers:
+        if key == b"content-length" or key == b"content-encoding":
+            continue
+        if key == b"etag" and not value.startswith(b"W/"):
+            value = b"W/" + value
+        result.append((key, value))
+    result.append((b"content-encoding", encoding.encode()))
+    if length is not None:
+        result.append((b"content-length", str(length).encode()))
+    return add_vary(result)
+
+
+class Compressor:
+    """流式压缩器, 每块数据压缩后立即交出已产生的输出"""
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            self._br = None
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self._br is not None:
+            return self._br.process(data)
+        return self._zlib.compress(data)
+
+    def finish(self) -> bytes:
+        if self._br is not None:
+            return self._br.finish()
+        return self._zlib.flush()
+
+
+def compress_bytes(encoding: str, data: bytes) -> bytes:
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+async def compress_stream(chunks: AsyncIterator[bytes], encoding: str):
+    compressor = Compressor(encoding)
+    async for chunk in chunks:
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.finish()
@@ -0,0 +1,61 @@
+"""
+测试的公共夹具: 在子进程中以 python server.py 启动服务端, 用户存储, 隧道注册表和日志都放在临时目录
+"""
+import os
+import signal
+
+import pytest
+
+from bench import free_port, start_server_script, wait_for_log
+
+
+class ServerProcess:
+    def __init__(self, tmp_path, env=None, port=None):
+        self.port = port or free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.log_path = str(tmp_path / "server.log")
+        self.env = {
+            "SERVER_HOST": "127.0.0.1", "SERVER_PORT": str(self.port), "SERVER_RELOAD": "false",
+            "USER_STORE_PATH": str(tmp_path / "users.db"),
+            "TUNNEL_REGISTRY": "sqlite", "TUNNEL_REGISTRY_PATH": str(tmp_path / "tunnels.db"),
+            **(env or {}),
+        }
+        self.proc = None
+
+    def launch(self, handoff=False):
+        self.proc = start_server_script({**self.env, "SERVER_HANDOFF": str(handoff).lower()}, self.log_path)
+
+    async def start(self, handoff=False):
+        """启动并等到开始接受连接"""
+        offset = self.log_offset()
+        self.launch(handoff)
+        await wait_for_log(self.log_path, "Listening on", offset)
+        return self
+
+    def log_offset(self):
+        return os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+
+    def read_log(self, offset=0):
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            return f.read().decode("utf-8", "replace")
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGKILL)
+            self.proc.wait()
+
+
+@pytest.fixture
+def servers(tmp_path):
+    """创建 ServerProcess 的工厂, 同一个测试中创建的服务端共用临时目录 (即共用注册表和用户存储)"""
+    created = []
+
+    def create(env=None, port=None):
+        server = ServerProcess(tmp_path, env, port)
+        created.append(server)
+        return server
+
+    yield create
+    for server in created:
+        server.stop()
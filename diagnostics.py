@@ -0,0 +1,329 @@
+"""
+诊断: 事件循环卡顿检测, 请求耗时分解和采样分析器
+
+卡顿检测: 事件循环上每 STALL_THRESHOLD 秒一次的定时器更新心跳, 后台看门狗线程发现心跳超时
+STALL_THRESHOLD 秒以上时抓取事件循环线程当前的调用栈, 即正在阻塞循环的代码. 循环恢复后
+记录这次卡顿 (开始时间, 时长, 调用栈) 并写一条警告日志; 时长是心跳迟到的时间,
+比实际阻塞的时间最多短 STALL_THRESHOLD 秒. 阻塞调用持有 GIL 时 (纯 Python
+的计算, 不释放 GIL 的 C 扩展) 看门狗要等它让出 GIL 才能运行, 抓到的仍是卡顿中的调用栈;
+看门狗没来得及运行时只记录时长.
+
+请求耗时: TimingGate 中间件为每个 HTTP 请求记录以下阶段, 最近 TIMING_HISTORY 个请求保存在
+环形缓冲区中, 按路由和隧道汇总:
+
+    queue      进入应用到开始转发 (中间件, 路由, 准入, 查找隧道和选择成员)
+    connect    开始转发到请求头发给上游 (等待连接池名额, 建立连接或打开多路复用流)
+    ttfb       到响应头开始发送; 不转发的请求从进入应用算起, 没连上上游时从开始转发算起
+    transfer   响应头到响应体发送完
+
+转发的两个时间点由代理代码调用 mark_forward/mark_connected 记录, 经 contextvars 找到
+当前请求, 不需要把计时对象传来传去. 路由名由全局依赖 record_route 在匹配路由之后记录;
+HostRouter 等中间件会复制 scope, TimingGate 自己的 scope 里看不到路由. WebSocket 不记录.
+
+采样分析器: Profiler 在后台线程中每隔 interval 秒读取一次事件循环线程的调用栈
+(sys._current_frames), 统计各调用栈出现的次数, 只在被请求的那几秒内运行.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Callable, Dict, List
+
+from starlette.requests import HTTPConnection
+
+logger = logging.getLogger(__name__)
+
+STALL_THRESHOLD = float(os.getenv("STALL_THRESHOLD", 0.1))  # 为 0 时不检测
+STALL_HISTORY = int(os.getenv("STALL_HISTORY", 100))
+TIMING_HISTORY = int(os.getenv("TIMING_HISTORY", 2048))  # 为 0 时不记录
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+
+# 卡顿的调用栈最多保留的层数 (最内层)
+_STACK_DEPTH = 30
+
+PHASES = ("queue", "connect", "ttfb", "transfer", "total")
+
+
+class StallDetector:
+    """看门狗线程发现事件循环超过 threshold 秒没有心跳时抓取循环线程的调用栈"""
+    def __init__(self, threshold: float = STALL_THRESHOLD, history: int = STALL_HISTORY):
+        self.threshold = threshold
+        self.stalls = deque(maxlen=history)
+        self.count = 0
+        self.on_stall: Callable[[float], None] | None = None
+        self._due = 0.0  # 下一次心跳应该到达的时间 (monotonic)
+        self._captured = None  # 看门狗抓到的 (_due, 调用栈)
+        self._handle: asyncio.TimerHandle | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """在事件循环中调用"""
+        if self.threshold <= 0 or self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._due = time.monotonic() + self.threshold
+        self._handle = self._loop.call_later(self.threshold, self._beat)
+        self._thread = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = now - self._due
+        if lag >= self.threshold:
+            captured = self._captured
+            stack = captured[1] if captured is not None and captured[0] == self._due else None
+            self._record(lag, stack)
+        self._captured = None
+        self._due = now + self.threshold
+        self._handle = self._loop.call_later(self.threshold, self._beat)
+
+    def _record(self, lag: float, stack: List[str] | None):
+        self.count += 1
+        self.stalls.append({
+            "time": time.time() - lag,
+            "duration": round(lag, 4),
+            "stack": stack
+        })
+        where = stack[-1].strip().replace("\n", " | ") if stack else "stack not captured"
+        logger.warning("Event loop stalled for %.0fms: %s", lag * 1000, where)
+        if self.on_stall is not None:
+            self.on_stall(lag)
+
+    def _watch(self):
+        # 睡到当前心跳超时的时刻; 心跳按时到达时 _due 已经后移, 接着睡
+        while True:
+            due = self._due
+            wait = due + self.threshold - time.monotonic()
+            if wait <= 0 and self._captured is None:
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self._captured = (due, traceback.format_stack(frame, _STACK_DEPTH))
+                del frame
+            if self._stop.wait(wait if wait > 0 else self.threshold):
+                return
+
+    def recent(self, limit: int) -> List[dict]:
+        """最近的卡顿, 新的在前"""
+        return list(reversed(self.stalls))[:limit]
+
+
+class Timing:
+    """一个 HTTP 请求各阶段的时间点 (perf_counter), 未经过的阶段为 None"""
+    __slots__ = ("start", "forward", "connected", "head", "status", "tunnel", "route")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.forward = None
+        self.connected = None
+        self.head = None
+        self.status = None
+        self.tunnel = None  # 公网端口, 代理请求找到隧道后设置
+        self.route = "-"  # 处理函数名, 没有匹配的路由时为 "-"
+
+
+_current: ContextVar[Timing | None] = ContextVar("request_timing", default=None)
+
+
+def mark_forward():
+    timing = _current.get()
+    if timing is not None:
+        timing.forward = time.perf_counter()
+
+
+def mark_connected():
+    timing = _current.get()
+    if timing is not None:
+        timing.connected = time.perf_counter()
+
+
+def tag_tunnel(public_port: int):
+    """当前请求按隧道汇总"""
+    timing = _current.get()
+    if timing is not None:
+        timing.tunnel = public_port
+
+
+def record_route(connection: HTTPConnection):
+    """FastAPI 的全局依赖, 记录当前请求路由到的处理函数名"""
+    timing = _current.get()
+    endpoint = connection.scope.get("endpoint")
+    if timing is not None and endpoint is not None:
+        timing.route = getattr(endpoint, "__name__", type(endpoint).__name__)
+
+
+class Timings:
+    """最近 history 个请求的耗时, 每项为 (结束时间, 路由, 隧道, 状态码, queue, connect, ttfb, transfer, total)"""
+    def __init__(self, history: int = TIMING_HISTORY):
+        self.enabled = history > 0
+        self.records = deque(maxlen=max(history, 1))
+
+    def record(self, timing: Timing, end: float):
+        start, forward, connected, head = timing.start, timing.forward, timing.connected, timing.head
+        self.records.append((
+            time.time(),
+            timing.route,
+            timing.tunnel,
+            timing.status,
+            forward - start if forward is not None else None,
+            connected - forward if connected is not None and forward is not None else None,
+            head - (connected or forward or start) if head is not None else None,
+            end - head if head is not None else None,
+            end - start
+        ))
+
+    def recent(self, limit: int, tunnel: int | None = None) -> List[dict]:
+        """最近的请求, 新的在前; 时长单位为毫秒"""
+        result = []
+        if limit <= 0:
+            return result
+        for record in reversed(self.records):
+            if tunnel is not None and record[2] != tunnel:
+                continue
+            result.append(_record_view(record))
+            if len(result) >= limit:
+                break
+        return result
+
+    def summary(self, tunnel: int | None = None) -> Dict[str, Dict[str, dict]]:
+        """按路由和隧道汇总各阶段的 p50/p99/max (毫秒)"""
+        routes: Dict[str, list] = {}
+        tunnels: Dict[str, list] = {}
+        for record in list(self.records):
+            if tunnel is not None and record[2] != tunnel:
+                continue
+            routes.setdefault(record[1], []).append(record)
+            if record[2] is not None:
+                tunnels.setdefault(str(record[2]), []).append(record)
+        return {
+            "routes": {name: _summarize(records) for name, records in routes.items()},
+            "tunnels": {port: _summarize(records) for port, records in tunnels.items()}
+        }
+
+
+def _ms(value: float | None):
+    return None if value is None else round(value * 1000, 3)
+
+
+def _record_view(record) -> dict:
+    view = {"time": record[0], "route": record[1], "tunnel": record[2], "status": record[3]}
+    for phase, value in zip(PHASES, record[4:]):
+        view[phase] = _ms(value)
+    return view
+
+
+def _summarize(records) -> dict:
+    summary = {"count": len(records)}
+    for index, phase in enumerate(PHASES, 4):
+        values = sorted(record[index] for record in records if record[index] is not None)
+        if not values:
+            continue
+        summary[phase] = {
+            "p50": _ms(values[(len(values) - 1) // 2]),
+            "p99": _ms(values[min(len(values) - 1, int(len(values) * 0.99))]),
+            "max": _ms(values[-1])
+        }
+    return summary
+
+
+class TimingGate:
+    """ASGI 中间件, 为每个 HTTP 请求记录 Timing, 响应发送完 (或处理结束) 后写入 timings"""
+    def __init__(self, app, timings: Timings):
+        self.app = app
+        self.timings = timings
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.timings.enabled:
+            return await self.app(scope, receive, send)
+        timing = Timing(time.perf_counter())
+        token = _current.set(timing)
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                timing.head = time.perf_counter()
+                timing.status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _current.reset(token)
+            self.timings.record(timing, time.perf_counter())
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    """调用栈的折叠表示, 从外到内以分号连接, 可直接交给 flamegraph.pl 或 speedscope"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """按需运行的采样分析器, 同一时间只运行一次"""
+    def __init__(self):
+        self.running = False
+
+    async def profile(self, seconds: float, interval: float) -> Counter:
+        """在事件循环中调用, 采样 seconds 秒, 返回 折叠的调用栈 -> 次数"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        try:
+            return await asyncio.to_thread(self._sample, threading.get_ident(), seconds, interval)
+        finally:
+            self.running = False
+
+    @staticmethod
+    def _sample(thread_id: int, seconds: float, interval: float) -> Counter:
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[_collapse(frame)] += 1
+            del frame
+            time.sleep(interval)
+        return stacks
+
+
+def top_stacks(stacks: Counter, limit: int) -> List[dict]:
+    total = sum(stacks.values()) or 1
+    return [
+        {"count": count, "percent": round(count * 100 / total, 1), "stack": stack.split(";")}
+        for stack, count in stacks.most_common(limit)
+    ]
+
+
+def top_functions(stacks: Counter, limit: int) -> List[dict]:
+    """按最内层函数 (自身耗时) 汇总"""
+    functions = Counter()
+    for stack, count in stacks.items():
+        functions[stack.rsplit(";", 1)[-1]] += count
+    total = sum(functions.values()) or 1
+    return [
+        {"function": name, "count": count, "percent": round(count * 100 / total, 1)}
+        for name, count in functions.most_common(limit)
+    ]
@@ -0,0 +1,234 @@
+"""
+排空与平滑重启
+
+隧道被删除 (API 删除, 客户端移除或同步时去掉) 后立即不再接收新请求, 进行中的请求
+(HTTP 响应体, WebSocket, TCP 连接) 最多再继续 DRAIN_TIMEOUT 秒, 之后才释放它的上游连接池,
+缓存和指标; 到时仍未结束的请求被取消. 进行中的请求按隧道ID记录处理它的任务, 任务结束即完成.
+
+进程的平滑重启由 serve() 负责 (python server.py, SERVER_RELOAD=false). 两个进程要同时监听同一个端口,
+双方的 socket 都要设置 SO_REUSEPORT, 而设置了的端口同一用户的任何进程都能加入并分走连接,
+所以平时不设置, 只在明确的交接中打开:
+
+    1. 向旧进程发送 SIGUSR1: 它给主端口和 TCP 隧道端口的监听 socket 设置 SO_REUSEPORT
+       (应用的 prepare_handoff)
+    2. 以 SERVER_HANDOFF=true 启动新进程, 它以 SO_REUSEPORT 监听, 加入旧进程的端口
+    3. 新进程开始监听 (启动完成) 后向旧进程发送 SIGTERM
+
+旧进程收到 SIGTERM 后依次:
+
+    1. 把同一端口上的新连接全部交给新进程 (SO_ATTACH_REUSEPORT_CBPF, 只支持 Linux),
+       稍后关闭监听 socket
+    2. 调用应用的 begin_drain(deadline): 交出 TCP 隧道端口, 通知隧道客户端改连
+    3. 之后的 HTTP 响应带 Connection: close, 长连接在当前请求完成后由服务端关闭;
+       等所有 HTTP 请求和进行中的请求结束
+    4. 调用应用的 finish_drain(deadline): 隧道客户端旧连接上的流结束后关闭这些连接
+    5. 按 uvicorn 原来的流程退出, 仍然空闲的连接此时关闭
+
+各步共用 DRAIN_TIMEOUT 秒的期限, 到时直接进入第 5 步. 再次收到 SIGTERM 或收到 SIGINT 时立即退出.
+"""
+import asyncio
+import ctypes
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from functools import partial
+from typing import Awaitable, Callable, Dict, Set
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 30))
+
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, "SO_ATTACH_REUSEPORT_CBPF", 51)
+
+# 把新连接交给新进程后, 等已经在旧 socket 队列中的连接被接受
+_ACCEPT_GRACE = 0.2
+_POLL_INTERVAL = 0.1
+# 连续这么久没有进行中的请求才认为排空完成, 刚建立还没发出请求的连接在此期间到达
+_SETTLE_TIME = 0.5
+
+
+class InFlight:
+    """按隧道ID记录进行中的请求 (处理它的任务)"""
+    def __init__(self):
+        self.draining = False  # 进程正在排空
+        self._tasks: Dict[str, Set[asyncio.Task]] = {}
+
+    def track(self, key: str):
+        """当前任务计为 key 的一个进行中请求, 任务结束时自动移除"""
+        task = asyncio.current_task()
+        tasks = self._tasks.get(key)
+        if tasks is None:
+            tasks = self._tasks[key] = set()
+        if task not in tasks:
+            tasks.add(task)
+            task.add_done_callback(partial(self._forget, key))
+
+    def _forget(self, key: str, task: asyncio.Task):
+        tasks = self._tasks.get(key)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._tasks[key]
+
+    def count(self, key: str | None = None) -> int:
+        if key is not None:
+            return len(self._tasks.get(key, ()))
+        return sum(map(len, self._tasks.values()))
+
+    async def wait(self, key: str, timeout: float = DRAIN_TIMEOUT) -> int:
+        """等待 key 当前进行中的请求结束 (之后开始的不算), 超时后取消剩下的, 返回取消的个数"""
+        pending = set(self._tasks.get(key, ()))
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(_POLL_INTERVAL)
+            pending = {task for task in pending if not task.done()}
+        for task in pending:
+            task.cancel()
+        return len(pending)
+
+
+class DrainGate:
+    """ASGI 中间件, 排空期间给 HTTP 响应加上 Connection: close"""
+    def __init__(self, app, in_flight: InFlight):
+        self.app = app
+        self.in_flight = in_flight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.in_flight.draining:
+            return await self.app(scope, receive, send)
+
+        async def send_closing(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", ()), (b"connection", b"close")]}
+            await send(message)
+
+        await self.app(scope, receive, send_closing)
+
+
+def listen_socket(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    """绑定 socket, 由 uvicorn 在启动完成后开始监听; reuse_port 时加入仍在监听该端口的旧进程"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def allow_reuse_port(sock: socket.socket):
+    """给已在监听的 socket 设置 SO_REUSEPORT, 之后设置了它的新 socket 可以监听同一端口"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+def steer_away(sock: socket.socket) -> bool:
+    """让 SO_REUSEPORT 组把新连接都交给第二个 socket, 即旧进程之后加入的新进程;
+    组里只剩一个 socket 时内核照常选择. 不支持时返回 False"""
+    # 只有一条指令的 cBPF 程序: BPF_RET | BPF_K, 返回组内下标 1
+    program = ctypes.create_string_buffer(struct.pack("HBBI", 0x06, 0, 0, 1))
+    fprog = struct.pack("HP", 1, ctypes.addressof(program))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    except OSError as e:
+        logger.debug("Cannot steer connections on %s: %s", sock.getsockname(), e)
+        return False
+    return True
+
+
+def _busy(connection) -> bool:
+    """uvicorn 的连接是否有未完成的 HTTP 请求; WebSocket 连接由进行中的请求和 finish_drain 负责"""
+    if not hasattr(connection, "cycle"):
+        return False
+    cycle = connection.cycle
+    return cycle is not None and not cycle.response_complete
+
+
+class DrainingServer(uvicorn.Server):
+    def __init__(
+        self,
+        config: uvicorn.Config,
+        in_flight: InFlight,
+        begin_drain: Callable[[float], Awaitable[None]],
+        finish_drain: Callable[[float], Awaitable[None]],
+        prepare_handoff: Callable[[], None] | None = None,
+        timeout: float = DRAIN_TIMEOUT
+    ):
+        super().__init__(config)
+        self.in_flight = in_flight
+        self.begin_drain = begin_drain
+        self.finish_drain = finish_drain
+        self.prepare_handoff = prepare_handoff
+        self.timeout = timeout
+        self.listeners = []
+        self._drain_task: asyncio.Task | None = None
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets)
+        if self.started:
+            # 此时才开始接受连接, 部署脚本以这一行判断新进程就绪
+            logger.info("Listening on %s:%s", self.config.host, self.config.port)
+
+    def install_signal_handlers(self):
+        super().install_signal_handlers()
+        if threading.current_thread() is threading.main_thread():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self._handoff)
+
+    def _handoff(self):
+        """SIGUSR1: 允许新进程加入本进程监听的端口"""
+        for sock in self.listeners:
+            allow_reuse_port(sock)
+        if self.prepare_handoff is not None:
+            self.prepare_handoff()
+        logger.info("Ready to hand off port %s", self.config.port)
+
+    def handle_exit(self, sig, frame):
+        if sig == signal.SIGTERM and self.started and self._drain_task is None:
+            self._drain_task = asyncio.get_running_loop().create_task(self._drain())
+            return
+        super().handle_exit(sig, frame)
+
+    async def _drain(self):
+        deadline = time.monotonic() + self.timeout
+        logger.info("Draining before exit (up to %ss)", self.timeout)
+        self.in_flight.draining = True
+        try:
+            for sock in self.listeners:
+                steer_away(sock)
+            await asyncio.sleep(_ACCEPT_GRACE)
+            for server in self.servers:
+                server.close()
+            await self.begin_drain(deadline)
+            quiet_since = None
+            while time.monotonic() < deadline:
+                if self.in_flight.count() or any(map(_busy, self.server_state.connections)):
+                    quiet_since = None
+                elif quiet_since is None:
+                    quiet_since = time.monotonic()
+                elif time.monotonic() - quiet_since >= _SETTLE_TIME:
+                    break
+                await asyncio.sleep(_POLL_INTERVAL)
+            await self.finish_drain(deadline)
+        except Exception:
+            logger.exception("Draining failed")
+        remaining = self.in_flight.count()
+        if remaining:
+            logger.warning("Drain timed out with %d requests in flight", remaining)
+        else:
+            logger.info("Drained in %.1fs", self.timeout - (deadline - time.monotonic()))
+        self.should_exit = True
+
+
+def serve(
+    app, host: str, port: int, in_flight: InFlight, begin_drain, finish_drain,
+    prepare_handoff=None, handoff: bool = False, **kwargs
+):
+    """运行 uvicorn, SIGUSR1 时准备交接, SIGTERM 时排空后退出; handoff 表示接替仍在运行的旧进程"""
+    config = uvicorn.Config(app, host=host, port=port, timeout_graceful_shutdown=1, **kwargs)
+    server = DrainingServer(config, in_flight, begin_drain, finish_drain, prepare_handoff)
+    server.listeners = [listen_socket(host, port, reuse_port=handoff)]
+    server.run(sockets=server.listeners)
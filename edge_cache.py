@@ -0,0 +1,503 @@
+"""
+隧道的边缘缓存
+
+隧道开启 cache 后, 它的 GET 响应按共享缓存的规则 (Cache-Control, Expires, ETag,
+Last-Modified, Vary) 保存在服务端:
+    - 新鲜的条目直接返回, 不访问上游
+    - 过期但带校验器的条目发送条件请求, 上游回复 304 时更新头部后继续使用
+    - no-store, private, 带 Set-Cookie 或 Vary: * 的响应不保存; 带 Authorization 的请求不走缓存
+    - 同一个键的并发未命中只有第一个访问上游, 其余等它存入后再查
+
+内存一层按总字节数做 LRU; 设置了目录时, 从内存淘汰的条目降级写入磁盘, 再次命中时读回内存.
+磁盘一层的索引只在内存中, 启动时清空目录.
+按需压缩的结果与条目一起缓存, 每种编码只压缩一次.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Tuple
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+from compression import (
+    add_vary, choose_encoding, compress_bytes, encoded_headers, header_value, is_compressible
+)
+
+logger = logging.getLogger(__name__)
+
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 410}
+
+# 304 中出现时用来更新已保存条目的头部
+_REVALIDATION_HEADERS = {b"cache-control", b"date", b"etag", b"expires", b"last-modified", b"vary"}
+
+# 缓存直接作答时不返回给浏览器的头部, 这些由缓存重新生成
+_STORED_SKIP = {b"content-length", b"age", b"set-cookie"}
+
+# 未命中时去掉浏览器自己的条件头部, 取回完整响应才能存入
+_UNCONDITIONAL = [("if-none-match", None), ("if-modified-since", None)]
+
+# 条目以外的固定开销, 避免大量小条目超出内存限制
+_ENTRY_OVERHEAD = 512
+
+
+def parse_cache_control(value: str | None) -> Dict[str, str | None]:
+    directives = {}
+    for item in (value or "").split(","):
+        name, _, argument = item.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def _seconds(value: str | None) -> float | None:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_date(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class CacheEntry:
+    __slots__ = ("status", "headers", "body", "stored_at", "lifetime", "vary", "encodings", "size")
+
+    def __init__(self, status: int, headers, body: bytes, stored_at: float, lifetime: float, vary: Tuple[str, ...]):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at  # 已扣除上游返回的 Age
+        self.lifetime = lifetime
+        self.vary = vary
+        self.encodings: Dict[str, bytes] = {}
+        self.size = len(body) + _ENTRY_OVERHEAD
+
+    def age(self, now: float) -> float:
+        return max(0.0, now - self.stored_at)
+
+    def is_fresh(self, now: float) -> bool:
+        return self.age(now) < self.lifetime
+
+    @property
+    def etag(self) -> str | None:
+        return header_value(self.headers, b"etag")
+
+    @property
+    def last_modified(self) -> str | None:
+        return header_value(self.headers, b"last-modified")
+
+    def to_bytes(self) -> bytes:
+        meta = json.dumps({
+            "status": self.status,
+            "headers": [[k.decode("latin-1"), v.decode("latin-1")] for k, v in self.headers],
+            "stored_at": self.stored_at,
+            "lifetime": self.lifetime,
+            "vary": self.vary,
+        }).encode()
+        return len(meta).to_bytes(4, "big") + meta + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CacheEntry":
+        size = int.from_bytes(data[:4], "big")
+        meta = json.loads(data[4:4 + size])
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in meta["headers"]]
+        return cls(
+            meta["status"], headers, data[4 + size:], meta["stored_at"], meta["lifetime"], tuple(meta["vary"])
+        )
+
+
+def freshness_lifetime(headers) -> float | None:
+    """按 s-maxage, max-age, Expires 的顺序计算新鲜时长, 都没有时返回 None"""
+    directives = parse_cache_control(header_value(headers, b"cache-control"))
+    if "no-cache" in directives:
+        return 0.0
+    lifetime = _seconds(directives.get("s-maxage"))
+    if lifetime is None:
+        lifetime = _seconds(directives.get("max-age"))
+    if lifetime is None:
+        expires = header_value(headers, b"expires")
+        if expires is None:
+            return None
+        expires_at = _http_date(expires)
+        date = _http_date(header_value(headers, b"date"))
+        if expires_at is None:
+            return 0.0
+        lifetime = max(0.0, expires_at - (date or time.time()))
+    return lifetime
+
+
+def _stored_at(headers, now: float) -> float:
+    """收到响应的时刻减去上游已经缓存的时长"""
+    return now - (_seconds(header_value(headers, b"age")) or 0.0)
+
+
+def _variant_key(base: tuple, names: Tuple[str, ...], request: Request) -> tuple:
+    return base + tuple(" ".join(request.headers.get(name, "").split()) for name in names)
+
+
+def _not_modified(entry: CacheEntry, request: Request) -> bool:
+    """浏览器自己的条件请求与条目匹配时回复 304"""
+    if entry.status != 200:
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = entry.etag
+        if etag is None:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = _http_date(request.headers.get("if-modified-since"))
+    last_modified = _http_date(entry.last_modified)
+    return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+
+async def _discard(response: StreamingResponse):
+    """不需要的响应体读完丢弃, 让上游连接可以复用"""
+    async for _ in response.body_iterator:
+        pass
+
+
+def _write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _read_and_remove(path: str) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read()
+    os.unlink(path)
+    return data
+
+
+def _remove_later(path: str):
+    def remove():
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    asyncio.get_running_loop().run_in_executor(None, remove)
+
+
+class EdgeCache:
+    """
+    memory_bytes: 内存一层的总字节数上限
+    max_entry_bytes: 单个响应体超过该大小时不缓存
+    directory: 磁盘一层的目录, 为空时不使用磁盘
+    on_evict: 淘汰一个条目时以层名 ("memory" 或 "disk") 调用
+    """
+    def __init__(
+        self,
+        memory_bytes: int,
+        max_entry_bytes: int,
+        directory: str | None = None,
+        disk_bytes: int = 0,
+        wait_timeout: float = 10.0,
+        on_evict: Callable[[str], None] | None = None
+    ):
+        self.memory_bytes = memory_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes if directory else 0
+        self.wait_timeout = wait_timeout
+        self._on_evict = on_evict
+        self._memory: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+        self._memory_size = 0
+        self._disk: "OrderedDict[tuple, Tuple[str, int]]" = OrderedDict()
+        self._disk_size = 0
+        self._vary: Dict[tuple, Tuple[str, ...]] = {}  # (端口, 路径) -> 上次响应的 Vary 头部
+        self._inflight: Dict[tuple, asyncio.Event] = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # 索引不持久化, 之前留下的文件无法再找到
+            for name in os.listdir(directory):
+                if name.endswith(".cache"):
+                    os.unlink(os.path.join(directory, name))
+
+    @property
+    def memory_size(self) -> int:
+        return self._memory_size
+
+    @property
+    def disk_size(self) -> int:
+        return self._disk_size
+
+    def __len__(self) -> int:
+        return len(self._memory) + len(self._disk)
+
+    # 查找与存储
+    def _key(self, base: tuple, request: Request) -> tuple:
+        return _variant_key(base, self._vary.get(base, ()), request)
+
+    async def _get(self, key: tuple) -> CacheEntry | None:
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            return entry
+        located = self._disk.pop(key, None)
+        if located is None:
+            return None
+        path, size = located
+        self._disk_size -= size
+        try:
+            data = await asyncio.to_thread(_read_and_remove, path)
+        except OSError as e:
+            logger.warning("Failed to read cache file %s: %s", path, e)
+            return None
+        entry = CacheEntry.from_bytes(data)
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key: tuple, entry: CacheEntry):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= old.size
+        located = self._disk.pop(key, None)
+        if located is not None:
+            self._disk_size -= located[1]
+            _remove_later(located[0])
+        self._memory[key] = entry
+        self._memory_size += entry.size
+        self._shrink_memory()
+
+    def _shrink_memory(self):
+        while self._memory_size > self.memory_bytes and self._memory:
+            key, entry = self._memory.popitem(last=False)
+            self._memory_size -= entry.size
+            self._evicted("memory")
+            if self.disk_bytes and len(entry.body) + _ENTRY_OVERHEAD <= self.disk_bytes:
+                self._demote(key, entry)
+
+    def _demote(self, key: tuple, entry: CacheEntry):
+        """写入磁盘在线程中进行, 完成后才出现在磁盘索引中"""
+        path = os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + ".cache")
+        data = entry.to_bytes()
+
+        def written(future):
+            if future.exception() is not None:
+                logger.warning("Failed to write cache file %s: %s", path, future.exception())
+                return
+            if key in self._memory or key in self._disk:
+                return
+            self._disk[key] = (path, len(data))
+            self._disk_size += len(data)
+            while self._disk_size > self.disk_bytes and self._disk:
+                _, (old_path, size) = self._disk.popitem(last=False)
+                self._disk_size -= size
+                self._evicted("disk")
+                _remove_later(old_path)
+
+        asyncio.ensure_future(asyncio.to_thread(_write_file, path, data)).add_done_callback(written)
+
+    def _evicted(self, tier: str):
+        if self._on_evict is not None:
+            self._on_evict(tier)
+
+    def purge(self, public_port: int):
+        """删除某个隧道的全部条目"""
+        for key in [key for key in self._memory if key[0] == public_port]:
+            self._memory_size -= self._memory.pop(key).size
+        for key in [key for key in self._disk if key[0] == public_port]:
+            path, size = self._disk.pop(key)
+            self._disk_size -= size
+            _remove_later(path)
+        for base in [base for base in self._vary if base[0] == public_port]:
+            del self._vary[base]
+
+    # 请求处理
+    async def handle(
+        self,
+        public_port: int,
+        target: str,
+        request: Request,
+        fetch: Callable[..., Awaitable[StreamingResponse]],
+        compress: bool = False
+    ) -> Tuple[Response, str]:
+        """返回 (响应, 结果), 结果为 hit, revalidated, miss 或 bypass
+
+        fetch(extra_headers) 访问上游并返回流式响应, extra_headers 替换同名的请求头, 值为 None 时删除
+        """
+        request_directives = parse_cache_control(request.headers.get("cache-control"))
+        if "authorization" in request.headers or "no-store" in request_directives:
+            return await fetch(), "bypass"
+        # 浏览器强制刷新时仍可用缓存, 但必须先经上游确认
+        must_revalidate = (
+            "no-cache" in request_directives
+            or request_directives.get("max-age") == "0"
+            or request.headers.get("pragma", "").lower() == "no-cache"
+        )
+
+        base = (public_port, target)
+        key = self._key(base, request)
+        entry = await self._get(key)
+        if entry is None and key in self._inflight:
+            try:
+                await asyncio.wait_for(self._inflight[key].wait(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                pass
+            key = self._key(base, request)
+            entry = await self._get(key)
+
+        if entry is not None and not must_revalidate and entry.is_fresh(time.time()):
+            return await self._respond(key, entry, request, compress), "hit"
+
+        if entry is not None and (entry.etag or entry.last_modified):
+            conditional = []
+            if entry.etag:
+                conditional.append(("if-none-match", entry.etag))
+            if entry.last_modified:
+                conditional.append(("if-modified-since", entry.last_modified))
+            response = await fetch(conditional)
+            if response.status_code == 304:
+                await _discard(response)
+                self._refresh(key, entry, response.raw_headers)
+                return await self._respond(key, entry, request, compress), "revalidated"
+        elif request.method == "GET" and key not in self._inflight:
+            event = self._inflight[key] = asyncio.Event()
+            try:
+                response = await fetch(_UNCONDITIONAL)
+            except BaseException:
+                self._finish_inflight(key, event)
+                raise
+            return self._store(base, key, request, response, event), "miss"
+        else:
+            response = await fetch()
+
+        if request.method == "GET":
+            response = self._store(base, key, request, response)
+        return response, "miss"
+
+    def _finish_inflight(self, key: tuple, event: asyncio.Event | None):
+        if event is not None:
+            event.set()
+            if self._inflight.get(key) is event:
+                del self._inflight[key]
+
+    def _storable(self, response: StreamingResponse) -> bool:
+        if response.status_code not in CACHEABLE_STATUS:
+            return False
+        headers = response.raw_headers
+        directives = parse_cache_control(header_value(headers, b"cache-control"))
+        if "no-store" in directives or "private" in directives:
+            return False
+        if header_value(headers, b"set-cookie") is not None:
+            return False
+        if (header_value(headers, b"vary") or "").strip() == "*":
+            return False
+        length = header_value(headers, b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_entry_bytes:
+            return False
+        # 既不能判断新鲜度又没有校验器的响应存下来也用不上
+        if freshness_lifetime(headers) is None and header_value(headers, b"etag") is None \
+                and header_value(headers, b"last-modified") is None:
+            return False
+        return True
+
+    def _store(self, base: tuple, key: tuple, request: Request, response: StreamingResponse,
+               event: asyncio.Event | None = None):
+        """响应可以缓存时, 边转发边收集响应体, 完整转发后存入"""
+        if not self._storable(response):
+            self._finish_inflight(key, event)
+            return response
+
+        headers = response.raw_headers
+        vary = tuple(sorted(
+            name.strip().lower() for name in (header_value(headers, b"vary") or "").split(",") if name.strip()
+        ))
+        # Vary 可能与上次不同, 按本次响应的 Vary 重新计算键
+        store_key = _variant_key(base, vary, request)
+        status = response.status_code
+        stored_headers = [(k, v) for k, v in headers if k not in _STORED_SKIP]
+        body = response.body_iterator
+
+        async def collect():
+            chunks = []
+            size = 0
+            complete = False
+            try:
+                async for chunk in body:
+                    if chunks is not None:
+                        size += len(chunk)
+                        if size > self.max_entry_bytes:
+                            chunks = None
+                        else:
+                            chunks.append(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                if complete and chunks is not None:
+                    now = time.time()
+                    self._vary[base] = vary
+                    self._put(store_key, CacheEntry(
+                        status, stored_headers, b"".join(chunks),
+                        _stored_at(headers, now), freshness_lifetime(headers) or 0.0, vary
+                    ))
+                self._finish_inflight(key, event)
+
+        response.body_iterator = collect()
+        return response
+
+    def _refresh(self, key: tuple, entry: CacheEntry, headers):
+        """304 响应: 用其中的新鲜度和校验器相关头部替换条目中的同名头部"""
+        updates = [(k, v) for k, v in headers if k in _REVALIDATION_HEADERS]
+        if updates:
+            names = {k for k, _ in updates}
+            entry.headers = [(k, v) for k, v in entry.headers if k not in names] + updates
+        entry.stored_at = _stored_at(headers, time.time())
+        entry.lifetime = freshness_lifetime(entry.headers) or 0.0
+        if key in self._memory:
+            self._memory.move_to_end(key)
+
+    async def _encoded(self, key: tuple, entry: CacheEntry, encoding: str) -> bytes:
+        """条目按 encoding 压缩后的内容, 第一次用到时压缩并计入条目大小"""
+        encoded = entry.encodings.get(encoding)
+        if encoded is None:
+            if len(entry.body) > 64 * 1024:
+                encoded = await asyncio.to_thread(compress_bytes, encoding, entry.body)
+                # 等待期间可能已被并发的请求压缩好
+                if encoding in entry.encodings:
+                    return entry.encodings[encoding]
+            else:
+                encoded = compress_bytes(encoding, entry.body)
+            entry.encodings[encoding] = encoded
+            entry.size += len(encoded)
+            if self._memory.get(key) is entry:
+                self._memory_size += len(encoded)
+                self._shrink_memory()
+        return encoded
+
+    async def _respond(self, key: tuple, entry: CacheEntry, request: Request, compress: bool) -> Response:
+        headers = list(entry.headers)
+        if _not_modified(entry, request):
+            response = Response(status_code=304)
+            response.raw_headers = [(k, v) for k, v in headers if k in _REVALIDATION_HEADERS]
+            return response
+
+        body = entry.body
+        if compress and request.method == "GET" and is_compressible(
+            entry.status, headers + [(b"content-length", str(len(body)).encode())]
+        ):
+            encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+            if encoding is None:
+                headers = add_vary(headers)
+            else:
+                body = await self._encoded(key, entry, encoding)
+                headers = encoded_headers(headers, encoding)
+
+        response = Response(content=body, status_code=entry.status)
+        response.raw_headers = headers + [
+            (b"content-length", str(len(body)).encode()),
+            (b"age", str(int(entry.age(time.time()))).encode()),
+        ]
+        return response
@@ -0,0 +1,136 @@
+"""
+按 Host 头部路由
+
+自定义域名存放在按标签反转的字典树中: "api.example.com" 依次经过 com -> example -> api.
+节点中的 "" 键保存精确匹配的值, "*" 键保存通配符 "*.example.com" 的值,
+通配符匹配其下任意层级的子域名, 但不匹配 example.com 本身; 精确匹配优先, 其次是最长的通配符.
+查找只与主机名的标签数有关, 与已注册的域名数量无关.
+
+HostRouter 是 ASGI 中间件: Host 命中某个隧道时把请求路径改写为 /proxy/{public_port}{path},
+交给原有的代理路由处理, 其余请求 (管理面板, API 等) 原样放行. 服务端自己的主机名从不改写,
+注册隧道时也不能使用它们或覆盖它们的通配符.
+"""
+from typing import Callable, Collection, Dict
+
+_EXACT = ""
+_WILDCARD = "*"
+
+
+def normalize_host(host: str) -> str | None:
+    """去掉端口和末尾的点并转为小写, 不是合法主机名时返回 None"""
+    host = host.strip().lower()
+    if host.startswith("["):
+        # IPv6 字面量不会对应任何域名
+        return None
+    host = host.rsplit(":", 1)[0] if ":" in host else host
+    host = host.rstrip(".")
+    if not host or "*" in host or ".." in host or host.startswith("."):
+        return None
+    return host
+
+
+def normalize_domain(domain: str) -> str:
+    """校验并规范化要注册的域名, 允许最左侧为 "*" 的通配符; 通配符不能直接位于顶级域名下 (如 *.com)"""
+    domain = domain.strip().lower().rstrip(".")
+    labels = domain.split(".")
+    if len(labels) < 2 or any(not label for label in labels):
+        raise ValueError(f"Invalid custom domain: {domain}")
+    if "*" in domain and (labels[0] != "*" or "*" in ".".join(labels[1:]) or len(labels) < 3):
+        raise ValueError(f"Invalid custom domain: {domain}")
+    return domain
+
+
+def domain_covers(domain: str, host: str) -> bool:
+    """规范化后的 domain (可以是通配符) 是否匹配规范化后的主机名 host"""
+    if domain.startswith("*."):
+        return host.endswith(domain[1:])
+    return domain == host
+
+
+class DomainTrie:
+    """按标签反转的域名字典树, 值一般是隧道ID"""
+    def __init__(self):
+        self._root: Dict[str, object] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, domain: str, value):
+        """domain 需先经 normalize_domain 规范化"""
+        labels = domain.split(".")
+        node = self._root
+        for label in reversed(labels[1:]):
+            node = node.setdefault(label, {})
+        key = labels[0]
+        if key == _WILDCARD:
+            slot = _WILDCARD
+        else:
+            node = node.setdefault(key, {})
+            slot = _EXACT
+        if slot not in node:
+            self._size += 1
+        node[slot] = value
+
+    def remove(self, domain: str):
+        labels = domain.split(".")
+        path = [self._root]
+        for label in reversed(labels[1:]):
+            node = path[-1].get(label)
+            if node is None:
+                return
+            path.append(node)
+        if labels[0] == _WILDCARD:
+            slot = _WILDCARD
+        else:
+            node = path[-1].get(labels[0])
+            if node is None:
+                return
+            path.append(node)
+            slot = _EXACT
+        if path[-1].pop(slot, None) is None:
+            return
+        self._size -= 1
+        # 自下而上删除空节点
+        keys = list(reversed(labels if slot == _EXACT else labels[1:]))
+        for depth in range(len(path) - 1, 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][keys[depth - 1]]
+
+    def match(self, host: str):
+        """host 需先经 normalize_host 规范化, 没有匹配时返回 None"""
+        node = self._root
+        found = None
+        for label in reversed(host.split(".")):
+            # 当前节点的通配符要求后面至少还有一级标签
+            wildcard = node.get(_WILDCARD)
+            if wildcard is not None:
+                found = wildcard
+            node = node.get(label)
+            if node is None:
+                return found
+        return node.get(_EXACT, found)
+
+
+class HostRouter:
+    """ASGI 中间件, resolve 根据规范化后的主机名返回隧道的公网端口或 None; server_hosts 中的主机名不改写"""
+    def __init__(self, app, resolve: Callable[[str], int | None], server_hosts: Collection[str] = ()):
+        self.app = app
+        self.resolve = resolve
+        self.server_hosts = frozenset(server_hosts)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            for name, value in scope["headers"]:
+                if name == b"host":
+                    host = normalize_host(value.decode("latin-1"))
+                    public_port = self.resolve(host) if host and host not in self.server_hosts else None
+                    if public_port is not None:
+                        prefix = f"/proxy/{public_port}"
+                        scope = dict(scope)
+                        scope["path"] = prefix + scope["path"]
+                        if scope.get("raw_path"):
+                            scope["raw_path"] = prefix.encode() + scope["raw_path"]
+                    break
+        return await self.app(scope, receive, send)
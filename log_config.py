@@ -0,0 +1,105 @@
+"""
+日志配置
+
+日志记录经 QueueHandler 放入队列, 由 QueueListener 的后台线程格式化并写出,
+事件循环上只做级别判断和消息拼接, 不做任何 I/O.
+
+环境变量:
+    LOG_LEVEL               根日志级别, 默认 INFO
+    LOG_LEVELS              按子系统设置级别, 如 "server.proxy=DEBUG,tcp_tunnel=WARNING"
+    LOG_FORMAT              text 或 json, 默认 text
+    LOG_FILE                额外写入的日志文件
+    ACCESS_LOG_SAMPLE_RATE  访问日志采样率 (0~1), 5xx 响应总是记录
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FILE = os.getenv("LOG_FILE")
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", 0.01))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 只在调用线程里拼接消息, 时间戳和 JSON 序列化留给后台线程
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """普通文本, 结构化字段以 key=value 追加在行尾"""
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON"""
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """配置根日志并启动后台写日志线程, 返回的 listener 在退出时 stop()"""
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class AccessLog:
+    """按比例采样的访问日志"""
+    def __init__(self, logger: logging.Logger, sample_rate: float = ACCESS_LOG_SAMPLE_RATE):
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    def log(self, method: str, target: str, status: int, duration: float, **fields):
+        if status < 500 and random.random() >= self.sample_rate:
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        fields.update(method=method, target=target, status=status, ms=round(duration * 1000, 1))
+        self.logger.info("%s %s %d", method, target, status, extra={"fields": fields})
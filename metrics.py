@@ -0,0 +1,183 @@
+"""
+进程内指标, 以 Prometheus 文本格式导出
+
+所有记录都发生在事件循环线程上, 因此不加锁: 计数只是对子对象的属性做加法,
+直方图用 bisect 找桶. labels() 返回的子对象可以缓存起来重复使用.
+"""
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        # 按调用时传入的原始标签值缓存, 命中时不必再转换成字符串
+        self._cache: Dict[tuple, object] = {}
+
+    def labels(self, *values):
+        child = self._cache.get(values)
+        if child is None:
+            key = tuple(str(v) for v in values)
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            self._cache[values] = child
+        return child
+
+    def remove(self, *values):
+        """删除标签以 values 开头的所有子对象"""
+        prefix = tuple(str(v) for v in values)
+        size = len(prefix)
+        for key in [key for key in self._children if key[:size] == prefix]:
+            del self._children[key]
+        for key in [key for key in self._cache if tuple(str(v) for v in key[:size]) == prefix]:
+            del self._cache[key]
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """计数器和仪表的当前值, 以标签元组为键"""
+        return {key: child.value for key, child in self._children.items()}
+
+    def _new_child(self):
+        return _Value()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in self._children.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """导出时调用 function 取值, 适合本来就能直接算出的量"""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            self.labels().set(self._function())
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,396 @@
+"""
+隧道多路复用协议
+
+服务端与客户端之间的一条 WebSocket 上同时承载多个 HTTP 交换.
+每个二进制消息是一帧, 帧头固定 6 字节:
+
+    +---------+----------+----------------+-------------
+    | type: 1 | flags: 1 | stream_id: 4   | payload ...
+    +---------+----------+----------------+-------------
+
+HEADERS       请求头 (方法, 路径, 头部) 或响应头 (状态码, 头部)
+DATA          原始字节的请求体/响应体
+WINDOW_UPDATE 接收方消费数据后归还发送窗口, 实现按流的流量控制
+RESET         中止一个流
+CONTROL       控制消息 (tunnel_request 等), 流ID 为 0, 编码见 codec.py;
+              没有协商二进制编码时控制消息是 JSON 文本消息
+
+DATA 帧设置 FLAG_COMPRESSED 时内容经 zlib 压缩, 解压后不超过 MAX_FRAME_SIZE;
+流量控制按解压后的长度计算. 是否压缩由发送方决定 (Multiplexer.compress_level).
+无法解压或解压后过大的帧只重置它所在的流, 连接上的其他流不受影响.
+不小于 COMPRESS_THREAD_MIN_SIZE 的帧在线程中压缩, 不占用事件循环; 解压的结果不超过
+MAX_FRAME_SIZE, 耗时在 0.1ms 左右, 在收到帧时直接完成.
+
+一个客户端可以注册多个带名称的隧道, 发往客户端的流在第一个 HEADERS 帧的原有内容前
+总是加上隧道名称 (encode_routed_head, 没有名称的隧道为空字符串), 客户端据此选择本地服务.
+
+同一协议也用于 worker 之间的内部连接: 经其他 worker 转发时, 流的第一个 HEADERS
+帧在最前面再加上目标客户端ID, 由持有该客户端连接的 worker 去掉后转交给客户端.
+"""
+import asyncio
+import struct
+import zlib
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+FRAME_HEADERS = 1
+FRAME_DATA = 2
+FRAME_WINDOW_UPDATE = 3
+FRAME_RESET = 4
+FRAME_CONTROL = 5
+
+FLAG_END_STREAM = 0x1
+FLAG_COMPRESSED = 0x2
+
+INITIAL_WINDOW = 256 * 1024
+MAX_FRAME_SIZE = 64 * 1024
+# 小于该长度的数据帧不压缩; 压缩后没有小于原长度的 90% 时, 这个流之后不再尝试压缩
+COMPRESS_MIN_SIZE = 512
+COMPRESS_MIN_SAVING = 0.9
+# 压缩一个 64KB 的帧约需 0.5-1ms
+COMPRESS_THREAD_MIN_SIZE = 16 * 1024
+
+# 逐跳头部, 不在代理两端之间转发
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade"
+}
+
+_FRAME_HEADER = struct.Struct("!BBI")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+
+
+class StreamReset(Exception):
+    """对端重置了流, 或者底层连接已断开"""
+
+
+def _decompress(payload) -> bytes:
+    """解压数据帧, 解压后超过 MAX_FRAME_SIZE 视为协议错误"""
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise StreamReset(f"corrupt compressed frame: {e}") from None
+    if decompressor.unconsumed_tail:
+        raise StreamReset("compressed frame too large")
+    return data
+
+
+def encode_frame(frame_type: int, stream_id: int, payload=b"", flags: int = 0) -> bytes:
+    return _FRAME_HEADER.pack(frame_type, flags, stream_id) + payload
+
+
+def decode_frame(data: bytes):
+    frame_type, flags, stream_id = _FRAME_HEADER.unpack_from(data)
+    return frame_type, flags, stream_id, memoryview(data)[_FRAME_HEADER.size:]
+
+
+def encode_fields(fields: List[str]) -> bytes:
+    """字符串列表编码为: 数量(u16) + 每项长度(u16) + 内容"""
+    parts = [_U16.pack(len(fields))]
+    for field in fields:
+        raw = field.encode("latin-1")
+        parts.append(_U16.pack(len(raw)))
+        parts.append(raw)
+    return b"".join(parts)
+
+
+def decode_fields(data) -> List[str]:
+    # latin-1 与字节一一对应: 整块解码一次, 再按长度切片, 比逐项解码快一倍
+    text = str(data, "latin-1")
+    if len(text) < _U16.size:
+        raise ValueError("truncated header fields")
+    count = ord(text[0]) << 8 | ord(text[1])
+    offset = _U16.size
+    fields = []
+    for _ in range(count):
+        if offset + _U16.size > len(text):
+            raise ValueError("truncated header fields")
+        end = offset + _U16.size + (ord(text[offset]) << 8 | ord(text[offset + 1]))
+        fields.append(text[offset + _U16.size:end])
+        offset = end
+    if offset > len(text):
+        raise ValueError("truncated header fields")
+    return fields
+
+
+def encode_routed_head(route: str, head: bytes) -> bytes:
+    return encode_fields([route]) + head
+
+
+def decode_routed_head(payload):
+    """返回 (路由, 其余头部), 路由是目标客户端ID或隧道名称; 开头不是完整的路由时抛出 ValueError"""
+    offset = 2 * _U16.size
+    if len(payload) < offset or _U16.unpack_from(payload)[0] != 1:
+        raise ValueError("missing route")
+    size, = _U16.unpack_from(payload, _U16.size)
+    if offset + size > len(payload):
+        raise ValueError("truncated route")
+    route = str(payload[offset:offset + size], "latin-1")
+    return route, memoryview(payload)[offset + size:]
+
+
+def _pairs(fields: List[str]) -> List[Tuple[str, str]]:
+    return list(zip(fields[0::2], fields[1::2]))
+
+
+def encode_request_head(method: str, path: str, headers: List[Tuple[str, str]]) -> bytes:
+    fields = [method, path]
+    for name, value in headers:
+        fields.append(name)
+        fields.append(value)
+    return encode_fields(fields)
+
+
+def decode_request_head(payload):
+    fields = decode_fields(payload)
+    if len(fields) < 2:
+        raise ValueError("missing method or path")
+    return fields[0], fields[1], _pairs(fields[2:])
+
+
+def encode_response_head(status: int, headers: List[Tuple[str, str]]) -> bytes:
+    fields = [str(status)]
+    for name, value in headers:
+        fields.append(name)
+        fields.append(value)
+    return encode_fields(fields)
+
+
+def decode_response_head(payload):
+    fields = decode_fields(payload)
+    if not fields:
+        raise ValueError("missing status")
+    return int(fields[0]), _pairs(fields[1:])
+
+
+class Stream:
+    """多路复用连接上的一个双向流"""
+    def __init__(self, mux: "Multiplexer", stream_id: int, routes: Tuple[str, ...] = ()):
+        self.mux = mux
+        self.id = stream_id
+        self.routes = routes  # 依次为经其他 worker 转发时的目标客户端ID, 隧道名称; 都可以没有
+        self.local_closed = False  # 本端已发送 END_STREAM
+        self.remote_closed = False  # 已收到对端 END_STREAM
+        self.head_end_stream = False  # 对端的 HEADERS 帧本身就结束了流, 即没有消息体
+        self.error: Exception | None = None
+        self._head = None
+        self._head_ready = asyncio.Event()
+        self._chunks: asyncio.Queue = asyncio.Queue()
+        self._send_window = INITIAL_WINDOW
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+        self._unacked = 0  # 已消费但还没通告给对端的字节数
+        self._compressible = True  # 数据压缩效果不好时 (图片, 已压缩的响应) 置为 False
+
+    async def wait_head(self):
+        """等待对端发来的头部"""
+        await self._head_ready.wait()
+        if self._head is None:
+            raise self.error
+        return self._head
+
+    async def send_head(self, payload: bytes, end_stream: bool = False):
+        if self.routes:
+            for route in reversed(self.routes):
+                payload = encode_routed_head(route, payload)
+            self.routes = ()
+        flags = FLAG_END_STREAM if end_stream else 0
+        await self.mux.send_frame(FRAME_HEADERS, self.id, payload, flags)
+        if end_stream:
+            self._close_local()
+
+    async def write(self, data: bytes):
+        """发送数据, 发送窗口耗尽时等待对端归还"""
+        view = memoryview(data)
+        while view:
+            while self._send_window <= 0 and self.error is None:
+                self._window_open.clear()
+                await self._window_open.wait()
+            if self.error is not None:
+                raise self.error
+            size = min(len(view), MAX_FRAME_SIZE, self._send_window)
+            self._send_window -= size
+            payload, flags = await self._compress(view[:size])
+            await self.mux.send_frame(FRAME_DATA, self.id, payload, flags)
+            view = view[size:]
+
+    async def _compress(self, payload):
+        """按连接的设置压缩一个数据帧, 返回 (内容, 标志)"""
+        level = self.mux.compress_level
+        if level is None or not self._compressible or len(payload) < COMPRESS_MIN_SIZE:
+            return payload, 0
+        if len(payload) >= COMPRESS_THREAD_MIN_SIZE:
+            compressed = await asyncio.to_thread(zlib.compress, payload, level)
+        else:
+            compressed = zlib.compress(payload, level)
+        if len(compressed) < len(payload) * COMPRESS_MIN_SAVING:
+            return compressed, FLAG_COMPRESSED
+        self._compressible = False
+        return payload, 0
+
+    async def end(self):
+        if not self.local_closed:
+            await self.mux.send_frame(FRAME_DATA, self.id, b"", FLAG_END_STREAM)
+            self._close_local()
+
+    async def read(self) -> bytes:
+        """读取下一块数据, 流正常结束时返回 b\"\""""
+        chunk = await self._chunks.get()
+        if chunk is None:
+            self._chunks.put_nowait(None)
+            if self.error is not None:
+                raise self.error
+            return b""
+        # 攒够四分之一窗口再归还, 减少 WINDOW_UPDATE 帧的数量
+        self._unacked += len(chunk)
+        if self._unacked >= INITIAL_WINDOW // 4 and not self.remote_closed:
+            increment, self._unacked = self._unacked, 0
+            await self.mux.send_frame(FRAME_WINDOW_UPDATE, self.id, _U32.pack(increment))
+        return chunk
+
+    async def iter_chunks(self):
+        while True:
+            chunk = await self.read()
+            if not chunk:
+                return
+            yield chunk
+
+    async def reset(self, reason: str = ""):
+        """中止流并通知对端"""
+        if self.mux.streams.pop(self.id, None) is None:
+            return
+        self._fail(StreamReset(reason))
+        try:
+            await self.mux.send_frame(FRAME_RESET, self.id, reason.encode("utf-8"))
+        except StreamReset:
+            pass
+
+    # 以下由 Multiplexer 在收到帧时调用, 都不会阻塞
+    def _on_head(self, payload, end_stream: bool):
+        self._head = bytes(payload)
+        self.head_end_stream = end_stream
+        self._head_ready.set()
+        if end_stream:
+            self._on_data(b"", True)
+
+    def _on_data(self, payload, end_stream: bool):
+        if payload:
+            self._chunks.put_nowait(bytes(payload))
+        if end_stream:
+            self.remote_closed = True
+            self._chunks.put_nowait(None)
+            self.mux._maybe_remove(self)
+
+    def _on_window_update(self, increment: int):
+        self._send_window += increment
+        self._window_open.set()
+
+    def _fail(self, error: Exception):
+        if self.error is None:
+            self.error = error
+        self.remote_closed = True
+        self.local_closed = True
+        self._head_ready.set()
+        self._chunks.put_nowait(None)
+        self._window_open.set()
+
+    def _close_local(self):
+        self.local_closed = True
+        self.mux._maybe_remove(self)
+
+
+class Multiplexer:
+    """在一条消息通道上复用多个流
+
+    send: 发送一个二进制消息的协程函数, 所有帧经同一把锁串行写出
+    on_stream: 对端新建流时调用的协程函数, 为空时忽略对端新建的流
+    """
+    def __init__(
+        self,
+        send: Callable[[bytes], Awaitable[None]],
+        on_stream: Callable[[Stream], Awaitable[None]] | None = None,
+        first_stream_id: int = 1
+    ):
+        self.streams: Dict[int, Stream] = {}
+        self.closed = False
+        self._send = send
+        self._on_stream = on_stream
+        self._next_id = first_stream_id
+        self.compress_level: int | None = None  # 为 None 时不压缩发出的数据帧
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def open_stream(self, *routes: str) -> Stream:
+        if self.closed:
+            raise StreamReset("connection closed")
+        stream = Stream(self, self._next_id, routes)
+        self._next_id += 2
+        self.streams[stream.id] = stream
+        return stream
+
+    async def send_frame(self, frame_type: int, stream_id: int, payload=b"", flags: int = 0):
+        if self.closed:
+            raise StreamReset("connection closed")
+        frame = encode_frame(frame_type, stream_id, payload, flags)
+        async with self._lock:
+            await self._send(frame)
+
+    def feed(self, data: bytes):
+        """处理收到的一帧"""
+        frame_type, flags, stream_id, payload = decode_frame(data)
+        end_stream = bool(flags & FLAG_END_STREAM)
+        stream = self.streams.get(stream_id)
+
+        if frame_type == FRAME_HEADERS:
+            if stream is None:
+                if self._on_stream is None:
+                    return
+                stream = Stream(self, stream_id)
+                self.streams[stream_id] = stream
+                self._spawn(self._on_stream(stream))
+            stream._on_head(payload, end_stream)
+        elif stream is None:
+            # 已经结束或被重置的流, 丢弃迟到的帧
+            return
+        elif frame_type == FRAME_DATA:
+            if flags & FLAG_COMPRESSED:
+                try:
+                    payload = _decompress(payload)
+                except StreamReset as e:
+                    self._reset(stream, e)
+                    return
+            stream._on_data(payload, end_stream)
+        elif frame_type == FRAME_WINDOW_UPDATE:
+            stream._on_window_update(_U32.unpack(payload)[0])
+        elif frame_type == FRAME_RESET:
+            del self.streams[stream_id]
+            stream._fail(StreamReset(bytes(payload).decode("utf-8", "replace")))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _reset(self, stream: Stream, error: StreamReset):
+        """在 feed 中重置一个流, RESET 帧在后台发出"""
+        del self.streams[stream.id]
+        stream._fail(error)
+        self._spawn(self._send_reset(stream.id, str(error)))
+
+    async def _send_reset(self, stream_id: int, reason: str):
+        try:
+            await self.send_frame(FRAME_RESET, stream_id, reason.encode("utf-8"))
+        except StreamReset:
+            pass
+
+    def _maybe_remove(self, stream: Stream):
+        if stream.local_closed and stream.remote_closed:
+            self.streams.pop(stream.id, None)
+
+    def close(self):
+        """连接断开, 所有未完成的流都以 StreamReset 结束"""
+        self.closed = True
+        for stream in self.streams.values():
+            stream._fail(StreamReset("connection closed"))
+        self.streams.clear()
@@ -0,0 +1,266 @@
+"""
+限流与带宽整形
+
+每个隧道和每个用户各有一个 Limiter, 由三部分组成, 都可以不设置:
+    requests_per_second/burst  请求数令牌桶, 超出时直接返回 429
+    concurrent                 同时进行中的请求 (含 WebSocket) 数
+    bytes_per_second           字节令牌桶, 对流式的请求体和响应体整形
+
+令牌桶只保存令牌数和上次更新时间, 取令牌时按经过的时间补充, 不需要定时任务,
+每次请求的开销是 O(1). 整形允许令牌数为负 (欠账), 欠多少就让发送方等多久,
+所以一个数据块不必拆开也能平滑限速.
+状态只在本进程内, 多 worker 部署时每个 worker 各自限流.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import List
+
+# 限额字段, 取值为正数或 None (不限制)
+LIMIT_FIELDS = ("requests_per_second", "burst", "concurrent", "bytes_per_second")
+
+
+def validate_limits(data) -> dict | None:
+    """校验 API 传入的限额, 返回只含已设置字段的新字典, 都没有设置时返回 None; 不合法时抛出 ValueError"""
+    if data is None:
+        return None
+    if not isinstance(data, dict):
+        raise ValueError("limits must be an object")
+    for field in data:
+        if field not in LIMIT_FIELDS:
+            raise ValueError(f"Unknown limit: {field}")
+    limits = {}
+    for field in LIMIT_FIELDS:
+        value = data.get(field)
+        if value is None:
+            continue
+        integral = field in ("burst", "concurrent")
+        if isinstance(value, bool) or not isinstance(value, int if integral else (int, float)) or value <= 0:
+            kind = "integer" if integral else "number"
+            raise ValueError(f"{field} must be a positive {kind}")
+        limits[field] = value
+    if "burst" in limits and "requests_per_second" not in limits:
+        raise ValueError("burst requires requests_per_second")
+    return limits or None
+
+
+def check_within(limits: dict | None, cap: dict | None):
+    """limits 中设置的字段不能超过 cap 中的同名字段, 超过时抛出 ValueError"""
+    if not limits or not cap:
+        return
+    for field in LIMIT_FIELDS:
+        if field in limits and field in cap and limits[field] > cap[field]:
+            raise ValueError(f"{field} exceeds the user limit of {cap[field]}")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1.0) -> float:
+        """令牌足够时取走并返回 0, 否则不取并返回需要等待的秒数"""
+        self._refill(time.monotonic())
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def refund(self, amount: float = 1.0):
+        self.tokens = min(self.burst, self.tokens + amount)
+
+    def reserve(self, amount: float) -> float:
+        """无论是否足够都取走, 返回为了不超速需要等待的秒数"""
+        self._refill(time.monotonic())
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Limiter:
+    """一个隧道或用户的限额及其状态; limits 是当前生效的配置对象"""
+    __slots__ = ("limits", "requests", "bandwidth", "concurrent", "active")
+
+    def __init__(self, limits: dict):
+        self.active = 0
+        self.configure(limits)
+
+    def configure(self, limits: dict):
+        """换成新配置, 令牌桶重新开始, 进行中的请求数保留"""
+        self.limits = limits
+        rate = limits.get("requests_per_second")
+        self.requests = TokenBucket(rate, limits.get("burst") or max(1.0, rate)) if rate else None
+        byte_rate = limits.get("bytes_per_second")
+        # 允许一秒的突发, 短响应不受影响
+        self.bandwidth = TokenBucket(byte_rate, byte_rate) if byte_rate else None
+        self.concurrent = limits.get("concurrent")
+
+
+class Limiters:
+    """按键 (隧道的客户端ID或用户名) 保存 Limiter"""
+    def __init__(self):
+        self._limiters = {}
+
+    def get(self, key, limits: dict | None) -> Limiter | None:
+        """limits 为当前配置; 配置换成了新对象时 (API 修改或其他 worker 同步过来) 就地更新"""
+        limiter = self._limiters.get(key)
+        if limiter is not None and limiter.limits is limits:
+            return limiter
+        if not limits:
+            self._limiters.pop(key, None)
+            return None
+        if limiter is None:
+            limiter = self._limiters[key] = Limiter(limits)
+        else:
+            limiter.configure(limits)
+        return limiter
+
+    def discard(self, key):
+        self._limiters.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._limiters)
+
+
+class Admission:
+    """通过准入的一次请求, 结束时 release() 归还并发名额"""
+    __slots__ = ("limiters",)
+
+    def __init__(self, limiters: List[Limiter]):
+        self.limiters = limiters
+
+    def release(self):
+        for limiter in self.limiters:
+            limiter.active -= 1
+
+    async def shape(self, size: int):
+        """按最慢的字节令牌桶等待"""
+        delay = 0.0
+        for limiter in self.limiters:
+            if limiter.bandwidth is not None:
+                delay = max(delay, limiter.bandwidth.reserve(size))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def shaping(self) -> bool:
+        return any(limiter.bandwidth is not None for limiter in self.limiters)
+
+    async def shape_chunks(self, chunks):
+        async for chunk in chunks:
+            await self.shape(len(chunk))
+            yield chunk
+
+
+class RateLimited(Exception):
+    def __init__(self, index: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.index = index  # 被拒绝的是第几个 Limiter
+        self.reason = reason  # "requests" 或 "concurrent"
+        self.retry_after = retry_after
+
+
+def admit(limiters: List[Limiter | None]) -> Admission:
+    """检查所有 Limiter (None 表示不限制), 全部通过时各占用一个并发名额;
+    否则抛出 RateLimited, 其 index 是被拒绝的 Limiter 在参数中的位置, 不留下任何占用"""
+    for index, limiter in enumerate(limiters):
+        if limiter is not None and limiter.concurrent is not None and limiter.active >= limiter.concurrent:
+            raise RateLimited(index, "concurrent", 1.0)
+    for index, limiter in enumerate(limiters):
+        if limiter is None or limiter.requests is None:
+            continue
+        wait = limiter.requests.take()
+        if wait:
+            # 退还已经从前面的桶取走的令牌
+            for taken in limiters[:index]:
+                if taken is not None and taken.requests is not None:
+                    taken.requests.refund()
+            raise RateLimited(index, "requests", wait)
+    admitted = [limiter for limiter in limiters if limiter is not None]
+    for limiter in admitted:
+        limiter.active += 1
+    return Admission(admitted)
+
+
+class KeyedBuckets:
+    """按键 (如 IP 或用户名) 的令牌桶, 最多保存 max_keys 个, 超出时淘汰最久未用的"""
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def take(self, key: str) -> float:
+        """取一个令牌, 返回 0 或需要等待的秒数"""
+        return self._bucket(key).take()
+
+    def wait(self, key: str) -> float:
+        """不取令牌, 只返回需要等待的秒数"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        bucket._refill(time.monotonic())
+        return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / bucket.rate
+
+
+_REJECTED_BODY = {
+    "requests": b'{"detail":"Too many requests"}',
+    "concurrent": b'{"detail":"Too many concurrent requests"}',
+}
+
+
+class AdmissionGate:
+    """ASGI 中间件, 在路由和解析请求之前准入
+
+    check(scope) 返回 Admission 或 None (不需要准入), 超出限额时抛出 RateLimited,
+    此时直接回复 429 (WebSocket 在接受前关闭). 通过的 Admission 放在 scope["state"]["admission"]
+    供处理函数整形, 整个 ASGI 调用结束 (响应发送完或 WebSocket 关闭) 后归还并发名额.
+    """
+    def __init__(self, app, check):
+        self.app = app
+        self.check = check
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        try:
+            admission = self.check(scope)
+        except RateLimited as e:
+            if scope["type"] == "websocket":
+                await send({"type": "websocket.close", "code": 1008})
+                return
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"retry-after", str(max(1, math.ceil(e.retry_after))).encode())
+                ]
+            })
+            await send({"type": "http.response.body", "body": _REJECTED_BODY[e.reason]})
+            return
+        if admission is None:
+            return await self.app(scope, receive, send)
+        scope = dict(scope)
+        scope["state"] = {**scope.get("state", {}), "admission": admission}
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
@@ -0,0 +1,380 @@
+"""
+隧道注册表
+
+ConnectionManager 在内存中维护隧道及其索引, 查找不经过注册表.
+多个 worker 同时服务时, 注册表保存它们共享的状态: 按隧道ID保存的隧道 (含自定义域名),
+以及每个客户端的 WebSocket 由哪个 worker 持有 (owner, 即该 worker 的内部地址, 按客户端ID保存).
+每次修改都分配一个递增的 version, 各 worker 定期拉取自己已知 version 之后的变化.
+删除以墓碑记录, 保留 TOMBSTONE_TTL 秒后清理.
+
+启动时 ConnectionManager 以 load() 一次取回全部隧道, 批量建立索引, 不逐条回放变化.
+之后 ConnectionManager 经 call() (等待结果) 和 submit() (不等待) 使用注册表: sqlite 后端的读写
+可能等待其他 worker 持有的锁, 都在注册表自己的一个线程中按提交顺序执行, 不占用事件循环.
+
+后端:
+    memory   不共享也不保存任何状态, 单进程部署的默认值
+    journal  单进程部署, 隧道保存在快照文件和追加写的日志中, 重启后恢复
+    sqlite   同一台机器上的多个 worker 共享一个 SQLite 文件 (WAL), 重启后同样恢复
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOMBSTONE_TTL = 3600
+# journal 后端: 日志中的记录数超过 max(该值, 2 * 隧道数) 时写新快照并清空日志
+JOURNAL_COMPACT_RECORDS = 10000
+
+
+def check_conflict(tunnel: dict, other: dict):
+    """tunnel 与另一个隧道 other 占用了相同的公网端口或域名时抛出 ValueError;
+    同一隧道组 (group 相同, 公网端口和域名都相同) 的成员可以共用"""
+    group = tunnel.get("group")
+    if (
+        group and other.get("group") == group
+        and other["public_port"] == tunnel["public_port"]
+        and other["custom_domain"] == tunnel["custom_domain"]
+    ):
+        return
+    if other["public_port"] == tunnel["public_port"]:
+        raise ValueError(f"Public port {tunnel['public_port']} is already in use")
+    raise ValueError(f"Custom domain {tunnel['custom_domain']} is already in use")
+
+
+def _log_failure(future: Future):
+    error = future.exception()
+    if error is not None:
+        logger.error("Tunnel registry write failed: %s", error)
+
+
+class TunnelRegistry:
+    """不共享的注册表, 所有方法都不做任何事; 共享后端继承并实现它们"""
+    shared = False
+
+    async def call(self, method: Callable, *args):
+        """执行注册表的一个方法并返回结果"""
+        return method(*args)
+
+    def submit(self, method: Callable, *args):
+        """执行注册表的一个方法, 不等待结果, 失败时只记录日志"""
+        try:
+            method(*args)
+        except Exception as e:
+            logger.error("Tunnel registry write failed: %s", e)
+
+    def put_tunnel(self, tunnel: dict):
+        """新增或更新隧道, 端口或域名已被其他隧道占用时抛出 ValueError (见 check_conflict)"""
+
+    def delete_tunnel(self, tunnel_id: str):
+        pass
+
+    def set_owner(self, client_id: str, address: str):
+        pass
+
+    def clear_owner(self, client_id: str, address: str):
+        """只有 owner 仍是 address 时才清除, 客户端可能已经重连到别的 worker"""
+
+    def clear_owners(self, address: str):
+        """worker 退出时清除它持有的所有客户端"""
+
+    def changes(self, since: int) -> Tuple[int, List[tuple], List[tuple]]:
+        """返回 (当前 version, [(隧道ID, 隧道或 None)], [(客户端ID, owner 或 None)])"""
+        return since, [], []
+
+    def load(self) -> Tuple[int, List[dict], List[tuple]]:
+        """返回 (当前 version, 全部隧道, [(客户端ID, owner)]), 用于启动时一次性恢复; 之后的变化由 changes 取得"""
+        return 0, [], []
+
+    def close(self):
+        pass
+
+
+class SqliteTunnelRegistry(TunnelRegistry):
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        # 手动管理事务, 写入用 BEGIN IMMEDIATE 在 worker 之间串行化 version;
+        # 启动时在主线程中载入, 之后只在 _executor 的线程中使用
+        self._conn = sqlite3.connect(path, isolation_level=None, timeout=5, check_same_thread=False)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tunnel-registry")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL);"
+            "INSERT OR IGNORE INTO meta VALUES (0, 0);"
+            "CREATE TABLE IF NOT EXISTS tunnels ("
+            "tunnel_id TEXT PRIMARY KEY, public_port INTEGER NOT NULL, custom_domain TEXT, "
+            "data TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0, "
+            "version INTEGER NOT NULL, updated_at REAL NOT NULL);"
+            # 隧道组的成员共用端口和域名, 冲突在写事务中由 check_conflict 检查
+            "DROP INDEX IF EXISTS tunnels_public_port;"
+            "DROP INDEX IF EXISTS tunnels_custom_domain;"
+            "CREATE INDEX IF NOT EXISTS tunnels_port ON tunnels(public_port) WHERE deleted = 0;"
+            "CREATE INDEX IF NOT EXISTS tunnels_domain ON tunnels(custom_domain) WHERE deleted = 0;"
+            "CREATE INDEX IF NOT EXISTS tunnels_version ON tunnels(version);"
+            "CREATE TABLE IF NOT EXISTS owners ("
+            "client_id TEXT PRIMARY KEY, address TEXT, version INTEGER NOT NULL, updated_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS owners_version ON owners(version);"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(tunnels)")]
+        if "client_id" in columns:
+            # 旧版本以客户端ID为键, 当时每个客户端只有一个隧道, 两者相同
+            self._conn.execute("ALTER TABLE tunnels RENAME COLUMN client_id TO tunnel_id")
+
+    async def call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    def submit(self, method, *args):
+        self._executor.submit(method, *args).add_done_callback(_log_failure)
+
+    def _write(self, sql: str, params: tuple = (), check=None):
+        """在一个写事务中分配新 version 并执行 sql, sql 的第一个参数是 version;
+        check(conn) 在写入前执行, 抛出异常时放弃写入"""
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if check is not None:
+                check(conn)
+            version = conn.execute("UPDATE meta SET version = version + 1 RETURNING version").fetchone()[0]
+            conn.execute(sql, (version, time.time()) + params)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put_tunnel(self, tunnel):
+        def check(conn):
+            # 其他 worker 刚注册, 本地还没同步到的冲突在这里拦下
+            # 用 UNION ALL 分别走两个索引, 写成 OR 时 SQLite 会扫描整张表
+            tunnel_id = tunnel["tunnel_id"]
+            for (data,) in conn.execute(
+                "SELECT data FROM tunnels WHERE deleted = 0 AND public_port = ? AND tunnel_id != ? UNION ALL "
+                "SELECT data FROM tunnels WHERE deleted = 0 AND custom_domain = ? AND tunnel_id != ?",
+                (tunnel["public_port"], tunnel_id, tunnel["custom_domain"] or None, tunnel_id)
+            ):
+                check_conflict(tunnel, json.loads(data))
+
+        self._write(
+            "INSERT INTO tunnels (version, updated_at, tunnel_id, public_port, custom_domain, data) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(tunnel_id) DO UPDATE SET "
+            "public_port = excluded.public_port, custom_domain = excluded.custom_domain, "
+            "data = excluded.data, deleted = 0, version = excluded.version, updated_at = excluded.updated_at",
+            (tunnel["tunnel_id"], tunnel["public_port"], tunnel["custom_domain"] or None, json.dumps(tunnel)),
+            check
+        )
+
+    def delete_tunnel(self, tunnel_id):
+        self._write(
+            "UPDATE tunnels SET deleted = 1, version = ?, updated_at = ? WHERE tunnel_id = ? AND deleted = 0",
+            (tunnel_id,)
+        )
+        self._conn.execute(
+            "DELETE FROM tunnels WHERE deleted = 1 AND updated_at < ?", (time.time() - TOMBSTONE_TTL,)
+        )
+
+    def set_owner(self, client_id, address):
+        self._write(
+            "INSERT INTO owners (version, updated_at, client_id, address) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(client_id) DO UPDATE SET "
+            "address = excluded.address, version = excluded.version, updated_at = excluded.updated_at",
+            (client_id, address)
+        )
+
+    def clear_owner(self, client_id, address):
+        self._write(
+            "UPDATE owners SET address = NULL, version = ?, updated_at = ? WHERE client_id = ? AND address = ?",
+            (client_id, address)
+        )
+        self._conn.execute(
+            "DELETE FROM owners WHERE address IS NULL AND updated_at < ?", (time.time() - TOMBSTONE_TTL,)
+        )
+
+    def clear_owners(self, address):
+        self._write(
+            "UPDATE owners SET address = NULL, version = ?, updated_at = ? WHERE address = ?",
+            (address,)
+        )
+
+    def changes(self, since):
+        conn = self._conn
+        # 在同一个读事务里取 version 和变化, WAL 下不阻塞写入
+        conn.execute("BEGIN")
+        try:
+            version = conn.execute("SELECT version FROM meta").fetchone()[0]
+            tunnels = [
+                (tunnel_id, None if deleted else json.loads(data))
+                for tunnel_id, data, deleted in conn.execute(
+                    "SELECT tunnel_id, data, deleted FROM tunnels "
+                    "WHERE version > ? AND version <= ? ORDER BY version",
+                    (since, version)
+                )
+            ]
+            owners = conn.execute(
+                "SELECT client_id, address FROM owners WHERE version > ? AND version <= ? ORDER BY version",
+                (since, version)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        return version, tunnels, owners
+
+    def load(self):
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            version = conn.execute("SELECT version FROM meta").fetchone()[0]
+            tunnels = [
+                _upgrade(tunnel_id, json.loads(data))
+                for tunnel_id, data in conn.execute(
+                    "SELECT tunnel_id, data FROM tunnels WHERE deleted = 0 AND version <= ?", (version,)
+                )
+            ]
+            owners = conn.execute(
+                "SELECT client_id, address FROM owners WHERE address IS NOT NULL AND version <= ?", (version,)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        return version, tunnels, owners
+
+    def close(self):
+        # 先执行完已提交的写入
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+
+class JournalTunnelRegistry(TunnelRegistry):
+    """单进程的持久化注册表: path 为追加写的 JSON 行日志, path.snapshot 为快照
+
+    日志每行是 {"put": 隧道} 或 {"delete": 隧道ID}, 启动时在快照上按顺序重放;
+    每条修改写入后立即 flush, 进程崩溃不会丢失, 关闭和压缩时 fsync.
+    压缩时把日志改名为 path.compacting, 换一个新日志继续追加, 在后台线程中写新快照,
+    原子替换后再删除 path.compacting; 中途崩溃时启动按 快照, path.compacting, path 的顺序重放,
+    新快照已包含的记录再重放一遍结果相同.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.compacting_path = path + ".compacting"
+        self._tunnels: Dict[str, dict] = {}
+        self._records = 0  # 日志中的记录数
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tunnel-journal")
+        self._compaction: Future | None = None
+        self._load_files()
+        self._file = open(self.path, "ab")
+
+    def _load_files(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                for tunnel in json.load(f)["tunnels"]:
+                    self._tunnels[tunnel["tunnel_id"]] = tunnel
+        # 上次压缩没有完成时留下的日志
+        compacting = os.path.exists(self.compacting_path)
+        if compacting:
+            self._replay(self.compacting_path)
+        self._replay(self.path)
+        if compacting or self._records > max(JOURNAL_COMPACT_RECORDS, 2 * len(self._tunnels)):
+            # 启动时还没有开始服务, 直接压缩
+            self._compact(list(self._tunnels.values()))
+            with open(self.path, "wb"):
+                pass
+            self._records = 0
+
+    def _replay(self, path: str):
+        if not os.path.exists(path):
+            return
+        good_offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的最后一行, 丢弃
+                    logger.warning("Discarding torn record at offset %s in %s", good_offset, path)
+                    break
+                if "put" in record:
+                    self._tunnels[record["put"]["tunnel_id"]] = record["put"]
+                else:
+                    self._tunnels.pop(record["delete"], None)
+                self._records += 1
+                good_offset += len(line)
+        with open(path, "r+b") as f:
+            f.truncate(good_offset)
+
+    def _append(self, record: dict):
+        self._file.write(json.dumps(record).encode() + b"\n")
+        self._file.flush()
+        self._records += 1
+        if self._records > max(JOURNAL_COMPACT_RECORDS, 2 * len(self._tunnels)):
+            self._start_compaction()
+
+    def _start_compaction(self):
+        """在调用者的线程中换日志并复制隧道表, 快照在后台线程中写入, 期间修改照常追加"""
+        if self._compaction is not None and not self._compaction.done():
+            return
+        if not os.path.exists(self.compacting_path):
+            self._file.close()
+            os.replace(self.path, self.compacting_path)
+            self._file = open(self.path, "ab")
+            self._records = 0
+        # 否则上次压缩失败, path.compacting 还在; 不换日志, 新快照同样包含 path 中已有的记录
+        self._compaction = self._executor.submit(self._compact, list(self._tunnels.values()))
+        self._compaction.add_done_callback(_log_failure)
+
+    def _compact(self, tunnels: List[dict]):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"tunnels": tunnels}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+        logger.info("Compacted tunnel journal %s (%d tunnels)", self.path, len(tunnels))
+
+    def put_tunnel(self, tunnel):
+        # 单进程部署, 冲突已由 ConnectionManager 在内存中检查
+        self._tunnels[tunnel["tunnel_id"]] = tunnel
+        self._append({"put": tunnel})
+
+    def delete_tunnel(self, tunnel_id):
+        if self._tunnels.pop(tunnel_id, None) is not None:
+            self._append({"delete": tunnel_id})
+
+    def load(self):
+        return 0, [_upgrade(tunnel_id, tunnel) for tunnel_id, tunnel in self._tunnels.items()], []
+
+    def close(self):
+        # 等后台的压缩写完快照
+        self._executor.shutdown(wait=True)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def _upgrade(tunnel_id: str, tunnel: dict) -> dict:
+    """旧版本写入的隧道没有 tunnel_id, 当时隧道ID就是客户端ID"""
+    if "tunnel_id" not in tunnel:
+        tunnel = {**tunnel, "tunnel_id": tunnel_id, "name": None}
+    return tunnel
+
+
+BACKENDS = {
+    "memory": lambda path: TunnelRegistry(),
+    "journal": lambda path: JournalTunnelRegistry(path or "tunnels.journal"),
+    "sqlite": lambda path: SqliteTunnelRegistry(path or "tunnels.db"),
+}
+
+
+def open_registry(kind: str, path: str | None = None) -> TunnelRegistry:
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown tunnel registry: {kind}")
+    registry = BACKENDS[kind](path)
+    if registry.shared:
+        logger.info("Using shared tunnel registry at %s", path or "tunnels.db")
+    return registry
@@ -1,12 +1,19 @@
 import asyncio
 import json
 import logging
+import math
 import os
-from typing import Dict, Set
+import re
+import secrets
+import time
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+from typing import Callable, Dict, List, Set, Tuple
 import uuid
-import websockets
-from fastapi import FastAPI, WebSocket, HTTPException, Depends, Request, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request, Response
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer
@@ -16,31 +23,129 @@ from passlib.context import CryptContext
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import aiohttp
+from protocol import (
+    HOP_BY_HOP_HEADERS, Multiplexer, Stream, StreamReset,
+    encode_request_head, decode_response_head, encode_response_head, decode_routed_head
+)
+from tcp_tunnel import TcpListeners
+from registry import check_conflict, open_registry
+from balancer import Backend, TunnelGroup
+from cluster import CLUSTER_PORT, PeerLinks
+from host_router import DomainTrie, HostRouter, domain_covers, normalize_domain, normalize_host
+from compression import add_vary, choose_encoding, compress_stream, encoded_headers, is_compressible
+from edge_cache import EdgeCache
+from session import SESSION_GRACE_PERIOD, ResumableLink
+from codec import FRAME_COMPRESSION, FRAME_COMPRESSION_LEVEL, decode_message, encode_message, is_control, negotiate
+from rate_limit import AdmissionGate, KeyedBuckets, Limiters, RateLimited, admit, check_within, validate_limits
+from ws_bridge import (
+    WEBSOCKET_METHOD, WS_MAX_MESSAGE_SIZE, WS_PROXY_HEARTBEAT,
+    AiohttpEndpoint, StarletteEndpoint, StreamEndpoint, bridge, handshake_headers
+)
+from user_store import open_user_store
+from log_config import AccessLog, setup_logging
+from metrics import Registry
+from admin_feed import RESYNC, AdminFeed
+from drain import DRAIN_TIMEOUT, DrainGate, InFlight, serve, steer_away
+from diagnostics import (
+    PROFILE_MAX_SECONDS, STALL_THRESHOLD, TIMING_HISTORY, Profiler, StallDetector, TimingGate, Timings,
+    mark_connected, mark_forward, record_route, tag_tunnel, top_functions, top_stacks
+)
 
 # 加载环境变量
 load_dotenv()
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 配置日志, 写日志在后台线程完成
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+proxy_logger = logging.getLogger(f"{__name__}.proxy")
+access_log = AccessLog(logging.getLogger(f"{__name__}.access"))
 
-# FastAPI应用
-app = FastAPI()
+# FastAPI应用, 每个路由都记录处理函数名供请求耗时汇总
+app = FastAPI(dependencies=[Depends(record_route)])
 
 # 模板引擎
 templates = Jinja2Templates(directory="templates")
 
 # 静态文件
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
 
 # 安全相关配置
 SECRET_KEY = os.getenv("JWT_SECRET", "your-secret-key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 10000))  # 为 0 时不缓存
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 低于 BCRYPT_ROUNDS 的旧哈希会在用户登录时自动重新计算
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# 登录限流: 每个 IP 的尝试次数, 以及每个用户名的失败次数, 速率为 0 时不限制
+LOGIN_RATE = float(os.getenv("LOGIN_RATE", 1))
+LOGIN_BURST = int(os.getenv("LOGIN_BURST", 10))
+LOGIN_FAILURE_RATE = float(os.getenv("LOGIN_FAILURE_RATE", 0.1))
+LOGIN_FAILURE_BURST = int(os.getenv("LOGIN_FAILURE_BURST", 5))
+
+# 密码哈希线程池配置
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", 32))
+
+# 上游连接池配置
+UPSTREAM_HOST = os.getenv("UPSTREAM_HOST", "localhost")
+UPSTREAM_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_LIMIT_PER_HOST", 100))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", 30))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", 10))
+PROXY_CHUNK_SIZE = int(os.getenv("PROXY_CHUNK_SIZE", 64 * 1024))
+
+# 是否为每个隧道的公网端口打开 TCP 监听
+TCP_TUNNELS_ENABLED = os.getenv("TCP_TUNNELS_ENABLED", "true").lower() == "true"
+
+# 服务端监听的端口; 以 uvicorn 命令行启动时也要设置, 隧道不能使用它
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8080))
+# 隧道不能使用的其他公网端口, 逗号分隔的端口或区间, 如 "1-1023,9090"
+RESERVED_PORTS = os.getenv("RESERVED_PORTS", "1-1023")
+# 以 SO_REUSEPORT 接替仍在运行的旧进程 (见 drain.py)
+SERVER_HANDOFF = os.getenv("SERVER_HANDOFF", "false").lower() == "true"
+
+# 熔断与健康探测配置
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", 3))
+HEALTH_COOLDOWN = float(os.getenv("HEALTH_COOLDOWN", 5))
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", 5))
+
+# 指标配置
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # 设置后抓取 /metrics 需要携带该 Bearer 令牌
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+
+# 诊断 (见 diagnostics.py): 事件循环卡顿检测和请求耗时记录
+DIAGNOSTICS_ENABLED = os.getenv("DIAGNOSTICS_ENABLED", "true").lower() == "true"
+
+# 自动分配的子域名: 设置后 {public_port}.{TUNNEL_BASE_DOMAIN} 路由到对应隧道
+TUNNEL_BASE_DOMAIN = os.getenv("TUNNEL_BASE_DOMAIN", "").strip().lower().strip(".")
+# 服务端自己的主机名 (管理面板和 API), 逗号分隔; 不按 Host 路由到隧道, 隧道也不能注册
+# TUNNEL_BASE_DOMAIN 总是包含在内
+SERVER_HOSTNAMES = os.getenv("SERVER_HOSTNAMES", "localhost")
+
+# 多 worker 共享的隧道注册表, memory 表示不共享
+TUNNEL_REGISTRY = os.getenv("TUNNEL_REGISTRY", "memory")  # memory, journal 或 sqlite
+TUNNEL_REGISTRY_PATH = os.getenv("TUNNEL_REGISTRY_PATH")  # 为空时为 tunnels.journal 或 tunnels.db
+REGISTRY_SYNC_INTERVAL = float(os.getenv("REGISTRY_SYNC_INTERVAL", 0.5))
+
+# 边缘缓存配置, 只对开启了 cache 的隧道生效
+CACHE_MEMORY_BYTES = int(os.getenv("CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", 8 * 1024 * 1024))
+CACHE_DIR = os.getenv("CACHE_DIR")  # 设置后从内存淘汰的条目写入该目录
+CACHE_DISK_BYTES = int(os.getenv("CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+
+# 管理面板推送配置
+ADMIN_FEED_INTERVAL = float(os.getenv("ADMIN_FEED_INTERVAL", 1))
+ADMIN_FEED_QUEUE_SIZE = int(os.getenv("ADMIN_FEED_QUEUE_SIZE", 8))
+
 # 数据模型
 class Token(BaseModel):
     access_token: str
@@ -52,6 +157,7 @@ class TokenData(BaseModel):
 class User(BaseModel):
     username: str
     disabled: bool | None = None
+    admin: bool = False  # 可以设置限额和使用诊断接口
 
 class UserInDB(User):
     hashed_password: str
@@ -65,104 +171,1168 @@ class UserLogin(BaseModel):
     password: str
 
 # 用户数据存储
-def load_users():
-    try:
-        with open('users.json', 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果文件不存在，创建默认管理员账户
-        default_users = {
-            "admin": {
-                "username": "admin",
-                "hashed_password": get_password_hash("admin"),
-                "disabled": False
-            }
-        }
-        save_users(default_users)
-        return default_users
+USER_STORE = os.getenv("USER_STORE", "sqlite")  # sqlite, log 或 json
+USER_STORE_PATH = os.getenv("USER_STORE_PATH")  # 为空时使用各后端的默认文件
+# 同样视为管理员的用户名, 逗号分隔, 用于旧存储中没有 admin 标记的账户; 这些用户名不能注册
+ADMIN_USERS = {name.strip() for name in os.getenv("ADMIN_USERS", "admin").split(",") if name.strip()}
 
-def save_users(users):
-    with open('users.json', 'w') as f:
-        json.dump(users, f, indent=4)
+def default_users():
+    # 存储为空且没有 users.json 可导入时，创建默认管理员账户
+    return {
+        "admin": {
+            "username": "admin",
+            "hashed_password": pwd_context.hash("admin"),
+            "disabled": False,
+            "admin": True
+        }
+    }
 
 # 初始化用户数据
-users_db = load_users()
+user_store = open_user_store(USER_STORE, USER_STORE_PATH, default_users)
+
+# 指标, 隧道相关的指标以公网端口为第一个标签
+metrics = Registry()
+tunnel_requests = metrics.counter(
+    "tunnel_requests_total", "HTTP requests proxied per tunnel by status class",
+    ["public_port", "code"]
+)
+tunnel_bytes_received = metrics.counter(
+    "tunnel_received_bytes_total", "Bytes received from visitors per tunnel",
+    ["public_port", "protocol"]
+)
+tunnel_bytes_sent = metrics.counter(
+    "tunnel_sent_bytes_total", "Bytes sent to visitors per tunnel",
+    ["public_port", "protocol"]
+)
+upstream_latency = metrics.histogram(
+    "tunnel_upstream_latency_seconds", "Time until the upstream response head arrived",
+    ["public_port"]
+)
+cache_requests = metrics.counter(
+    "edge_cache_requests_total", "Edge cache lookups per tunnel by result",
+    ["public_port", "result"]
+)
+rate_limited = metrics.counter(
+    "tunnel_rate_limited_total", "Requests rejected by tunnel or user limits",
+    ["public_port", "scope", "reason"]
+)
+group_ejections = metrics.counter(
+    "tunnel_group_ejections_total", "Tunnel group members ejected after repeated failures",
+    ["public_port"]
+)
+login_throttled = metrics.counter("login_throttled_total", "Login attempts rejected by throttling")
+cache_evictions = metrics.counter(
+    "edge_cache_evictions_total", "Entries evicted from an edge cache tier", ["tier"]
+)
+metrics.gauge("edge_cache_memory_bytes", "Bytes held in the in-memory edge cache").set_function(
+    lambda: edge_cache.memory_size
+)
+metrics.gauge("edge_cache_disk_bytes", "Bytes held in the on-disk edge cache").set_function(
+    lambda: edge_cache.disk_size
+)
+metrics.gauge("edge_cache_entries", "Entries in the edge cache across tiers").set_function(
+    lambda: len(edge_cache)
+)
+event_loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "Extra delay of a periodic timer on the event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+event_loop_stalls = metrics.counter(
+    "event_loop_stalls_total", "Event loop stalls longer than STALL_THRESHOLD"
+)
+metrics.gauge("websocket_connections", "Connected tunnel clients").set_function(
+    lambda: len(manager.active_connections)
+)
+metrics.gauge("tunnels", "Registered tunnels").set_function(lambda: len(manager.tunnels))
+metrics.gauge("mux_streams", "Open multiplexed streams over client WebSockets").set_function(
+    lambda: sum(len(mux.streams) for mux in manager.multiplexers.values())
+)
+metrics.gauge("requests_in_flight", "Proxied requests and WebSockets still running").set_function(
+    lambda: in_flight.count()
+)
+metrics.gauge("tcp_connections", "Open raw TCP tunnel connections").set_function(
+    lambda: manager.tcp_listeners.connection_count() if manager.tcp_listeners is not None else 0
+)
+
+def tcp_traffic_counters(public_port: int):
+    """TCP 连接的收发字节计数器, 关闭指标时返回 None"""
+    if not METRICS_ENABLED:
+        return None
+    return (
+        tunnel_bytes_received.labels(public_port, "tcp"),
+        tunnel_bytes_sent.labels(public_port, "tcp")
+    )
+
+def forget_tunnel_metrics(public_port: int):
+    """隧道删除后丢弃它的指标, 避免标签无限增长"""
+    for metric in (
+        tunnel_requests, tunnel_bytes_received, tunnel_bytes_sent, upstream_latency, cache_requests, rate_limited,
+        group_ejections
+    ):
+        metric.remove(public_port)
+
+async def sample_loop_lag():
+    """定时睡眠并测量实际唤醒的延迟, 反映事件循环被阻塞的程度"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        event_loop_lag.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
 
 # 连接管理
+TUNNEL_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def parse_port_ranges(text: str) -> List[Tuple[int, int]]:
+    """解析 "1-1023,9090" 形式的端口列表, 返回 (起, 止) 区间"""
+    ranges = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        ranges.append((int(low), int(high or low)))
+    return ranges
+
+def tunnel_key(client_id: str, name: str | None) -> str:
+    """隧道ID: 带名称的隧道为 "{客户端ID}.{名称}", 否则就是客户端ID"""
+    return f"{client_id}.{name}" if name is not None else client_id
+
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, tcp_listeners: TcpListeners | None = None, registry=None):
+        self.tcp_listeners = tcp_listeners  # 为空时不监听公网端口
+        self.registry = registry if registry is not None else open_registry("memory")
+        self.registry_version = 0  # 已应用到本地索引的注册表 version
+        self._sync_lock = asyncio.Lock()
+        self._synced_at = 0.0  # 最近一轮同步开始的时间 (monotonic)
+        self.address: str | None = None  # 本 worker 的内部地址, 共享注册表时在启动后设置
+        self.owners: Dict[str, str] = {}  # 连在其他 worker 上的客户端ID到该 worker 的地址
         self.active_connections: Dict[str, WebSocket] = {}
-        self.tunnels: Dict[str, Dict] = {}
-        self.domain_mappings: Dict[str, str] = {}  # 域名到客户端ID的映射
+        self.tunnels: Dict[str, Dict] = {}  # 隧道ID到隧道, 隧道的 client_id 是服务它的客户端
+        self.domain_mappings: Dict[str, str] = {}  # 域名到隧道ID的映射
+        self.domain_trie = DomainTrie()  # 与 domain_mappings 同步, 支持通配符的 Host 匹配
+        # 二级索引, 注册/删除/断开时同步更新, 保证查找为 O(1)
+        self.port_index: Dict[int, str] = {}  # 公网端口到隧道ID的映射, 隧道组为其中一个成员
+        self.client_tunnels: Dict[str, Set[str]] = {}  # 客户端ID到它的隧道ID
+        self.groups: Dict[int, TunnelGroup] = {}  # 公网端口到隧道组 (见 balancer.py)
+        self.local_port_refs: Dict[int, int] = {}  # 本地端口被多少条隧道引用
+        self.multiplexers: Dict[str, Multiplexer] = {}  # 客户端ID到多路复用器
+        # 客户端会话 (见 session.py), 断开后在宽限期内保留, 期间多路复用器仍可打开流
+        self.sessions: Dict[str, Tuple[str, ResumableLink]] = {}  # 客户端ID到 (令牌, 链路)
+        self.grace_timers: Dict[str, asyncio.TimerHandle] = {}  # 处于宽限期的会话
+        self.listeners: List[Callable[[str], None]] = []  # 隧道或其客户端的连接变化时以隧道ID调用
+        self.eject_listeners: List[Callable[[int, str], None]] = []  # 隧道组成员被摘除时以 (公网端口, 隧道ID) 调用
+        self.reserved_ports: List[Tuple[int, int]] = []  # 隧道不能使用的公网端口区间
+        self.server_hosts: Set[str] = set()  # 隧道的域名不能匹配的服务端主机名
         
-    async def connect(self, client_id: str, websocket: WebSocket):
+    async def connect(
+        self,
+        client_id: str,
+        websocket: WebSocket,
+        token: str | None = None,
+        received: int = 0,
+        codec: int = 0,
+        compression: bool = False
+    ):
+        """接受客户端连接; 带有效令牌时续传原来的会话, 否则开始新会话. 返回该会话的链路
+
+        codec/compression 是这条连接协商好的控制消息编码版本和是否压缩数据帧 (见 codec.py)"""
         await websocket.accept()
+        # 旧连接可能还没发现自己已断开 (半开连接), 由新连接取代
+        stale = self.active_connections.pop(client_id, None)
+        session = self.sessions.get(client_id)
+        resumed = session is not None and token is not None and secrets.compare_digest(session[0], token)
+        if not resumed:
+            if session is not None:
+                self._end_session(client_id)
+            session = (secrets.token_urlsafe(16), ResumableLink())
+            self.sessions[client_id] = session
+            self.multiplexers[client_id] = Multiplexer(session[1].send)
+        timer = self.grace_timers.pop(client_id, None)
+        if timer is not None:
+            timer.cancel()
         self.active_connections[client_id] = websocket
-        logger.info(f"Client {client_id} connected")
+        token, link = session
+        link.detach()
+        self.multiplexers[client_id].compress_level = FRAME_COMPRESSION_LEVEL if compression else None
+        # 第一条消息始终是 JSON, 客户端据此得知协商结果
+        await websocket.send_text(json.dumps({
+            "type": "session",
+            "token": token,
+            "resumed": resumed,
+            "received": link.received,
+            "grace": SESSION_GRACE_PERIOD,
+            "codec": codec,
+            "compression": "zlib" if compression else None
+        }))
+        await link.attach(websocket.send_bytes, received if resumed else 0)
+        if stale is not None:
+            try:
+                await stale.close(code=1001)
+            except RuntimeError:
+                pass
+        self.registry.submit(self.registry.set_owner, client_id, self.address)
+        self._notify_client(client_id)
+        logger.info("Client %s %s", client_id, "resumed its session" if resumed else "connected")
+        return link
+        
+    def disconnect(self, client_id: str, websocket: WebSocket | None = None):
+        """连接断开后会话进入宽限期; websocket 不是当前连接时 (已被续传的新连接取代) 不做任何事"""
+        current = self.active_connections.get(client_id)
+        if current is None or (websocket is not None and current is not websocket):
+            return
+        del self.active_connections[client_id]
+        session = self.sessions.get(client_id)
+        if session is None or SESSION_GRACE_PERIOD <= 0:
+            self._end_session(client_id)
+            return
+        session[1].detach()
+        self.grace_timers[client_id] = asyncio.get_running_loop().call_later(
+            SESSION_GRACE_PERIOD, self._end_session, client_id
+        )
+        self._notify_client(client_id)
+        logger.info("Client %s disconnected, holding its session for %ss", client_id, SESSION_GRACE_PERIOD)
         
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
+    def _end_session(self, client_id: str):
+        """会话结束: 未完成的流失败, 撤下域名映射和 TCP 监听, 等客户端重新注册"""
+        timer = self.grace_timers.pop(client_id, None)
+        if timer is not None:
+            timer.cancel()
+        session = self.sessions.pop(client_id, None)
+        if session is not None:
+            session[1].close()
+        self.active_connections.pop(client_id, None)
+        # 未完成的转发请求立即失败
+        mux = self.multiplexers.pop(client_id, None)
+        if mux is not None:
+            mux.close()
+        for tunnel_id in self.client_tunnels.get(client_id, ()):
+            tunnel = self.tunnels[tunnel_id]
+            # 隧道组中还有在线的成员时由它接替, 端口和域名照常服务
+            successor = self._online_member(tunnel, client_id)
             # 删除相关的域名映射
-            for domain, cid in list(self.domain_mappings.items()):
-                if cid == client_id:
-                    del self.domain_mappings[domain]
-            logger.info(f"Client {client_id} disconnected")
+            domain = tunnel["custom_domain"]
+            if domain and self.domain_mappings.get(domain) == tunnel_id:
+                self._map_domain(domain, successor)
+            # 关闭该客户端的 TCP 监听, 重新注册时再打开
+            if successor is None and self.tcp_listeners is not None:
+                self.tcp_listeners.close(tunnel["public_port"])
+        self.registry.submit(self.registry.clear_owner, client_id, self.address)
+        self._notify_client(client_id)
+        logger.info("Client %s disconnected", client_id)
             
     async def broadcast(self, message: str):
         for connection in self.active_connections.values():
             await connection.send_text(message)
             
-    def register_tunnel(self, client_id: str, local_port: int, public_port: int, custom_domain: str = None):
-        """注册一个新的隧道"""
-        logger.info(f"Registering new tunnel: client_id={client_id}, local_port={local_port}, public_port={public_port}, custom_domain={custom_domain}")
-        logger.info(f"Current tunnels before registration: {self.tunnels}")
-        
-        # 检查端口是否已被使用
-        for existing_id, tunnel in self.tunnels.items():
-            if tunnel["public_port"] == public_port:
-                logger.error(f"Public port {public_port} is already in use by tunnel {existing_id}")
-                raise ValueError(f"Public port {public_port} is already in use")
-        
-        # 创建新的隧道
-        self.tunnels[client_id] = {
+    async def register_tunnel(
+        self,
+        client_id: str,
+        local_port: int,
+        public_port: int,
+        custom_domain: str = None,
+        cache: bool = False,
+        compress: bool = False,
+        owner: str | None = None,
+        limits: dict | None = None,
+        name: str | None = None,
+        group: str | None = None
+    ):
+        """注册一个新的隧道, 返回隧道信息
+
+        name 是客户端为自己的某个隧道取的名称, 一个客户端可以注册多个; 没有名称时
+        隧道ID就是客户端ID (经 API 创建的隧道, 或只有一个隧道的旧客户端).
+        group 相同且公网端口和域名都相同的隧道组成隧道组, 请求在其中负载均衡;
+        隧道组的缓存, 压缩和限额设置以端口当前指向的成员为准.
+        owner 是经 API 创建隧道的用户名, 该用户的限额对其所有隧道合计生效;
+        客户端重新注册时不带 owner 和 limits, 沿用之前的值
+        """
+        tunnel_id = tunnel_key(client_id, name)
+        logger.info(
+            "Registering new tunnel: tunnel_id=%s, local_port=%s, public_port=%s, custom_domain=%s",
+            tunnel_id, local_port, public_port, custom_domain
+        )
+        
+        if custom_domain:
+            custom_domain = normalize_domain(custom_domain)
+        try:
+            self.check_reserved(public_port, custom_domain)
+        except ValueError as e:
+            logger.warning("Tunnel %s rejected: %s", tunnel_id, e)
+            raise
+        
+        previous = self.tunnels.get(tunnel_id) or {}
+        tunnel = {
+            "tunnel_id": tunnel_id,
+            "client_id": client_id,
+            "name": name,
+            "group": group or None,
             "local_port": local_port,
             "public_port": public_port,
             "custom_domain": custom_domain,
+            "cache": bool(cache),  # 开启边缘缓存
+            "compress": bool(compress),  # 按需压缩文本响应
+            "owner": owner if owner is not None else previous.get("owner"),
+            "limits": limits if limits is not None else previous.get("limits"),  # 见 rate_limit.py
             "created_at": datetime.now().isoformat()
         }
         
-        if custom_domain:
-            self.domain_mappings[custom_domain] = client_id
+        # 检查端口和域名是否已被其他隧道使用, 同一隧道重复注册视为更新, 同一隧道组的成员可以共用
+        for holder in (self.port_index.get(public_port), self.domain_mappings.get(custom_domain)):
+            if holder is not None and holder != tunnel_id:
+                try:
+                    check_conflict(tunnel, self.tunnels[holder])
+                except ValueError as e:
+                    logger.error("%s (held by tunnel %s)", e, holder)
+                    raise
+        # 共享注册表在写事务中再检查一次, 拦下其他 worker 刚注册、本地还没同步到的冲突
+        await self.registry.call(self.registry.put_tunnel, tunnel)
+        
+        # 校验通过后再修改, 避免索引处于中间状态
+        old = self._unindex_tunnel(tunnel_id)
+        if old is not None and old["public_port"] != public_port:
+            self._close_listener(old["public_port"])
+        self._index_tunnel(tunnel)
+        
+        # 端口被其他进程占用时仍可经 /proxy 访问, 只记录警告
+        if self.tcp_listeners is not None:
+            try:
+                self.tcp_listeners.open(public_port)
+            except OSError as e:
+                logger.warning("Cannot listen on public port %s: %s", public_port, e)
             
-        logger.info(f"Tunnel registered successfully. Current tunnels: {self.tunnels}")
+        self._notify(tunnel_id)
+        logger.info("Tunnel registered successfully: %s", tunnel_id)
+        return tunnel
         
-    def get_tunnel_info(self, client_id: str):
+    async def set_tunnel_limits(self, tunnel_id: str, limits: dict | None):
+        """修改隧道的限额, 隧道不存在时返回 None; 换成新的隧道字典, 限流器据此重新配置"""
+        tunnel = self.tunnels.get(tunnel_id)
+        if tunnel is None:
+            return None
+        tunnel = {**tunnel, "limits": limits}
+        await self.registry.call(self.registry.put_tunnel, tunnel)
+        if tunnel_id not in self.tunnels:
+            # 等待写入期间已被删除, 删除在注册表中排在这次写入之后
+            return None
+        self.tunnels[tunnel_id] = tunnel
+        self._notify(tunnel_id)
+        return tunnel
+        
+    def remove_tunnel(self, tunnel_id: str):
+        """删除隧道并同步清理索引, 返回被删除的隧道信息"""
+        tunnel = self._unindex_tunnel(tunnel_id)
+        if tunnel is not None:
+            self.registry.submit(self.registry.delete_tunnel, tunnel_id)
+            self._close_listener(tunnel["public_port"])
+            self._notify(tunnel_id)
+        return tunnel
+        
+    def retain_client_tunnels(self, client_id: str, names):
+        """客户端开始新会话时告知它现在的全部隧道名称, 删除其余的隧道 (断线期间从配置中移除的);
+        返回被删除的隧道"""
+        stale = [
+            tunnel_id for tunnel_id in self.client_tunnels.get(client_id, ())
+            if self.tunnels[tunnel_id]["name"] not in names
+        ]
+        return [self.remove_tunnel(tunnel_id) for tunnel_id in stale]
+
+    def restore(self) -> List[dict]:
+        """启动时从注册表一次性载入全部隧道, 只建立内存索引, 不逐个通知也不打开 TCP 监听; 返回载入的隧道"""
+        version, tunnels, owners = self.registry.load()
+        kept = []
+        for tunnel in tunnels:
+            try:
+                self.check_reserved(tunnel["public_port"], tunnel["custom_domain"])
+            except ValueError as e:
+                # 保留端口或主机名是后来才设置的, 或者注册表来自旧版本
+                logger.warning("Dropping tunnel %s: %s", tunnel["tunnel_id"], e)
+                self.registry.submit(self.registry.delete_tunnel, tunnel["tunnel_id"])
+                continue
+            kept.append(tunnel)
+        tunnels = kept
+        for tunnel in tunnels:
+            self._index_tunnel(tunnel)
+        for client_id, address in owners:
+            if address != self.address:
+                self.owners[client_id] = address
+        self.registry_version = version
+        return tunnels
+
+    async def open_listeners(self, ports, batch: int = 256):
+        """在后台分批打开恢复的隧道的 TCP 监听, 每批之间让出事件循环, 启动不必等它们全部就绪"""
+        if self.tcp_listeners is None:
+            return
+        for index, public_port in enumerate(ports):
+            if public_port not in self.port_index:
+                # 恢复之后已被删除
+                continue
+            try:
+                self.tcp_listeners.open(public_port)
+            except OSError as e:
+                logger.warning("Cannot listen on public port %s: %s", public_port, e)
+            if index % batch == batch - 1:
+                await asyncio.sleep(0)
+
+    async def sync(self):
+        """把其他 worker 在注册表中做的修改应用到本地索引
+
+        读取在注册表的线程中执行; 同时到达的多次同步合并: 等锁期间已经开始了新一轮时,
+        那一轮能看到调用之前的全部修改, 直接返回
+        """
+        requested = time.monotonic()
+        async with self._sync_lock:
+            if self._synced_at >= requested:
+                return
+            self._synced_at = time.monotonic()
+            version, tunnels, owners = await self.registry.call(self.registry.changes, self.registry_version)
+            self._apply_changes(version, tunnels, owners)
+
+    def _apply_changes(self, version: int, tunnels: List[tuple], owners: List[tuple]):
+        self.registry_version = version
+        for tunnel_id, tunnel in tunnels:
+            self._apply_remote_tunnel(tunnel_id, tunnel)
+        for client_id, address in owners:
+            if address is None or address == self.address:
+                changed = self.owners.pop(client_id, None) is not None
+            else:
+                changed = self.owners.get(client_id) != address
+                self.owners[client_id] = address
+                if client_id in self.grace_timers:
+                    # 客户端已在其他 worker 上开始新会话, 本地保留的会话不会再续传
+                    self._end_session(client_id)
+            if changed:
+                self._notify_client(client_id)
+
+    def _apply_remote_tunnel(self, tunnel_id: str, tunnel: dict | None):
+        if tunnel is not None and "tunnel_id" not in tunnel:
+            # 旧版本写入的隧道, 隧道ID就是客户端ID
+            tunnel = {**tunnel, "tunnel_id": tunnel_id, "name": None}
+        old = self.tunnels.get(tunnel_id)
+        if old == tunnel:
+            # 本 worker 自己的修改
+            return
+        old = self._unindex_tunnel(tunnel_id)
+        if old is not None and (tunnel is None or old["public_port"] != tunnel["public_port"]):
+            self._close_listener(old["public_port"])
+        if tunnel is not None:
+            self._index_tunnel(tunnel)
+        self._notify(tunnel_id)
+        
+    def _notify(self, tunnel_id: str):
+        for listener in self.listeners:
+            listener(tunnel_id)
+            
+    def _notify_client(self, client_id: str):
+        """客户端连接状态变化, 它的每个隧道都算变化"""
+        for tunnel_id in list(self.client_tunnels.get(client_id, ())):
+            self._notify(tunnel_id)
+        
+    def _close_listener(self, public_port: int):
+        """端口上已经没有隧道 (隧道组的最后一个成员也已删除) 时停止监听, 已有连接排空后再断开"""
+        if self.tcp_listeners is not None and public_port not in self.port_index:
+            self.tcp_listeners.close(public_port, DRAIN_TIMEOUT)
+            
+    def _map_domain(self, domain: str, tunnel_id: str | None):
+        """域名改为指向 tunnel_id, 为 None 时删除映射"""
+        if tunnel_id is None:
+            self.domain_mappings.pop(domain, None)
+            self.domain_trie.remove(domain)
+        else:
+            self.domain_mappings[domain] = tunnel_id
+            self.domain_trie.add(domain, tunnel_id)
+            
+    def _online_member(self, tunnel: dict, excluded_client: str | None = None) -> str | None:
+        """tunnel 所在隧道组中另一个客户端在线的成员"""
+        group = self.groups.get(tunnel["public_port"]) if tunnel.get("group") else None
+        if group is None:
+            return None
+        for tunnel_id in group.backends:
+            member = self.tunnels.get(tunnel_id)
+            if (
+                tunnel_id != tunnel["tunnel_id"] and member is not None
+                and member["client_id"] != excluded_client and self.is_online(member["client_id"])
+            ):
+                return tunnel_id
+        return None
+        
+    def pick_member(self, tunnel: dict) -> Tuple[dict, TunnelGroup | None, Backend | None]:
+        """隧道组按负载均衡策略选出一个可以接收请求的成员, 返回 (成员, 隧道组, 成员状态);
+        不是隧道组或没有成员在线时返回 (tunnel, None, None)"""
+        group = self.groups.get(tunnel["public_port"]) if tunnel.get("group") else None
+        if group is None:
+            return tunnel, None, None
+        # 宽限期内的客户端不在 active_connections 中, 不再分到新请求, 进行中的请求照常完成
+        backend = group.pick(lambda tunnel_id: self.is_online(self.tunnels[tunnel_id]["client_id"]))
+        if backend is None:
+            return tunnel, None, None
+        return self.tunnels[backend.key], group, backend
+        
+    def _index_tunnel(self, tunnel: dict):
+        tunnel_id = tunnel["tunnel_id"]
+        public_port = tunnel["public_port"]
+        self.tunnels[tunnel_id] = tunnel
+        # 隧道组已有成员时端口和域名继续指向原来的成员
+        self.port_index.setdefault(public_port, tunnel_id)
+        if tunnel.get("group"):
+            group = self.groups.get(public_port)
+            if group is None:
+                group = self.groups[public_port] = TunnelGroup()
+                group.on_eject = partial(self._on_eject, public_port)
+            group.add(tunnel_id)
+        self.client_tunnels.setdefault(tunnel["client_id"], set()).add(tunnel_id)
+        local_port = tunnel["local_port"]
+        self.local_port_refs[local_port] = self.local_port_refs.get(local_port, 0) + 1
+        
+        domain = tunnel["custom_domain"]
+        if domain and domain not in self.domain_mappings:
+            self._map_domain(domain, tunnel_id)
+            
+    def _on_eject(self, public_port: int, backend: Backend):
+        for listener in self.eject_listeners:
+            listener(public_port, backend.key)
+        
+    def _unindex_tunnel(self, tunnel_id: str):
+        tunnel = self.tunnels.pop(tunnel_id, None)
+        if tunnel is None:
+            return None
+        
+        public_port = tunnel["public_port"]
+        # 隧道组中的其他成员接替端口和域名
+        successor = None
+        group = self.groups.get(public_port) if tunnel.get("group") else None
+        if group is not None:
+            group.remove(tunnel_id)
+            if group:
+                successor = self._online_member(tunnel) or next(iter(group.backends))
+            else:
+                del self.groups[public_port]
+        if self.port_index.get(public_port) == tunnel_id:
+            if successor is not None:
+                self.port_index[public_port] = successor
+            else:
+                del self.port_index[public_port]
+        client_tunnels = self.client_tunnels.get(tunnel["client_id"])
+        if client_tunnels is not None:
+            client_tunnels.discard(tunnel_id)
+            if not client_tunnels:
+                del self.client_tunnels[tunnel["client_id"]]
+        
+        domain = tunnel["custom_domain"]
+        if domain and self.domain_mappings.get(domain) == tunnel_id:
+            self._map_domain(domain, successor)
+        
+        local_port = tunnel["local_port"]
+        refs = self.local_port_refs.get(local_port, 0) - 1
+        if refs > 0:
+            self.local_port_refs[local_port] = refs
+        else:
+            self.local_port_refs.pop(local_port, None)
+        return tunnel
+        
+    def find_tunnel_by_port(self, public_port: int):
+        """按公网端口在本地索引中查找隧道"""
+        tunnel_id = self.port_index.get(public_port)
+        if tunnel_id is None:
+            return None
+        return self.tunnels.get(tunnel_id)
+
+    async def lookup_tunnel_by_port(self, public_port: int):
+        """按公网端口查找隧道, 本地没有时可能是其他 worker 刚注册的, 先同步一次"""
+        tunnel = self.find_tunnel_by_port(public_port)
+        if tunnel is None and self.registry.shared:
+            await self.sync()
+            tunnel = self.find_tunnel_by_port(public_port)
+        return tunnel
+        
+    def find_tunnel_by_domain(self, domain: str):
+        """按自定义域名查找隧道"""
+        tunnel_id = self.domain_mappings.get(domain)
+        if tunnel_id is None:
+            return None
+        return self.tunnels.get(tunnel_id)
+        
+    def find_tunnel_by_host(self, host: str):
+        """按规范化后的 Host 查找隧道: 先匹配自定义域名 (含通配符), 再匹配自动分配的子域名"""
+        tunnel_id = self.domain_trie.match(host)
+        if tunnel_id is not None:
+            return self.tunnels.get(tunnel_id)
+        public_port = base_domain_port(host)
+        if public_port is not None:
+            return self.find_tunnel_by_port(public_port)
+        return None
+        
+    def is_reserved(self, public_port: int) -> bool:
+        return any(low <= public_port <= high for low, high in self.reserved_ports)
+
+    def check_reserved(self, public_port: int, custom_domain: str | None):
+        """公网端口或 (规范化后的) 域名属于服务端自己时抛出 ValueError"""
+        if self.is_reserved(public_port):
+            raise ValueError(f"Public port {public_port} is reserved")
+        if custom_domain and any(domain_covers(custom_domain, host) for host in self.server_hosts):
+            raise ValueError(f"Custom domain {custom_domain} is reserved")
+
+    def local_port_in_use(self, local_port: int) -> bool:
+        return local_port in self.local_port_refs
+
+    def is_online(self, client_id: str) -> bool:
+        """客户端连在本 worker 或其他 worker 上"""
+        return client_id in self.active_connections or client_id in self.owners
+        
+    def get_tunnel_info(self, tunnel_id: str):
         """获取隧道信息"""
-        tunnel = self.tunnels.get(client_id)
-        logger.info(f"Getting tunnel info for {client_id}: {tunnel}")
+        tunnel = self.tunnels.get(tunnel_id)
+        logger.debug("Getting tunnel info for %s: %s", tunnel_id, tunnel)
         return tunnel
 
     def list_tunnels(self):
         """列出所有隧道"""
-        logger.info(f"Listing all tunnels: {self.tunnels}")
+        logger.debug("Listing %d tunnels", len(self.tunnels))
         return self.tunnels
 
-manager = ConnectionManager()
+    def filter_tunnels(
+        self,
+        public_port: int | None = None,
+        local_port: int | None = None,
+        domain: str | None = None,
+        online: bool | None = None
+    ):
+        """按条件筛选隧道, 按创建顺序逐个产出"""
+        if public_port is not None:
+            group = self.groups.get(public_port)
+            if group is not None:
+                candidates = [self.tunnels[tunnel_id] for tunnel_id in group.backends]
+            else:
+                tunnel = self.find_tunnel_by_port(public_port)
+                candidates = [tunnel] if tunnel is not None else []
+        else:
+            candidates = self.tunnels.values()
+        for tunnel in candidates:
+            if local_port is not None and tunnel["local_port"] != local_port:
+                continue
+            if domain and domain not in (tunnel["custom_domain"] or ""):
+                continue
+            if online is not None and self.is_online(tunnel["client_id"]) != online:
+                continue
+            yield tunnel
+
+async def client_route(tunnel: dict):
+    """转发到隧道所属客户端所用的 (多路复用器, 路由), 路由即 open_stream 的参数
+
+    客户端连在本 worker 上时路由只有隧道名称 (没有名称时为空字符串, 客户端总是先去掉它);
+    连在其他 worker 上时返回到那个 worker 的内部连接, 路由前面再加上客户端ID;
+    客户端不在线或 owner 不可达时返回 None.
+    """
+    client_id = tunnel["client_id"]
+    routes = (tunnel.get("name") or "",)
+    mux = manager.multiplexers.get(client_id)
+    if mux is not None:
+        return mux, routes
+    owner = manager.owners.get(client_id)
+    if owner is None:
+        return None
+    try:
+        return await peer_links.connect(owner), (client_id, *routes)
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning("Cannot reach worker %s for client %s: %s", owner, client_id, e)
+        return None
+
+async def resolve_tcp_target(public_port: int):
+    """TCP 连接到达时确定转发目标, 隧道组按负载均衡策略选一个成员 (只选择, 不统计延迟和连接数)"""
+    tunnel = await manager.lookup_tunnel_by_port(public_port)
+    if tunnel is None:
+        return None
+    tunnel = manager.pick_member(tunnel)[0]
+    route = await client_route(tunnel)
+    open_stream = partial(route[0].open_stream, *route[1]) if route is not None else None
+    return open_stream, UPSTREAM_HOST, tunnel["local_port"]
+
+manager = ConnectionManager(
+    TcpListeners(resolve_tcp_target, tcp_traffic_counters) if TCP_TUNNELS_ENABLED else None,
+    open_registry(TUNNEL_REGISTRY, TUNNEL_REGISTRY_PATH)
+)
+manager.reserved_ports = [(SERVER_PORT, SERVER_PORT), *parse_port_ranges(RESERVED_PORTS)]
+if CLUSTER_PORT:
+    manager.reserved_ports.append((CLUSTER_PORT, CLUSTER_PORT))
+manager.server_hosts = {
+    host for host in map(normalize_host, [*SERVER_HOSTNAMES.split(","), TUNNEL_BASE_DOMAIN]) if host
+}
+
+# 限流器, 按隧道ID和用户名保存, 配置分别在隧道字典和用户记录的 "limits" 中
+tunnel_limiters = Limiters()
+user_limiters = Limiters()
+# 进行中的请求, 按隧道ID (隧道组为选中的成员) 记录, 隧道删除和进程退出前据此排空
+in_flight = InFlight()
+stall_detector = StallDetector(STALL_THRESHOLD if DIAGNOSTICS_ENABLED else 0)
+timings = Timings(TIMING_HISTORY if DIAGNOSTICS_ENABLED else 0)
+profiler = Profiler()
+login_attempts = KeyedBuckets(LOGIN_RATE, LOGIN_BURST) if LOGIN_RATE > 0 else None
+login_failures = KeyedBuckets(LOGIN_FAILURE_RATE, LOGIN_FAILURE_BURST) if LOGIN_FAILURE_RATE > 0 else None
+
+def forget_tunnel_limiter(tunnel_id: str):
+    if tunnel_id not in manager.tunnels:
+        tunnel_limiters.discard(tunnel_id)
+
+def forget_user_limiter(username: str):
+    if username not in user_store:
+        user_limiters.discard(username)
+
+manager.listeners.append(forget_tunnel_limiter)
+
+def count_ejection(public_port: int, tunnel_id: str):
+    if METRICS_ENABLED:
+        group_ejections.labels(public_port).inc()
+
+manager.eject_listeners.append(count_ejection)
+user_store.listeners.append(forget_user_limiter)
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+def admit_proxy_request(scope):
+    """AdmissionGate 的检查函数: /proxy/{port} 的请求按隧道及其所属用户的限额准入,
+    在路由, 解析请求和任何上游工作之前执行; 没有设置限额时返回 None"""
+    path = scope["path"]
+    if not path.startswith("/proxy/"):
+        return None
+    port = path[7:].split("/", 1)[0]
+    if not port.isdigit():
+        return None
+    public_port = int(port)
+    # 只查本地索引: 其他 worker 刚注册、还没同步到的隧道, 第一个请求不做准入
+    tunnel = manager.find_tunnel_by_port(public_port)
+    if tunnel is None:
+        return None
+    limiters = [tunnel_limiters.get(tunnel["tunnel_id"], tunnel.get("limits"))]
+    owner = tunnel.get("owner")
+    if owner is not None:
+        user = user_store.get(owner)
+        limiters.append(user_limiters.get(owner, user.get("limits") if user is not None else None))
+    if not any(limiters):
+        return None
+    try:
+        return admit(limiters)
+    except RateLimited as e:
+        if METRICS_ENABLED:
+            rate_limited.labels(public_port, "tunnel" if e.index == 0 else "user", e.reason).inc()
+            tunnel_requests.labels(public_port, "4xx").inc()
+        access_log.log(scope.get("method", "GET"), path, 429, 0.0)
+        raise
+
+def base_domain_port(host: str):
+    """TUNNEL_BASE_DOMAIN 下自动分配的子域名 {public_port}.{TUNNEL_BASE_DOMAIN} 中的端口"""
+    if TUNNEL_BASE_DOMAIN and host.endswith(TUNNEL_BASE_DOMAIN):
+        label = host[:-len(TUNNEL_BASE_DOMAIN)]
+        if label.endswith(".") and label[:-1].isdigit():
+            return int(label[:-1])
+    return None
+
+def resolve_host(host: str):
+    """Host 对应隧道时返回其公网端口, 请求随后按 /proxy/{public_port} 处理
+
+    共享注册表时本地找不到的端口子域名也照样改写: 可能是其他 worker 刚注册的,
+    由 /proxy 的处理函数同步注册表后再查找, 这里在事件循环中不读注册表
+    """
+    tunnel = manager.find_tunnel_by_host(host)
+    if tunnel is not None:
+        return tunnel["public_port"]
+    return base_domain_port(host) if manager.registry.shared else None
+
+# 准入在 HostRouter 改写路径之后执行, 先添加的中间件在内层
+app.add_middleware(AdmissionGate, check=admit_proxy_request)
+app.add_middleware(HostRouter, resolve=resolve_host, server_hosts=manager.server_hosts)
+app.add_middleware(DrainGate, in_flight=in_flight)
+app.add_middleware(TimingGate, timings=timings)
+
+async def pipe_stream(source: Stream, target: Stream):
+    async for chunk in source.iter_chunks():
+        await target.write(chunk)
+    await target.end()
+
+async def relay_peer_stream(stream: Stream):
+    """其他 worker 经内部连接转来的流, 转交给连在本 worker 上的客户端"""
+    target = None
+    try:
+        client_id, head = decode_routed_head(await stream.wait_head())
+        mux = manager.multiplexers.get(client_id)
+        if mux is None:
+            await stream.send_head(encode_response_head(502, []), end_stream=True)
+            return
+        target = mux.open_stream()
+        await target.send_head(head, end_stream=stream.head_end_stream)
+        
+        async def respond():
+            response_head = await asyncio.wait_for(target.wait_head(), timeout=UPSTREAM_TIMEOUT)
+            await stream.send_head(response_head, end_stream=target.head_end_stream)
+            if not target.head_end_stream:
+                await pipe_stream(target, stream)
+        
+        # 两个方向同时转发, CONNECT 流需要双向
+        tasks = [asyncio.create_task(respond())]
+        if not stream.head_end_stream:
+            tasks.append(asyncio.create_task(pipe_stream(stream, target)))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+    except (StreamReset, asyncio.TimeoutError, ValueError) as e:
+        proxy_logger.info("Relayed stream %s failed: %s", stream.id, e)
+    finally:
+        for s in (stream, target):
+            if s is not None and not (s.local_closed and s.remote_closed):
+                await s.reset("relay closed")
+
+peer_links = PeerLinks(relay_peer_stream)
+
+async def sync_registry():
+    """定期拉取其他 worker 对注册表的修改"""
+    while True:
+        await asyncio.sleep(REGISTRY_SYNC_INTERVAL)
+        try:
+            await manager.sync()
+        except Exception as e:
+            logger.error("Failed to sync tunnel registry: %s", e)
+
+async def on_upstream_headers_sent(session, context, params):
+    mark_connected()
+
+# 记录请求耗时时, 以 aiohttp 的请求头发出事件作为连上上游的时间
+upstream_trace = aiohttp.TraceConfig()
+upstream_trace.on_request_headers_sent.append(on_upstream_headers_sent)
+
+# 上游连接池
+class UpstreamPool:
+    """按本地端口维护长连接池, 并用熔断器记录上游健康状态"""
+    def __init__(self):
+        self.sessions: Dict[int, aiohttp.ClientSession] = {}
+        self.failures: Dict[int, int] = {}
+        self.open_until: Dict[int, float] = {}  # 熔断打开到何时
+        self.websocket_session: aiohttp.ClientSession | None = None
+        self._probe_task: asyncio.Task | None = None
+
+    def get_session(self, local_port: int) -> aiohttp.ClientSession:
+        """获取某个本地端口对应的会话, 不存在时创建"""
+        session = self.sessions.get(local_port)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=UPSTREAM_LIMIT_PER_HOST,
+                keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT
+            )
+            # 流式转发不限制总时长, 只限制连接和单次读取的超时
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=UPSTREAM_TIMEOUT,
+                    sock_read=UPSTREAM_TIMEOUT
+                ),
+                auto_decompress=False,
+                trace_configs=[upstream_trace] if timings.enabled else None
+            )
+            self.sessions[local_port] = session
+        return session
+
+    def get_websocket_session(self) -> aiohttp.ClientSession:
+        """WebSocket 连接升级后不再归还连接池, 所有端口共用一个会话;
+        不设读取超时, 空闲的 WebSocket 由心跳保活"""
+        if self.websocket_session is None or self.websocket_session.closed:
+            self.websocket_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=UPSTREAM_TIMEOUT)
+            )
+        return self.websocket_session
+
+    def is_available(self, local_port: int) -> bool:
+        """熔断打开期间直接拒绝, 冷却结束后放行试探请求"""
+        until = self.open_until.get(local_port)
+        return until is None or until <= time.monotonic()
+
+    def record_success(self, local_port: int):
+        self.failures.pop(local_port, None)
+        if self.open_until.pop(local_port, None) is not None:
+            logger.info("Upstream %s:%s recovered", UPSTREAM_HOST, local_port)
+
+    def record_failure(self, local_port: int):
+        count = self.failures.get(local_port, 0) + 1
+        self.failures[local_port] = count
+        if count >= HEALTH_FAILURE_THRESHOLD:
+            self.open_until[local_port] = time.monotonic() + HEALTH_COOLDOWN
+            logger.warning("Upstream %s:%s marked unavailable after %d failures", UPSTREAM_HOST, local_port, count)
+
+    async def _probe_loop(self):
+        """后台只探测已熔断的端口, 健康的上游不产生额外请求"""
+        while True:
+            await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+            for local_port in list(self.open_until):
+                try:
+                    _, writer = await asyncio.wait_for(
+                        asyncio.open_connection(UPSTREAM_HOST, local_port),
+                        timeout=UPSTREAM_TIMEOUT
+                    )
+                    writer.close()
+                    self.record_success(local_port)
+                except (OSError, asyncio.TimeoutError):
+                    pass
+
+    def start(self):
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def release(self, local_port: int):
+        """关闭某个端口的连接池"""
+        session = self.sessions.pop(local_port, None)
+        self.failures.pop(local_port, None)
+        self.open_until.pop(local_port, None)
+        if session is not None:
+            await session.close()
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        for local_port in list(self.sessions):
+            await self.release(local_port)
+        if self.websocket_session is not None:
+            await self.websocket_session.close()
+            self.websocket_session = None
+
+upstream_pool = UpstreamPool()
+edge_cache = EdgeCache(
+    CACHE_MEMORY_BYTES,
+    CACHE_MAX_ENTRY_BYTES,
+    CACHE_DIR,
+    CACHE_DISK_BYTES,
+    wait_timeout=UPSTREAM_TIMEOUT,
+    on_evict=lambda tier: cache_evictions.labels(tier).inc()
+)
+background_tasks: Set[asyncio.Task] = set()
+
+# 管理面板推送
+def admin_tunnel_view(tunnel_id: str):
+    tunnel = manager.tunnels.get(tunnel_id)
+    if tunnel is None:
+        return None
+    return {**tunnel, "online": manager.is_online(tunnel["client_id"])}
+
+def admin_stats():
+    return {
+        "active_connections": len(manager.active_connections),
+        "tunnels": len(manager.tunnels)
+    }
+
+def tunnel_traffic():
+    """按公网端口汇总的 [请求数, 接收字节, 发送字节]"""
+    traffic: Dict[str, list] = {}
+    for (port, _), value in tunnel_requests.values().items():
+        traffic.setdefault(port, [0, 0, 0])[0] += value
+    for (port, _), value in tunnel_bytes_received.values().items():
+        traffic.setdefault(port, [0, 0, 0])[1] += value
+    for (port, _), value in tunnel_bytes_sent.values().items():
+        traffic.setdefault(port, [0, 0, 0])[2] += value
+    return traffic
+
+admin_feed = AdminFeed(
+    admin_tunnel_view,
+    lambda: [admin_tunnel_view(tunnel_id) for tunnel_id in manager.tunnels],
+    admin_stats,
+    tunnel_traffic,
+    ADMIN_FEED_INTERVAL,
+    ADMIN_FEED_QUEUE_SIZE
+)
+manager.listeners.append(admin_feed.on_change)
+
+@app.on_event("startup")
+async def startup():
+    upstream_pool.start()
+    admin_feed.start()
+    if manager.registry.shared:
+        # 先公布内部地址, 再载入其他 worker 注册的隧道
+        await peer_links.start()
+        manager.address = peer_links.address
+        cluster_port = int(peer_links.address.rsplit(":", 1)[1])
+        manager.reserved_ports.append((cluster_port, cluster_port))
+    # 重启或热重载后恢复注册表中的隧道; 上游连接池和限流器在第一个请求时再创建
+    start = time.perf_counter()
+    tunnels = manager.restore()
+    if tunnels:
+        logger.info("Restored %d tunnels in %.1fms", len(tunnels), (time.perf_counter() - start) * 1000)
+    if SERVER_HANDOFF and manager.tcp_listeners is not None:
+        # 旧进程仍在监听这些端口, 打开时加入它的监听
+        manager.tcp_listeners.adopt(tunnel["public_port"] for tunnel in tunnels)
+    if manager.registry.shared:
+        background_tasks.add(asyncio.create_task(sync_registry()))
+    elif tunnels:
+        # 多 worker 时 TCP 端口由客户端连接所在的 worker 监听, 单进程时全部在这里重新打开
+        ports = list(dict.fromkeys(tunnel["public_port"] for tunnel in tunnels))
+        background_tasks.add(asyncio.create_task(manager.open_listeners(ports)))
+    if METRICS_ENABLED:
+        background_tasks.add(asyncio.create_task(sample_loop_lag()))
+        stall_detector.on_stall = lambda duration: event_loop_stalls.inc()
+    stall_detector.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    stall_detector.stop()
+    admin_feed.close()
+    if manager.address is not None:
+        await manager.registry.call(manager.registry.clear_owners, manager.address)
+        peer_links.close()
+    manager.registry.close()
+    if manager.tcp_listeners is not None:
+        manager.tcp_listeners.close_all()
+    await upstream_pool.close()
+    await user_store.close()
+    password_hasher.shutdown()
+    log_listener.stop()
+
+def prepare_handoff():
+    """SIGUSR1 (见 drain.py): 允许新进程加入 TCP 隧道端口的监听"""
+    if manager.tcp_listeners is not None:
+        manager.tcp_listeners.share()
+
+async def begin_drain(deadline: float):
+    """平滑重启 (见 drain.py): 主端口的新连接已交给新进程, TCP 隧道端口同样交出, 并通知客户端改连;
+    客户端旧连接上进行中的流照常完成"""
+    if manager.tcp_listeners is not None:
+        for listener in manager.tcp_listeners.listening_sockets():
+            steer_away(listener)
+    for client_id, websocket in list(manager.active_connections.items()):
+        try:
+            await websocket.send_text(json.dumps({"type": "reconnect"}))
+        except Exception as e:
+            logger.debug("Cannot ask client %s to reconnect: %s", client_id, e)
+
+async def finish_drain(deadline: float):
+    """HTTP 请求都已结束: 停止 TCP 监听并等已有连接结束, 客户端旧连接上没有流后关闭它;
+    共享注册表时还要等客户端已在新进程上线, 新进程不再经内部连接转发过来"""
+    if manager.tcp_listeners is not None:
+        manager.tcp_listeners.close_all(max(0.0, deadline - time.monotonic()))
+    closing = set()
+    while time.monotonic() < deadline:
+        for client_id, websocket in list(manager.active_connections.items()):
+            if client_id in closing:
+                continue
+            mux = manager.multiplexers.get(client_id)
+            moved = client_id in manager.owners or not manager.registry.shared
+            if moved and (mux is None or not mux.streams):
+                closing.add(client_id)
+                try:
+                    await websocket.close(1001)
+                except Exception as e:
+                    logger.debug("Cannot close client %s: %s", client_id, e)
+        tcp_connections = manager.tcp_listeners.connection_count() if manager.tcp_listeners is not None else 0
+        if not manager.active_connections and not tcp_connections:
+            return
+        await asyncio.sleep(0.1)
 
 # 用户认证相关函数
+class AuthCache:
+    """缓存已验证的令牌和用户对象, 已认证的请求不必每次验签和构造模型
+
+    令牌条目在令牌的 exp 到期时失效; 用户被修改、禁用或删除时由
+    user_store 回调 invalidate_user 丢弃对应的用户对象.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._tokens: OrderedDict[str, Tuple[str, float]] = OrderedDict()  # 令牌到 (用户名, 过期时间)
+        self._users: OrderedDict[str, UserInDB] = OrderedDict()
+
+    def get_token(self, token: str) -> str | None:
+        entry = self._tokens.get(token)
+        if entry is None:
+            return None
+        username, exp = entry
+        if exp <= time.time():
+            del self._tokens[token]
+            return None
+        self._tokens.move_to_end(token)
+        return username
+
+    def put_token(self, token: str, username: str, exp: float):
+        self._put(self._tokens, token, (username, exp))
+
+    def get_user(self, username: str) -> UserInDB | None:
+        user = self._users.get(username)
+        if user is not None:
+            self._users.move_to_end(username)
+        return user
+
+    def put_user(self, user: UserInDB):
+        self._put(self._users, user.username, user)
+
+    def invalidate_user(self, username: str):
+        self._users.pop(username, None)
+
+    def _put(self, entries: OrderedDict, key, value):
+        if self.maxsize <= 0:
+            return
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+auth_cache = AuthCache(AUTH_CACHE_SIZE)
+user_store.listeners.append(auth_cache.invalidate_user)
+
 def get_user(username: str):
-    if username in users_db:
-        user_dict = users_db[username]
-        return UserInDB(**user_dict)
+    user = auth_cache.get_user(username)
+    if user is not None:
+        return user
+    user_dict = user_store.get(username)
+    if user_dict is not None:
+        user = UserInDB(**user_dict)
+        if username in ADMIN_USERS:
+            user.admin = True
+        auth_cache.put_user(user)
+        return user
     return None
 
-def authenticate_user(username: str, password: str):
+class PasswordHasher:
+    """在专用线程池中执行 bcrypt, 排队的任务过多时直接拒绝"""
+    def __init__(self, workers: int, queue_size: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._limit = workers + queue_size
+        self._pending = 0
+
+    async def run(self, fn, *args):
+        if self._pending >= self._limit:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many authentication requests",
+                headers={"Retry-After": "1"},
+            )
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+password_hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE)
+
+async def authenticate_user(username: str, password: str):
     user = get_user(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await password_hasher.run(verify_password, password, user.hashed_password):
         return False
+    # 哈希参数已过时, 趁有明文时重新计算
+    if pwd_context.needs_update(user.hashed_password):
+        user.hashed_password = await password_hasher.run(get_password_hash, password)
+        await user_store.update({
+            **(user_store.get(user.username) or {}),
+            "username": user.username,
+            "hashed_password": user.hashed_password,
+            "disabled": bool(user.disabled)
+        })
+        logger.info("Rehashed password for user %s", username)
     return user
 
 def verify_password(plain_password, hashed_password):
@@ -184,10 +1354,21 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def verify_token(token: str) -> str | None:
+    """验证令牌并返回用户名, 命中缓存时跳过验签; 验签失败抛出 JWTError"""
+    username = auth_cache.get_token(token)
+    if username is not None:
+        return username
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username = payload.get("sub")
+    exp = payload.get("exp")
+    if username is not None and exp is not None:
+        auth_cache.put_token(token, username, exp)
+    return username
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
+        username = verify_token(token)
         if username is None:
             raise HTTPException(
                 status_code=401,
@@ -201,6 +1382,12 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
                 detail="User not found",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        if user.disabled:
+            raise HTTPException(
+                status_code=401,
+                detail="Inactive user",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
         return user
     except JWTError:
         raise HTTPException(
@@ -209,27 +1396,54 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return current_user
+
 # 认证相关API
 @app.post("/api/register")
 async def register(user: UserCreate):
-    if user.username in users_db:
+    if user.username in user_store or user.username in ADMIN_USERS:
         raise HTTPException(
             status_code=400,
             detail="Username already registered"
         )
-    hashed_password = get_password_hash(user.password)
-    users_db[user.username] = {
-        "username": user.username,
-        "hashed_password": hashed_password,
-        "disabled": False
-    }
-    save_users(users_db)  # 保存到文件
+    hashed_password = await password_hasher.run(get_password_hash, user.password)
+    try:
+        # 后台线程批量落盘, 不阻塞事件循环
+        await user_store.create({
+            "username": user.username,
+            "hashed_password": hashed_password,
+            "disabled": False
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"message": "User created successfully"}
 
+def check_login_throttle(request: Request, username: str):
+    """按来源 IP 限制尝试次数, 按用户名限制失败次数, 在计算 bcrypt 之前拒绝"""
+    wait = 0.0
+    if login_attempts is not None:
+        wait = login_attempts.take(request.client.host if request.client else "")
+    if not wait and login_failures is not None:
+        wait = login_failures.wait(username)
+    if wait:
+        if METRICS_ENABLED:
+            login_throttled.inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many login attempts",
+            headers={"Retry-After": retry_after(wait)},
+        )
+
 @app.post("/api/login", response_model=Token)
-async def login(form_data: UserLogin):
-    user = authenticate_user(form_data.username, form_data.password)
+async def login(form_data: UserLogin, request: Request):
+    check_login_throttle(request, form_data.username)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
+        if login_failures is not None:
+            login_failures.take(form_data.username)
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
@@ -265,13 +1479,12 @@ async def get_admin_panel(request: Request, token: str | None = None):
             return RedirectResponse(url="/login")
             
         # 验证token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
+        username = verify_token(token)
         if not username:
             return RedirectResponse(url="/login")
             
         user = get_user(username)
-        if not user:
+        if not user or user.disabled:
             return RedirectResponse(url="/login")
             
         return templates.TemplateResponse(
@@ -279,49 +1492,171 @@ async def get_admin_panel(request: Request, token: str | None = None):
             {
                 "request": request,
                 "username": username,
-                "active_connections": len(manager.active_connections),
-                "tunnels": manager.tunnels
+                # 隧道列表由推送通道填充, 页面只渲染汇总数字
+                **admin_stats()
             }
         )
     except JWTError:
         return RedirectResponse(url="/login")
 
+async def send_control(websocket: WebSocket, message: dict, codec: int):
+    """按协商的编码发送控制消息"""
+    data = encode_message(message, codec)
+    if isinstance(data, str):
+        await websocket.send_text(data)
+    else:
+        await websocket.send_bytes(data)
+
 # WebSocket路由
 @app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await manager.connect(client_id, websocket)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    client_id: str,
+    session: str | None = None,
+    received: int = 0,
+    codec: str | None = None,
+    compression: str | None = None
+):
+    """客户端连接; session/received 为续传时的会话令牌和客户端已收到的帧数,
+    codec/compression 为客户端支持的控制消息编码版本和数据帧压缩算法 (见 codec.py)"""
+    if in_flight.draining:
+        # 进程即将退出, 客户端稍后重连时会到达新进程
+        await websocket.close(code=1013)
+        return
+    version = negotiate(codec)
+    compressed = version > 0 and FRAME_COMPRESSION and compression == "zlib"
     try:
+        link = await manager.connect(client_id, websocket, session, received, version, compressed)
+        mux = manager.multiplexers[client_id]
         while True:
-            data = await websocket.receive_text()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            
+            # 二进制消息是多路复用的数据帧或二进制编码的控制消息, 文本消息是 JSON 控制消息
+            data = message.get("bytes")
+            if data is not None and not is_control(data):
+                link.on_frame()
+                mux.feed(data)
+                if link.ack_due():
+                    await send_control(websocket, {"type": "ack", "received": link.received}, version)
+                continue
+            if data is None:
+                data = message.get("text")
+            
             try:
-                message = json.loads(data)
-                if message["type"] == "tunnel_request":
-                    manager.register_tunnel(
+                message = decode_message(data)
+            except ValueError:
+                logger.error("Invalid control message received: %r", data[:200])
+                continue
+            if message["type"] == "ping":
+                # 心跳兼作确认, 回复中带上服务端已收到的帧数
+                link.ack(message.get("received", 0))
+                await send_control(websocket, {
+                    "type": "pong", "id": message.get("id"), "received": link.acknowledged()
+                }, version)
+            elif message["type"] == "ack":
+                link.ack(message["received"])
+            elif message["type"] == "tunnel_request":
+                # tunnel_id 是客户端为这个隧道取的名称, 旧客户端不带, 只能注册一个隧道
+                name = message.get("tunnel_id")
+                group = message.get("group")
+                response = {"type": "tunnel_response", "status": "success"}
+                if name is not None:
+                    response["tunnel_id"] = name
+                try:
+                    if name is not None and not TUNNEL_NAME_PATTERN.fullmatch(str(name)):
+                        raise ValueError(f"Invalid tunnel id: {name}")
+                    if group is not None and not TUNNEL_NAME_PATTERN.fullmatch(str(group)):
+                        raise ValueError(f"Invalid tunnel group: {group}")
+                    await manager.register_tunnel(
                         client_id,
                         message["local_port"],
                         message["public_port"],
-                        message.get("custom_domain")
+                        message.get("custom_domain"),
+                        message.get("cache", False),
+                        message.get("compress", False),
+                        name=name,
+                        group=group
                     )
-                    await websocket.send_text(json.dumps({
-                        "type": "tunnel_response",
-                        "status": "success"
-                    }))
-            except json.JSONDecodeError:
-                logger.error(f"Invalid JSON received: {data}")
-    except websockets.exceptions.WebSocketDisconnect:
-        manager.disconnect(client_id)
+                except ValueError as e:
+                    response.update(status="error", detail=str(e))
+                await send_control(websocket, response, version)
+            elif message["type"] == "tunnel_remove":
+                await discard_tunnel(tunnel_key(client_id, message["tunnel_id"]))
+            elif message["type"] == "tunnel_sync":
+                # 新会话开始时客户端的全部隧道名称
+                for tunnel in manager.retain_client_tunnels(client_id, set(message["tunnel_ids"])):
+                    drain_tunnel(tunnel)
+    except WebSocketDisconnect:
+        manager.disconnect(client_id, websocket)
     except Exception as e:
-        logger.error(f"Error in websocket connection: {str(e)}")
-        manager.disconnect(client_id)
+        logger.error("Error in websocket connection: %s", e)
+        manager.disconnect(client_id, websocket)
+
+@app.websocket("/api/admin/feed")
+async def admin_feed_endpoint(websocket: WebSocket, token: str | None = None):
+    """管理面板的推送通道: 先发快照, 之后按 tick 发送合并后的变化"""
+    try:
+        username = verify_token(token) if token else None
+    except JWTError:
+        username = None
+    user = get_user(username) if username else None
+    if user is None or user.disabled:
+        await websocket.close(code=1008)
+        return
+    
+    await websocket.accept()
+    queue = admin_feed.subscribe()
+    # 浏览器不会发消息, 只需要及时发现断开
+    receiver = asyncio.create_task(websocket.receive())
+    try:
+        while True:
+            getter = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                getter.cancel()
+                message = receiver.result()
+                if message["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+                continue
+            message = getter.result()
+            await websocket.send_text(admin_feed.snapshot_message() if message is RESYNC else message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        admin_feed.unsubscribe(queue)
 
 # API路由
 @app.get("/api/tunnels")
-async def list_tunnels(current_user: User = Depends(get_current_user)):
-    """列出所有隧道"""
-    logger.info("Listing tunnels for user: %s", current_user.username)
-    tunnels = manager.list_tunnels()
-    logger.info("Current tunnels: %s", tunnels)
-    return tunnels
+async def list_tunnels(
+    response: Response,
+    offset: int = 0,
+    limit: int | None = None,
+    public_port: int | None = None,
+    local_port: int | None = None,
+    domain: str | None = None,
+    online: bool | None = None,
+    current_user: User = Depends(get_current_user)
+):
+    """列出隧道, 支持分页和筛选; 总数放在 X-Total-Count 头部"""
+    logger.debug("Listing tunnels for user: %s", current_user.username)
+    if offset < 0 or (limit is not None and limit < 0):
+        raise HTTPException(status_code=400, detail="offset and limit must not be negative")
+    
+    filtered = public_port is not None or local_port is not None or domain or online is not None
+    if not filtered:
+        tunnels = manager.list_tunnels()
+        total = len(tunnels)
+        selected = tunnels.values()
+    else:
+        selected = list(manager.filter_tunnels(public_port, local_port, domain, online))
+        total = len(selected)
+    end = None if limit is None else offset + limit
+    response.headers["X-Total-Count"] = str(total)
+    return {tunnel["tunnel_id"]: tunnel for tunnel in islice(selected, offset, end)}
 
 @app.post("/api/tunnels")
 async def create_tunnel(
@@ -331,7 +1666,7 @@ async def create_tunnel(
     """创建新隧道"""
     try:
         data = await request.json()
-        logger.info(f"Received tunnel creation request from {current_user.username}: {data}")
+        logger.info("Received tunnel creation request from %s: %s", current_user.username, data)
         
         # 检查必需字段
         if 'local_port' not in data or 'public_port' not in data:
@@ -342,151 +1677,619 @@ async def create_tunnel(
             local_port = int(data.get("local_port"))
             public_port = int(data.get("public_port"))
         except (TypeError, ValueError) as e:
-            logger.error(f"Invalid port values: {e}")
+            logger.error("Invalid port values: %s", e)
             raise HTTPException(status_code=400, detail="Port values must be valid integers")
             
         custom_domain = data.get("custom_domain")
+        cache = data.get("cache", False)
+        compress = data.get("compress", False)
+        if not isinstance(cache, bool) or not isinstance(compress, bool):
+            raise HTTPException(status_code=400, detail="cache and compress must be booleans")
+        group = data.get("group")
+        if group is not None and not (isinstance(group, str) and TUNNEL_NAME_PATTERN.fullmatch(group)):
+            raise HTTPException(status_code=400, detail="group must be 1-64 letters, digits, '-' or '_'")
+        limits = validate_limits(data.get("limits"))
+        if limits and not current_user.admin:
+            # 隧道的所有者不能给自己放宽到超过用户限额
+            owner = user_store.get(current_user.username)
+            check_within(limits, owner.get("limits") if owner is not None else None)
         
         # 验证端口值
         if local_port < 1 or local_port > 65535 or public_port < 1 or public_port > 65535:
-            logger.error(f"Port values out of range: local_port={local_port}, public_port={public_port}")
+            logger.error("Port values out of range: local_port=%s, public_port=%s", local_port, public_port)
             raise HTTPException(status_code=400, detail="Port values must be between 1 and 65535")
         
-        # 创建隧道
+        if manager.is_reserved(public_port):
+            raise HTTPException(status_code=400, detail=f"Public port {public_port} is reserved")
+        
+        # 创建隧道, 隧道ID与客户端ID相同, 以这个ID连接的客户端负责转发
         client_id = str(uuid.uuid4())
-        logger.info(f"Creating new tunnel with ID {client_id}")
         
         try:
-            manager.register_tunnel(client_id, local_port, public_port, custom_domain)
-            logger.info(f"Tunnel created successfully: {manager.tunnels[client_id]}")
+            tunnel = await manager.register_tunnel(
+                client_id, local_port, public_port, custom_domain, cache, compress,
+                owner=current_user.username, limits=limits, group=group
+            )
+            logger.info("Tunnel created successfully: %s", client_id)
         except ValueError as e:
-            logger.error(f"Failed to create tunnel: {str(e)}")
+            logger.error("Failed to create tunnel: %s", e)
             raise HTTPException(status_code=400, detail=str(e))
         
         # 返回成功响应
         response_data = {
+            "tunnel_id": tunnel["tunnel_id"],
             "client_id": client_id,
             "status": "success",
             "local_port": local_port,
             "public_port": public_port,
-            "custom_domain": custom_domain
+            "custom_domain": tunnel["custom_domain"],
+            "cache": cache,
+            "compress": compress,
+            "group": tunnel["group"],
+            "limits": limits
         }
-        logger.info(f"Returning response: {response_data}")
+        if TUNNEL_BASE_DOMAIN:
+            response_data["hostname"] = f"{public_port}.{TUNNEL_BASE_DOMAIN}"
+        logger.debug("Returning response: %s", response_data)
         return response_data
         
+    except HTTPException:
+        raise
     except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON in request: {str(e)}")
+        logger.error("Invalid JSON in request: %s", e)
         raise HTTPException(status_code=400, detail="Invalid JSON format")
     except ValueError as e:
-        logger.error(f"Value error in request: {str(e)}")
+        logger.error("Value error in request: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Unexpected error creating tunnel: {str(e)}")
+        logger.error("Unexpected error creating tunnel: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.delete("/api/tunnels/{client_id}")
+async def release_tunnel_resources(tunnel: dict):
+    """隧道删除后, 等它进行中的请求结束 (最多 DRAIN_TIMEOUT 秒, 到时取消) 再清理它的指标, 缓存,
+    以及不再被引用的上游连接池; 隧道组还有其他成员时保留端口的指标和缓存"""
+    cancelled = await in_flight.wait(tunnel["tunnel_id"], DRAIN_TIMEOUT)
+    if cancelled:
+        logger.warning("Cancelled %d requests still running on removed tunnel %s", cancelled, tunnel["tunnel_id"])
+    if tunnel["public_port"] not in manager.port_index:
+        forget_tunnel_metrics(tunnel["public_port"])
+        edge_cache.purge(tunnel["public_port"])
+    local_port = tunnel["local_port"]
+    if not manager.local_port_in_use(local_port):
+        await upstream_pool.release(local_port)
+
+def drain_tunnel(tunnel: dict):
+    """在后台排空并清理已删除的隧道"""
+    task = asyncio.create_task(release_tunnel_resources(tunnel))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def discard_tunnel(tunnel_id: str):
+    """删除隧道, 之后的请求不再路由到它, 进行中的请求在后台排空; 返回被删除的隧道, 不存在时返回 None"""
+    tunnel = manager.remove_tunnel(tunnel_id)
+    if tunnel is not None:
+        drain_tunnel(tunnel)
+    return tunnel
+
+@app.delete("/api/tunnels/{tunnel_id}")
 async def delete_tunnel(
-    client_id: str,
+    tunnel_id: str,
     current_user: User = Depends(get_current_user)
 ):
-    if client_id in manager.tunnels:
-        del manager.tunnels[client_id]
+    if await discard_tunnel(tunnel_id) is not None:
         return {"status": "success"}
     raise HTTPException(status_code=404, detail="Tunnel not found")
 
+@app.delete("/api/tunnels/{tunnel_id}/cache")
+async def purge_tunnel_cache(
+    tunnel_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """清空隧道的边缘缓存"""
+    tunnel = manager.tunnels.get(tunnel_id)
+    if tunnel is None:
+        raise HTTPException(status_code=404, detail="Tunnel not found")
+    edge_cache.purge(tunnel["public_port"])
+    return {"status": "success"}
+
+async def read_limits(request: Request):
+    try:
+        return validate_limits(await request.json())
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.put("/api/tunnels/{tunnel_id}/limits")
+async def set_tunnel_limits(
+    tunnel_id: str,
+    request: Request,
+    current_user: User = Depends(get_admin_user)
+):
+    """设置隧道的限额 (仅管理员), 请求体为 rate_limit.LIMIT_FIELDS 中的字段, 空对象或 null 表示取消限制"""
+    limits = await read_limits(request)
+    try:
+        tunnel = await manager.set_tunnel_limits(tunnel_id, limits)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if tunnel is None:
+        raise HTTPException(status_code=404, detail="Tunnel not found")
+    logger.info("Limits of tunnel %s set to %s by %s", tunnel_id, limits, current_user.username)
+    return {"status": "success", "limits": limits}
+
+@app.get("/api/users/{username}/limits")
+async def get_user_limits(username: str, current_user: User = Depends(get_current_user)):
+    """管理员可以查看所有用户, 其他用户只能查看自己"""
+    if username != current_user.username and not current_user.admin:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    user = user_store.get(username)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"username": username, "limits": user.get("limits")}
+
+@app.put("/api/users/{username}/limits")
+async def set_user_limits(
+    username: str,
+    request: Request,
+    current_user: User = Depends(get_admin_user)
+):
+    """设置用户的限额 (仅管理员), 对该用户经 API 创建的所有隧道合计生效"""
+    limits = await read_limits(request)
+    user = user_store.get(username)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    await user_store.update({**user, "limits": limits})
+    logger.info("Limits of user %s set to %s by %s", username, limits, current_user.username)
+    return {"status": "success", "limits": limits}
+
+# 诊断API
+@app.get("/api/admin/diagnostics")
+async def get_diagnostics(
+    port: int | None = None,
+    limit: int = 100,
+    current_user: User = Depends(get_admin_user)
+):
+    """最近的事件循环卡顿 (含调用栈) 和请求耗时, 以及按路由和隧道汇总的各阶段耗时 (仅管理员);
+    指定 port 时只看该隧道的请求"""
+    limit = max(0, min(limit, TIMING_HISTORY))
+    return {
+        "enabled": DIAGNOSTICS_ENABLED,
+        "stall_threshold": stall_detector.threshold,
+        "stalls_total": stall_detector.count,
+        "stalls": stall_detector.recent(limit),
+        "timings": {
+            **timings.summary(port),
+            "recent": timings.recent(limit, port)
+        }
+    }
+
+@app.get("/api/admin/profile")
+async def profile_event_loop(
+    seconds: float = 5,
+    interval: float = 0.005,
+    limit: int = 30,
+    format: str = "json",
+    current_user: User = Depends(get_admin_user)
+):
+    """对事件循环线程采样 seconds 秒 (仅管理员); format=collapsed 时返回全部折叠的调用栈 (每行 "栈 次数")"""
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]")
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="interval must be between 0.001 and 1")
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be json or collapsed")
+    try:
+        stacks = await profiler.profile(seconds, interval)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    samples = sum(stacks.values())
+    logger.info("Event loop profiled for %ss (%d samples) by %s", seconds, samples, current_user.username)
+    if format == "collapsed":
+        return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in stacks.most_common()))
+    return {
+        "seconds": seconds,
+        "interval": interval,
+        "samples": samples,
+        "functions": top_functions(stacks, limit),
+        "stacks": top_stacks(stacks, limit)
+    }
+
+def forward_headers(request: Request, extra_headers=()):
+    """需要转发给上游的请求头, extra_headers 替换同名的请求头, 值为 None 时删除"""
+    replaced = {k for k, _ in extra_headers}
+    headers = [
+        (k, v) for k, v in request.headers.items()
+        if k not in HOP_BY_HOP_HEADERS and k != "host" and k not in replaced
+    ]
+    headers.extend((k, v) for k, v in extra_headers if v is not None)
+    return headers
+
+def has_request_body(request: Request) -> bool:
+    if "transfer-encoding" in request.headers:
+        return True
+    return request.headers.get("content-length", "0") != "0"
+
+async def count_chunks(chunks, counter):
+    """原样传递数据块, 同时累计字节数"""
+    async for chunk in chunks:
+        counter.inc(len(chunk))
+        yield chunk
+
+async def release_after(chunks, release):
+    """原样传递数据块, 响应体发送完或被放弃后调用 release()"""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        release()
+
+async def balanced(tunnel: dict, forward):
+    """隧道组按负载均衡策略选一个成员, 以它调用 forward(member) 并记录延迟和结果;
+    成员的进行中请求数在响应体发送完后才减少"""
+    member, group, backend = manager.pick_member(tunnel)
+    in_flight.track(member["tunnel_id"])
+    if group is None:
+        return await forward(member)
+    group.start(backend)
+    started = time.perf_counter()
+    try:
+        response = await forward(member)
+    except Exception as e:
+        group.done(backend)
+        # 上游拒绝的请求 (4xx) 不算成员故障
+        ok = isinstance(e, HTTPException) and e.status_code < 500
+        group.observe(backend, time.perf_counter() - started, ok)
+        raise
+    group.observe(backend, time.perf_counter() - started, response.status_code < 500)
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = release_after(response.body_iterator, partial(group.done, backend))
+    else:
+        group.done(backend)
+    return response
+
+def compress_response(request: Request, response):
+    """隧道开启 compress 时按 Accept-Encoding 压缩上游未压缩的文本响应, 边转发边压缩"""
+    if not isinstance(response, StreamingResponse) or request.method == "HEAD":
+        return response
+    if not is_compressible(response.status_code, response.raw_headers):
+        return response
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    if encoding is None:
+        response.raw_headers = add_vary(response.raw_headers)
+        return response
+    response.raw_headers = encoded_headers(response.raw_headers, encoding)
+    response.body_iterator = compress_stream(response.body_iterator, encoding)
+    return response
+
+def make_streaming_response(status: int, headers, body) -> StreamingResponse:
+    """用上游的状态码和头部构造流式响应, 保留重复的头部 (如 Set-Cookie)"""
+    response = StreamingResponse(body, status_code=status)
+    response.raw_headers = [
+        (k.lower().encode("latin-1"), v.encode("latin-1"))
+        for k, v in headers
+        if k.lower() not in HOP_BY_HOP_HEADERS
+    ]
+    return response
+
+async def forward_to_upstream(local_port: int, path: str, request: Request, body, extra_headers=()):
+    """直接经连接池转发到本机端口, 用于没有在线客户端的隧道"""
+    # 熔断打开时快速失败, 不再对上游发起请求
+    if not upstream_pool.is_available(local_port):
+        proxy_logger.warning("Local service on port %s is unavailable", local_port)
+        raise HTTPException(status_code=502, detail="Local service not available")
+    
+    # 构建目标URL
+    target_url = f"http://{UPSTREAM_HOST}:{local_port}{path}"
+    if request.url.query:
+        target_url += f"?{request.url.query}"
+        
+    # 使用连接池中的会话发送请求
+    session = upstream_pool.get_session(local_port)
+    method = request.method
+    headers = forward_headers(request, extra_headers)
+    
+    proxy_logger.debug("Sending %s request to %s with headers: %s", method, target_url, headers)
+    try:
+        # 有请求体时直接把请求流交给 aiohttp, 边收边发
+        response = await session.request(
+            method=method,
+            url=target_url,
+            headers=headers,
+            data=body,
+            allow_redirects=False
+        )
+    except aiohttp.ClientError as e:
+        upstream_pool.record_failure(local_port)
+        error_msg = f"Failed to forward request: {str(e)}"
+        proxy_logger.error("%s", error_msg)
+        raise HTTPException(status_code=502, detail=error_msg)
+    except asyncio.TimeoutError:
+        upstream_pool.record_failure(local_port)
+        error_msg = "Request timed out"
+        proxy_logger.error("%s to %s", error_msg, target_url)
+        raise HTTPException(status_code=504, detail=error_msg)
+    
+    upstream_pool.record_success(local_port)
+    proxy_logger.debug("Received response with status: %s", response.status)
+    
+    async def stream_body():
+        # 每次只读一个块, 客户端消费慢时上游读取也随之暂停
+        try:
+            async for chunk in response.content.iter_chunked(PROXY_CHUNK_SIZE):
+                yield chunk
+        finally:
+            response.release()
+    
+    return make_streaming_response(response.status, response.headers.items(), stream_body())
+
+async def forward_through_client(
+    mux: Multiplexer, path: str, request: Request, body, routes=(), extra_headers=()
+):
+    """经客户端的 WebSocket 转发, 每个请求占用一个独立的流
+
+    routes 见 client_route, 包含客户端ID时 mux 是到其他 worker 的内部连接, 由那个 worker 转交给客户端
+    """
+    target = path or "/"
+    if request.url.query:
+        target += f"?{request.url.query}"
+    
+    stream = mux.open_stream(*routes)
+    try:
+        head = encode_request_head(request.method, target, forward_headers(request, extra_headers))
+        await stream.send_head(head, end_stream=body is None)
+        mark_connected()
+        if body is not None:
+            async for chunk in body:
+                if chunk:
+                    await stream.write(chunk)
+            await stream.end()
+        status, headers = decode_response_head(
+            await asyncio.wait_for(stream.wait_head(), timeout=UPSTREAM_TIMEOUT)
+        )
+    except StreamReset as e:
+        error_msg = f"Failed to forward request: {str(e)}"
+        proxy_logger.error("%s", error_msg)
+        raise HTTPException(status_code=502, detail=error_msg)
+    except asyncio.TimeoutError:
+        await stream.reset("timeout")
+        proxy_logger.error("Request timed out on stream %s", stream.id)
+        raise HTTPException(status_code=504, detail="Request timed out")
+    
+    proxy_logger.debug("Received response with status: %s on stream %s", status, stream.id)
+    
+    async def stream_body():
+        try:
+            async for chunk in stream.iter_chunks():
+                yield chunk
+        finally:
+            # 浏览器中途断开时通知客户端停止发送
+            if not stream.remote_closed:
+                await stream.reset("cancelled")
+    
+    return make_streaming_response(status, headers, stream_body())
+
+async def open_upstream_websocket(local_port: int, target: str, headers, protocols):
+    """直接与本机端口建立 WebSocket, 返回 (端点, 上游选定的子协议)"""
+    if not upstream_pool.is_available(local_port):
+        proxy_logger.warning("Local service on port %s is unavailable", local_port)
+        raise HTTPException(status_code=502, detail="Local service not available")
+    
+    session = upstream_pool.get_websocket_session()
+    try:
+        ws = await asyncio.wait_for(session.ws_connect(
+            f"ws://{UPSTREAM_HOST}:{local_port}{target}",
+            headers=headers,
+            protocols=protocols,
+            heartbeat=WS_PROXY_HEARTBEAT,
+            max_msg_size=WS_MAX_MESSAGE_SIZE
+        ), timeout=UPSTREAM_TIMEOUT)
+    except aiohttp.WSServerHandshakeError as e:
+        # 上游正常响应但拒绝升级, 不计入熔断
+        upstream_pool.record_success(local_port)
+        raise HTTPException(status_code=e.status, detail=f"Upgrade rejected: {e.message}")
+    except aiohttp.ClientError as e:
+        upstream_pool.record_failure(local_port)
+        error_msg = f"Failed to forward request: {str(e)}"
+        proxy_logger.error("%s", error_msg)
+        raise HTTPException(status_code=502, detail=error_msg)
+    except asyncio.TimeoutError:
+        upstream_pool.record_failure(local_port)
+        proxy_logger.error("WebSocket handshake timed out on port %s", local_port)
+        raise HTTPException(status_code=504, detail="Request timed out")
+    upstream_pool.record_success(local_port)
+    return AiohttpEndpoint(ws), ws.protocol
+
+async def open_client_websocket(mux: Multiplexer, target: str, headers, protocols, routes=()):
+    """经客户端建立 WebSocket, 返回 (流端点, 上游选定的子协议)"""
+    if protocols:
+        headers = headers + [("sec-websocket-protocol", ", ".join(protocols))]
+    stream = mux.open_stream(*routes)
+    try:
+        await stream.send_head(encode_request_head(WEBSOCKET_METHOD, target, headers))
+        status, response_headers = decode_response_head(
+            await asyncio.wait_for(stream.wait_head(), timeout=UPSTREAM_TIMEOUT)
+        )
+    except StreamReset as e:
+        error_msg = f"Failed to forward request: {str(e)}"
+        proxy_logger.error("%s", error_msg)
+        raise HTTPException(status_code=502, detail=error_msg)
+    except asyncio.TimeoutError:
+        await stream.reset("timeout")
+        proxy_logger.error("WebSocket handshake timed out on stream %s", stream.id)
+        raise HTTPException(status_code=504, detail="Request timed out")
+    
+    endpoint = StreamEndpoint(stream)
+    if status != 101:
+        await endpoint.release()
+        raise HTTPException(status_code=status, detail="Upgrade rejected by local service")
+    subprotocol = next((v for k, v in response_headers if k.lower() == "sec-websocket-protocol"), None)
+    return endpoint, subprotocol
+
+@app.websocket("/proxy/{port}{path:path}")
+async def proxy_websocket(websocket: WebSocket, port: int, path: str):
+    """WebSocket 升级请求: 先与上游握手, 成功后接受连接并双向转发消息"""
+    start = time.perf_counter()
+    status = 500
+    recorded = False
+    upstream = None
+    group = backend = None
+    try:
+        tunnel = await manager.lookup_tunnel_by_port(port)
+        if not tunnel:
+            raise HTTPException(status_code=404, detail=f"No tunnel found for port {port}")
+        recorded = METRICS_ENABLED
+        
+        target = path or "/"
+        if websocket.url.query:
+            target += f"?{websocket.url.query}"
+        headers, protocols = handshake_headers(websocket.headers.items())
+        
+        # 隧道组中 WebSocket 只在握手时选择成员, 之后一直连在它上面
+        member, group, backend = manager.pick_member(tunnel)
+        in_flight.track(member["tunnel_id"])
+        if group is not None:
+            group.start(backend)
+        handshake = time.perf_counter()
+        try:
+            route = await client_route(member)
+            if route is not None:
+                upstream, subprotocol = await open_client_websocket(route[0], target, headers, protocols, route[1])
+            else:
+                upstream, subprotocol = await open_upstream_websocket(member["local_port"], target, headers, protocols)
+        except Exception as e:
+            if group is not None:
+                ok = isinstance(e, HTTPException) and e.status_code < 500
+                group.observe(backend, time.perf_counter() - handshake, ok)
+            raise
+        if group is not None:
+            group.observe(backend, time.perf_counter() - handshake, True)
+        await websocket.accept(subprotocol)
+        status = 101
+        
+        received = sent = None
+        if recorded:
+            upstream_latency.labels(port).observe(time.perf_counter() - start)
+            received = tunnel_bytes_received.labels(port, "websocket")
+            sent = tunnel_bytes_sent.labels(port, "websocket")
+        # 一个 WebSocket 在整个生命周期内占用一个并发名额 (见 AdmissionGate)
+        admission = websocket.scope.get("state", {}).get("admission")
+        shape = admission.shape if admission is not None and admission.shaping() else None
+        code, reason = await bridge(StarletteEndpoint(websocket), upstream, received, sent, shape)
+        proxy_logger.debug("WebSocket for port %s closed with code %s %s", port, code, reason)
+    except HTTPException as e:
+        status = e.status_code
+        proxy_logger.info("WebSocket upgrade for port %s rejected: %s", port, e.detail)
+        # 尚未接受时关闭, uvicorn 以 403 拒绝升级
+        await websocket.close()
+    finally:
+        if upstream is not None:
+            await upstream.release()
+        if group is not None:
+            group.done(backend)
+        if recorded:
+            tunnel_requests.labels(port, f"{status // 100}xx").inc()
+        access_log.log("GET", f"/proxy/{port}{path}", status, time.perf_counter() - start)
+
 @app.api_route("/proxy/{port}{path:path}", methods=["GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH"])
 async def proxy_request(port: int, path: str, request: Request):
+    start = time.perf_counter()
+    status = 500
+    recorded = False  # 只为存在的隧道记录指标, 随意的端口号不会产生新的标签
     try:
-        logger.info(f"Received proxy request for port: {port}, path: {path}")
-        logger.info(f"Request headers: {dict(request.headers)}")
-        logger.info(f"Available tunnels: {manager.tunnels}")
+        proxy_logger.debug("Received proxy request for port: %s, path: %s", port, path)
+        proxy_logger.debug("Request headers: %s", request.headers)
         
         # 查找对应的隧道
-        tunnel = None
-        for client_id, tunnel_info in manager.tunnels.items():
-            logger.info(f"Checking tunnel: {client_id} -> {tunnel_info}")
-            if tunnel_info["public_port"] == port:
-                tunnel = tunnel_info
-                break
+        tunnel = await manager.lookup_tunnel_by_port(port)
         
         if not tunnel:
-            logger.error(f"No tunnel found for port {port}")
+            proxy_logger.info("No tunnel found for port %s", port)
             raise HTTPException(status_code=404, detail=f"No tunnel found for port {port}")
-            
-        local_port = tunnel["local_port"]
-        logger.info(f"Found tunnel, forwarding to local port: {local_port}")
+        recorded = METRICS_ENABLED
+        tag_tunnel(port)
+        # 已由 AdmissionGate 准入, 设置了 bytes_per_second 时对请求体和响应体整形
+        admission = request.scope.get("state", {}).get("admission")
+        shaping = admission is not None and admission.shaping()
         
-        # 检查本地服务是否可用
-        try:
-            async with aiohttp.ClientSession() as session:
-                check_url = f"http://localhost:{local_port}/"
-                async with session.get(check_url) as response:
-                    logger.info(f"Local service check response: {response.status}")
-        except Exception as e:
-            logger.error(f"Local service not available: {str(e)}")
-            raise HTTPException(status_code=502, detail=f"Local service not available: {str(e)}")
+        body = request.stream() if has_request_body(request) else None
+        if body is not None and shaping:
+            body = admission.shape_chunks(body)
+        if body is not None and recorded:
+            body = count_chunks(body, tunnel_bytes_received.labels(port, "http"))
         
-        # 构建目标URL
-        target_url = f"http://localhost:{local_port}{path}"
-        if request.url.query:
-            target_url += f"?{request.url.query}"
-            
-        logger.info(f"Forwarding request to: {target_url}")
-            
-        # 使用aiohttp发送请求
-        async with aiohttp.ClientSession() as session:
-            method = request.method
-            headers = dict(request.headers)
-            
-            # 移除可能导致问题的头部
-            headers.pop('host', None)
-            headers.pop('content-length', None)
-            headers.pop('connection', None)
-            headers.pop('keep-alive', None)
-            headers.pop('transfer-encoding', None)
-            
-            body = await request.body()
-            
-            logger.info(f"Sending {method} request to {target_url} with headers: {headers}")
-            try:
-                async with session.request(
-                    method=method,
-                    url=target_url,
-                    headers=headers,
-                    data=body if body else None,
-                    allow_redirects=True,
-                    timeout=aiohttp.ClientTimeout(total=10)
-                ) as response:
-                    content = await response.read()
-                    logger.info(f"Received response with status: {response.status}")
-                    return Response(
-                        content=content,
-                        status_code=response.status,
-                        headers=dict(response.headers)
-                    )
-            except aiohttp.ClientError as e:
-                error_msg = f"Failed to forward request: {str(e)}"
-                logger.error(error_msg)
-                raise HTTPException(status_code=502, detail=error_msg)
-            except asyncio.TimeoutError:
-                error_msg = "Request timed out"
-                logger.error(error_msg)
-                raise HTTPException(status_code=504, detail=error_msg)
+        async def forward(member, extra_headers=()):
+            # 隧道所属客户端在线时经由它的 WebSocket 转发 (可能经过持有它的 worker), 否则直连本地端口
+            mark_forward()
+            route = await client_route(member)
+            if route is not None:
+                proxy_logger.debug("Found tunnel, forwarding through client %s", member["client_id"])
+                return await forward_through_client(route[0], path, request, body, route[1], extra_headers)
+            local_port = member["local_port"]
+            proxy_logger.debug("Found tunnel, forwarding to local port: %s", local_port)
+            return await forward_to_upstream(local_port, path, request, body, extra_headers)
+        
+        async def fetch(extra_headers=()):
+            return await balanced(tunnel, partial(forward, extra_headers=extra_headers))
+        
+        if tunnel.get("cache") and request.method in ("GET", "HEAD"):
+            target = path or "/"
+            if request.url.query:
+                target += f"?{request.url.query}"
+            response, result = await edge_cache.handle(port, target, request, fetch, tunnel.get("compress", False))
+            if recorded:
+                cache_requests.labels(port, result).inc()
+        else:
+            response, result = await fetch(), None
+        if tunnel.get("compress"):
+            response = compress_response(request, response)
+        status = response.status_code
+        if shaping:
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = admission.shape_chunks(response.body_iterator)
+            else:
+                await admission.shape(len(response.body))
+        if recorded:
+            if result != "hit":
+                upstream_latency.labels(port).observe(time.perf_counter() - start)
+            sent = tunnel_bytes_sent.labels(port, "http")
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = count_chunks(response.body_iterator, sent)
+            else:
+                # 缓存命中时响应体已在内存中
+                sent.inc(len(response.body))
+        return response
                 
-    except HTTPException:
+    except HTTPException as e:
+        status = e.status_code
         raise
     except Exception as e:
         error_msg = f"Proxy error: {str(e)}"
-        logger.error(error_msg)
+        proxy_logger.exception("%s", error_msg)
         raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        if recorded:
+            tunnel_requests.labels(port, f"{status // 100}xx").inc()
+        access_log.log(request.method, f"/proxy/{port}{path}", status, time.perf_counter() - start)
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """Prometheus 文本格式的指标"""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(
-        "server:app",
-        host=os.getenv("SERVER_HOST", "0.0.0.0"),
-        port=int(os.getenv("SERVER_PORT", 8080)),
-        reload=True,  # 启用热重载
-        reload_dirs=["templates", "."],  # 监视这些目录的变化
-        reload_delay=0.25  # 重载延迟，防止过于频繁
-    )
+    host = os.getenv("SERVER_HOST", "0.0.0.0")
+    if os.getenv("SERVER_RELOAD", "true").lower() == "true":
+        import uvicorn
+        uvicorn.run(
+            "server:app",
+            host=host,
+            port=SERVER_PORT,
+            reload=True,  # 启用热重载
+            reload_dirs=["templates", "."],  # 监视这些目录的变化
+            reload_delay=0.25  # 重载延迟，防止过于频繁
+        )
+    else:
+        # 生产部署: 交接时新进程与旧进程同时监听, 旧进程收到 SIGTERM 后排空再退出
+        serve(app, host, SERVER_PORT, in_flight, begin_drain, finish_drain, prepare_handoff, SERVER_HANDOFF)
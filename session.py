@@ -0,0 +1,128 @@
+"""
+可续传的隧道会话
+
+客户端断线重连后, 服务端在宽限期 (SESSION_GRACE_PERIOD) 内保留隧道和多路复用器,
+客户端带上会话令牌重连即可接着使用原来的会话, 进行中的流不受影响.
+
+续传不改变帧格式: WebSocket 本身保证顺序, 两端只需数自己收到了多少个二进制帧.
+发送方保留对端尚未确认的帧; 重连时双方交换已收到的帧数, 各自从对端缺少的那一帧开始重发.
+确认以控制消息发送 (JSON 文本, 或协商后为 codec.py 的二进制编码):
+
+    {"type": "ack", "received": n}                       收到较多帧后发送
+    {"type": "ping", "id": k, "received": n}             客户端定时发送, 兼作确认
+    {"type": "pong", "id": k, "received": n}             服务端回复, 客户端据此测量 RTT
+    {"type": "session", "token": t, "resumed": b, "received": n, "grace": g}
+                                                         服务端在连接建立后首先发送
+
+连接断开期间写出的帧只进入缓冲区, 续传后按顺序补发; 缓冲区超过 RESUME_BUFFER_BYTES 时
+发送方等待对端确认 (断开期间即暂停发送), 宽限期结束仍未续传则会话关闭, 所有流以 StreamReset 结束.
+"""
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable
+
+from protocol import StreamReset
+
+SESSION_GRACE_PERIOD = float(os.getenv("SESSION_GRACE_PERIOD", 30))  # 为 0 时断开即结束会话
+RESUME_BUFFER_BYTES = int(os.getenv("RESUME_BUFFER_BYTES", 16 * 1024 * 1024))
+
+# 收到多少帧后主动发送一次确认
+ACK_INTERVAL_FRAMES = 32
+
+
+class ResumableLink:
+    """多路复用器与当前 WebSocket 之间的一层, 给发出的帧计数并保留到对端确认"""
+    def __init__(self, buffer_limit: int = RESUME_BUFFER_BYTES):
+        self.buffer_limit = buffer_limit
+        self.received = 0  # 已收到的帧数
+        self.closed = False
+        self._send: Callable[[bytes], Awaitable[None]] | None = None  # 断开期间为 None
+        self._unacked = deque()  # 已发出但对端尚未确认的帧
+        self._acked = 0  # 对端已确认的帧数, 即 _unacked[0] 之前的帧数
+        self._buffered = 0  # _unacked 的总字节数
+        self._acknowledged = 0  # 最近一次告诉对端的 received
+        self._lock = asyncio.Lock()
+        self._space = asyncio.Event()
+        self._space.set()
+
+    @property
+    def attached(self) -> bool:
+        return self._send is not None
+
+    async def send(self, frame: bytes):
+        """Multiplexer 的发送函数; 断开期间只写入缓冲区"""
+        while self._buffered >= self.buffer_limit and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        if self.closed:
+            raise StreamReset("session closed")
+        async with self._lock:
+            self._unacked.append(frame)
+            self._buffered += len(frame)
+            if self._send is not None:
+                try:
+                    await self._send(frame)
+                except Exception:
+                    # 连接已断开, 帧留在缓冲区中, 续传时重发
+                    self._send = None
+
+    async def send_message(self, message):
+        """与帧经同一个发送顺序写出的控制消息, 不计数也不缓冲, 断开期间丢弃;
+        需要 attach 时传入的 send 也能发送文本"""
+        async with self._lock:
+            if self._send is not None:
+                try:
+                    await self._send(message)
+                except Exception:
+                    self._send = None
+
+    def on_frame(self):
+        """收到一个二进制帧后调用"""
+        self.received += 1
+
+    def ack_due(self) -> bool:
+        """是否应该发送确认; 返回 True 时视为已确认到 received"""
+        if self.received - self._acknowledged >= ACK_INTERVAL_FRAMES:
+            self._acknowledged = self.received
+            return True
+        return False
+
+    def acknowledged(self) -> int:
+        """随 ping/pong 附带确认时调用, 返回要告诉对端的 received"""
+        self._acknowledged = self.received
+        return self.received
+
+    def ack(self, received: int):
+        """对端已收到 received 个帧, 丢弃这些帧"""
+        while self._acked < received and self._unacked:
+            self._buffered -= len(self._unacked.popleft())
+            self._acked += 1
+        if self._buffered < self.buffer_limit:
+            self._space.set()
+
+    async def attach(self, send: Callable[[bytes], Awaitable[None]], received: int):
+        """换到新的连接: 丢弃对端已收到的帧, 按顺序重发其余的帧"""
+        async with self._lock:
+            self.ack(received)
+            if received > self._acked:
+                raise StreamReset("peer received frames that were never sent")
+            self._send = send
+            try:
+                for frame in list(self._unacked):
+                    await send(frame)
+            except Exception:
+                self._send = None
+                raise
+        self._acknowledged = self.received
+
+    def detach(self):
+        self._send = None
+
+    def close(self):
+        """会话结束, 等待缓冲区空间的发送方以 StreamReset 结束"""
+        self.closed = True
+        self._send = None
+        self._unacked.clear()
+        self._buffered = 0
+        self._space.set()
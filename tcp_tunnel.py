@@ -0,0 +1,293 @@
+"""
+原始 TCP 隧道
+
+为每个隧道的 public_port 打开监听, 把连接上的字节原样转发到隧道目标:
+隧道所属客户端在线时经多路复用流 (CONNECT 请求) 转发, 否则直连本机的 local_port.
+
+转发直接操作非阻塞 socket, 每个方向只分配一块缓冲区, 用 sock_recv_into 循环复用;
+一端读到 EOF 时只关闭另一端的写方向, 两个方向都结束后才关闭连接.
+
+监听平时不设置 SO_REUSEPORT, 其他 socket 不能加入隧道端口. 平滑重启 (见 drain.py) 时旧进程
+share() 后给全部监听设置它, 新进程对 adopt() 过的端口 (从注册表恢复的隧道) 先照常监听,
+端口被占用时再以 SO_REUSEPORT 加入旧进程的监听.
+隧道删除后端口立即停止监听, 已有的连接最多再保持 DRAIN_TIMEOUT 秒.
+"""
+import asyncio
+import errno
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Set
+
+from protocol import Stream, StreamReset, encode_request_head, decode_response_head
+
+logger = logging.getLogger(__name__)
+
+TCP_BIND_HOST = os.getenv("TCP_BIND_HOST", "0.0.0.0")
+TCP_RELAY_BUFFER_SIZE = int(os.getenv("TCP_RELAY_BUFFER_SIZE", 64 * 1024))
+TCP_IDLE_TIMEOUT = float(os.getenv("TCP_IDLE_TIMEOUT", 300))
+TCP_CONNECT_TIMEOUT = float(os.getenv("TCP_CONNECT_TIMEOUT", 10))
+
+
+class _Activity:
+    """记录连接最近一次收发数据的时间, 用于空闲超时"""
+    __slots__ = ("last",)
+
+    def __init__(self):
+        self.last = time.monotonic()
+
+    def touch(self):
+        self.last = time.monotonic()
+
+
+def _shutdown_write(sock: socket.socket):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+async def _connect(host: str, port: int) -> socket.socket:
+    loop = asyncio.get_running_loop()
+    last_error = OSError(f"Cannot resolve {host}")
+    for family, type_, proto, _, address in await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except OSError as e:
+            sock.close()
+            last_error = e
+            continue
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    raise last_error
+
+
+async def _pump_socket(src: socket.socket, dst: socket.socket, activity: _Activity, counter=None):
+    loop = asyncio.get_running_loop()
+    buffer = bytearray(TCP_RELAY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        size = await loop.sock_recv_into(src, buffer)
+        if size == 0:
+            break
+        activity.touch()
+        if counter is not None:
+            counter.inc(size)
+        # sock_sendall 返回前数据已全部交给内核, 缓冲区可以立即复用
+        await loop.sock_sendall(dst, view[:size])
+    _shutdown_write(dst)
+
+
+async def _pump_to_stream(src: socket.socket, stream, activity: _Activity, counter=None):
+    loop = asyncio.get_running_loop()
+    buffer = bytearray(TCP_RELAY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        size = await loop.sock_recv_into(src, buffer)
+        if size == 0:
+            break
+        activity.touch()
+        if counter is not None:
+            counter.inc(size)
+        await stream.write(view[:size])
+    await stream.end()
+
+
+async def _pump_from_stream(stream, dst: socket.socket, activity: _Activity, counter=None):
+    loop = asyncio.get_running_loop()
+    async for chunk in stream.iter_chunks():
+        activity.touch()
+        if counter is not None:
+            counter.inc(len(chunk))
+        await loop.sock_sendall(dst, chunk)
+    _shutdown_write(dst)
+
+
+class TcpListeners:
+    """按公网端口管理 TCP 监听和其上的连接
+
+    resolve: 根据公网端口返回 (打开多路复用流的函数或 None, 上游主机, 本地端口) 的协程函数,
+             隧道不存在时返回 None
+    traffic: 根据公网端口返回 (接收, 发送) 两个带 inc() 的计数器, 或 None 表示不计数
+    """
+    def __init__(
+        self,
+        resolve: Callable[[int], Awaitable[tuple | None]],
+        traffic: Callable[[int], tuple | None] | None = None
+    ):
+        self._resolve = resolve
+        self._traffic = traffic
+        self._listeners: Dict[int, socket.socket] = {}
+        self._accept_tasks: Dict[int, asyncio.Task] = {}
+        self._connections: Dict[int, Set[asyncio.Task]] = {}
+        self._draining: List[Set[asyncio.Task]] = []  # 已停止监听的端口上仍在排空的连接
+        self.shared = False  # 已准备交接, 之后打开的监听也设置 SO_REUSEPORT
+        self._adopted: Set[int] = set()  # 可以加入旧进程监听的端口
+
+    def is_listening(self, public_port: int) -> bool:
+        return public_port in self._listeners
+
+    def connection_count(self) -> int:
+        return sum(len(tasks) for tasks in self._connections.values()) + sum(map(len, self._draining))
+
+    def listening_sockets(self) -> List[socket.socket]:
+        return list(self._listeners.values())
+
+    def open(self, public_port: int):
+        """开始监听公网端口, 已在监听时不做任何事"""
+        if public_port in self._listeners:
+            return
+        address = (TCP_BIND_HOST, public_port)
+        try:
+            listener = socket.create_server(address, backlog=1024, reuse_port=self.shared)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or public_port not in self._adopted:
+                raise
+            # 交接中旧进程仍在监听, 加入它的 SO_REUSEPORT 组; 旧进程没有准备交接时同样失败
+            listener = socket.create_server(address, backlog=1024, reuse_port=True)
+            logger.info("TCP tunnel port %s taken over from the previous process", public_port)
+        finally:
+            self._adopted.discard(public_port)
+        listener.setblocking(False)
+        self._listeners[public_port] = listener
+        self._connections[public_port] = set()
+        self._accept_tasks[public_port] = asyncio.create_task(self._accept_loop(public_port, listener))
+        logger.info("TCP tunnel listening on %s:%s", TCP_BIND_HOST, public_port)
+
+    def share(self):
+        """准备交接: 允许新进程加入所有监听的端口"""
+        self.shared = True
+        for listener in self._listeners.values():
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def adopt(self, ports):
+        """接替旧进程: 这些端口第一次打开时可以加入旧进程的监听"""
+        self._adopted.update(ports)
+
+    def close(self, public_port: int, drain: float = 0):
+        """停止监听; drain 为 0 时断开该端口上的所有连接, 否则已有连接最多再保持 drain 秒"""
+        listener = self._listeners.pop(public_port, None)
+        if listener is None:
+            return
+        self._accept_tasks.pop(public_port).cancel()
+        connections = self._connections.pop(public_port)
+        listener.close()
+        if drain > 0 and connections:
+            self._draining.append(connections)
+            asyncio.get_running_loop().call_later(drain, self._cut, connections)
+            logger.info("TCP tunnel on port %s closed, draining %d connections", public_port, len(connections))
+            return
+        for task in connections:
+            task.cancel()
+        logger.info("TCP tunnel on port %s closed", public_port)
+
+    def _cut(self, connections: Set[asyncio.Task]):
+        """排空到时, 断开仍未结束的连接"""
+        if connections:
+            logger.info("Closing %d TCP connections still open after draining", len(connections))
+        for task in list(connections):
+            task.cancel()
+        self._draining = [tasks for tasks in self._draining if tasks is not connections]
+
+    def close_all(self, drain: float = 0):
+        for public_port in list(self._listeners):
+            self.close(public_port, drain)
+        if not drain:
+            for connections in self._draining:
+                for task in list(connections):
+                    task.cancel()
+            self._draining = []
+
+    async def _accept_loop(self, public_port: int, listener: socket.socket):
+        loop = asyncio.get_running_loop()
+        connections = self._connections[public_port]
+        while True:
+            try:
+                sock, _ = await loop.sock_accept(listener)
+            except OSError as e:
+                # 例如文件描述符耗尽, 稍后再试
+                logger.error("Accept failed on port %s: %s", public_port, e)
+                await asyncio.sleep(0.1)
+                continue
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            task = asyncio.create_task(self._handle(public_port, sock))
+            connections.add(task)
+            task.add_done_callback(connections.discard)
+
+    async def _handle(self, public_port: int, sock: socket.socket):
+        activity = _Activity()
+        upstream = None
+        stream = None
+        try:
+            target = await self._resolve(public_port)
+            if target is None:
+                return
+            open_stream, host, local_port = target
+            counters = self._traffic(public_port) if self._traffic is not None else None
+            received, sent = counters or (None, None)
+
+            if open_stream is not None:
+                stream = await self._open_stream(open_stream)
+                if stream is None:
+                    return
+                pumps = [
+                    asyncio.create_task(_pump_to_stream(sock, stream, activity, received)),
+                    asyncio.create_task(_pump_from_stream(stream, sock, activity, sent)),
+                ]
+            else:
+                upstream = await asyncio.wait_for(_connect(host, local_port), TCP_CONNECT_TIMEOUT)
+                pumps = [
+                    asyncio.create_task(_pump_socket(sock, upstream, activity, received)),
+                    asyncio.create_task(_pump_socket(upstream, sock, activity, sent)),
+                ]
+            await self._supervise(public_port, pumps, activity)
+        except (OSError, asyncio.TimeoutError, StreamReset, ValueError) as e:
+            # ValueError: 客户端的响应头格式不对
+            logger.info("TCP connection on port %s failed: %s", public_port, e)
+        finally:
+            if stream is not None and not stream.remote_closed:
+                await stream.reset("connection closed")
+            if upstream is not None:
+                upstream.close()
+            sock.close()
+
+    async def _open_stream(self, open_stream: Callable[[], Stream]):
+        """打开流并等待客户端接受; 没有打开成功时重置流, 不留在连接上"""
+        stream = open_stream()
+        try:
+            await stream.send_head(encode_request_head("CONNECT", "", []))
+            status, _ = decode_response_head(
+                await asyncio.wait_for(stream.wait_head(), TCP_CONNECT_TIMEOUT)
+            )
+        except BaseException as e:
+            await stream.reset(str(e) or type(e).__name__)
+            raise
+        if status != 200:
+            logger.info("Client refused TCP connection with status %s", status)
+            await stream.reset("connection refused")
+            return None
+        return stream
+
+    async def _supervise(self, public_port: int, pumps, activity: _Activity):
+        """等待两个方向都结束; 任一方向出错或空闲超时则整体关闭"""
+        pending = set(pumps)
+        try:
+            while pending:
+                timeout = activity.last + TCP_IDLE_TIMEOUT - time.monotonic()
+                if timeout <= 0:
+                    logger.info("TCP connection on port %s idle, closing", public_port)
+                    return
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+        finally:
+            for task in pumps:
+                task.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
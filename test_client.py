@@ -0,0 +1,82 @@
+"""
+客户端的 TCP 隧道: 一个方向出错时另一个方向也结束, 本地连接关闭; 连接被换下后仍能退出
+"""
+import asyncio
+
+import pytest
+
+from client import TunnelClient
+from protocol import Multiplexer, Stream, StreamReset
+
+
+def pending_pumps():
+    return [
+        task for task in asyncio.all_tasks()
+        if "handle_connect" in task.get_coro().__qualname__ and not task.done()
+    ]
+
+
+def test_connect_cancels_other_pump_on_error():
+    async def run():
+        closed = asyncio.Event()
+
+        async def local_service(reader, writer):
+            writer.write(b"hello")
+            await reader.read()
+            closed.set()
+            writer.close()
+
+        server = await asyncio.start_server(local_service, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        sent = []
+
+        async def send(frame):
+            # 响应头发出后连接断开, 向服务端转发数据失败
+            sent.append(frame)
+            if len(sent) > 1:
+                raise StreamReset("connection closed")
+
+        mux = Multiplexer(send)
+        stream = mux.streams[1] = Stream(mux, 1)
+        try:
+            with pytest.raises(StreamReset):
+                await TunnelClient("ws://127.0.0.1", {}).handle_connect(stream, port)
+            await asyncio.wait_for(closed.wait(), 5)
+            await asyncio.sleep(0)
+            assert pending_pumps() == []
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_stop_after_link_retired():
+    class Link:
+        attached = True
+
+    class WebSocket:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    async def run():
+        client = TunnelClient("ws://127.0.0.1", {})
+        client.running = True
+        client.link = Link()
+        sent = []
+
+        async def send_control(message):
+            sent.append(message)
+            # 服务端排空, 连接被换下
+            client.mux = None
+
+        client.send_control = send_control
+        client.tunnels = {"web": {}}
+        client.websocket = WebSocket()
+        await client.stop()
+        assert client.websocket.closed
+        return sent
+
+    assert asyncio.run(run()) == [{"type": "tunnel_remove", "tunnel_id": "web"}]
@@ -0,0 +1,191 @@
+"""
+排空与交接: drain.py 的组件, 以及 SIGTERM 排空和 SIGUSR1 交接的整个流程
+"""
+import asyncio
+import errno
+import signal
+import socket
+
+import aiohttp
+import pytest
+
+from bench import create_tunnel, free_port, login, start_slow_upstream, wait_for_log
+from drain import DrainGate, InFlight, allow_reuse_port, listen_socket
+
+# 排空和交接期间持续发出请求的客户端数
+CONCURRENCY = 8
+
+
+def reuse_port_socket(port):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("127.0.0.1", port))
+    return sock
+
+
+def test_listen_socket_joinable_only_after_handoff():
+    listener = listen_socket("127.0.0.1", 0)
+    listener.listen()
+    port = listener.getsockname()[1]
+    try:
+        with pytest.raises(OSError) as e:
+            reuse_port_socket(port)
+        assert e.value.errno == errno.EADDRINUSE
+        allow_reuse_port(listener)
+        reuse_port_socket(port).close()
+    finally:
+        listener.close()
+
+
+def test_in_flight_wait_cancels_after_timeout():
+    async def run():
+        in_flight = InFlight()
+
+        async def request(delay):
+            in_flight.track("tunnel")
+            await asyncio.sleep(delay)
+
+        quick = asyncio.create_task(request(0.05))
+        slow = asyncio.create_task(request(10))
+        await asyncio.sleep(0)
+        assert in_flight.count("tunnel") == 2
+        assert await in_flight.wait("tunnel", 0.5) == 1
+        await asyncio.gather(quick, slow, return_exceptions=True)
+        assert quick.done() and not quick.cancelled()
+        assert slow.cancelled()
+        assert in_flight.count() == 0
+
+    asyncio.run(run())
+
+
+def test_drain_gate_closes_connections_while_draining():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def run(draining):
+        in_flight = InFlight()
+        in_flight.draining = draining
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await DrainGate(app, in_flight)({"type": "http"}, None, send)
+        return messages[0]["headers"]
+
+    assert asyncio.run(run(False)) == []
+    assert asyncio.run(run(True)) == [(b"connection", b"close")]
+
+
+async def slow_tunnel(server, delay):
+    """创建一个每个请求等待 delay 秒的隧道, 返回 (上游, 隧道的 URL)"""
+    upstream_port = free_port()
+    upstream = await start_slow_upstream(upstream_port, delay)
+    async with aiohttp.ClientSession() as session:
+        headers = await login(session, server.base_url)
+        public_port = free_port()
+        await create_tunnel(session, server.base_url, headers, upstream_port, public_port)
+    return upstream, f"{server.base_url}/proxy/{public_port}/"
+
+
+async def fetch(url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            await resp.read()
+            return resp.status
+
+
+async def keep_fetching(url, stop, results, concurrency=CONCURRENCY):
+    """concurrency 个客户端持续请求 url, 直到 stop 被设置后不再发出新请求; 每个请求的结果
+    (状态码或异常) 追加到 results"""
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def client():
+            while not stop.is_set():
+                try:
+                    async with session.get(url) as resp:
+                        await resp.read()
+                        results.append(resp.status)
+                except aiohttp.ClientError as e:
+                    results.append(repr(e))
+                    await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+def assert_all_ok(results):
+    failed = [result for result in results if result != 200]
+    assert not failed, f"{len(failed)}/{len(results)} requests failed, e.g. {failed[:5]}"
+
+
+async def wait_exit(proc, timeout=15):
+    return await asyncio.wait_for(asyncio.to_thread(proc.wait), timeout)
+
+
+def test_sigterm_finishes_in_flight_requests(servers):
+    async def run():
+        server = await servers({"DRAIN_TIMEOUT": "10"}).start()
+        upstream, url = await slow_tunnel(server, 0.3)
+        stop = asyncio.Event()
+        results = []
+        load = asyncio.create_task(keep_fetching(url, stop, results))
+        try:
+            await asyncio.sleep(1.0)
+            # 不再发出新请求, 每个客户端此时都有一个进行中的请求
+            stop.set()
+            in_flight_from = len(results)
+            offset = server.log_offset()
+            server.proc.send_signal(signal.SIGTERM)
+            assert await wait_exit(server.proc) == 0
+            assert "Drained in" in server.read_log(offset)
+        finally:
+            stop.set()
+            await load
+            await upstream.cleanup()
+        assert_all_ok(results)
+        assert len(results) - in_flight_from == CONCURRENCY
+
+    asyncio.run(run())
+
+
+def test_handoff_keeps_serving(servers):
+    async def run():
+        old = await servers({"DRAIN_TIMEOUT": "10"}).start()
+        upstream, url = await slow_tunnel(old, 0.2)
+        stop = asyncio.Event()
+        results = []
+        load = asyncio.create_task(keep_fetching(url, stop, results))
+        try:
+            # 交接的每一步都在持续的请求下进行
+            await asyncio.sleep(0.5)
+            assert results
+            offset = old.log_offset()
+            old.proc.send_signal(signal.SIGUSR1)
+            await wait_for_log(old.log_path, "Ready to hand off", offset)
+            new = await servers(old.env, old.port).start(handoff=True)
+            old.proc.send_signal(signal.SIGTERM)
+            assert await wait_exit(old.proc) == 0
+            # 旧进程退出之后的请求由新进程处理
+            served_by_old = len(results)
+            await asyncio.sleep(0.5)
+            assert len(results) > served_by_old
+            assert new.proc.poll() is None
+        finally:
+            stop.set()
+            await load
+            await upstream.cleanup()
+        assert_all_ok(results)
+
+    asyncio.run(run())
+
+
+def test_handoff_requires_sigusr1(servers):
+    async def run():
+        old = await servers().start()
+        # 旧进程没有准备交接, 新进程不能加入它的端口
+        new = servers(old.env, old.port)
+        new.launch(handoff=True)
+        assert await wait_exit(new.proc) != 0
+        assert await fetch(f"{old.base_url}/login") == 200
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+"""
+按 Host 路由: 通配符的限制, 以及服务端自己的主机名不能被隧道占用
+"""
+import asyncio
+
+import aiohttp
+import pytest
+
+from bench import free_port, login, start_client, wait_for_log
+from host_router import HostRouter, domain_covers, normalize_domain
+
+
+@pytest.mark.parametrize("domain", ["*.com", "*.localhost", "a.*.example.com", "*", "com"])
+def test_normalize_domain_rejects(domain):
+    with pytest.raises(ValueError):
+        normalize_domain(domain)
+
+
+def test_normalize_domain_accepts():
+    assert normalize_domain("*.Example.com.") == "*.example.com"
+    assert normalize_domain("app.example.com") == "app.example.com"
+
+
+def test_domain_covers():
+    assert domain_covers("*.example.com", "a.b.example.com")
+    assert not domain_covers("*.example.com", "example.com")
+    assert domain_covers("app.example.com", "app.example.com")
+    assert not domain_covers("app.example.com", "x.app.example.com")
+
+
+def test_host_router_skips_server_hosts():
+    async def app(scope, receive, send):
+        paths.append(scope["path"])
+
+    async def run(host):
+        scope = {"type": "http", "path": "/api/login", "headers": [(b"host", host.encode())]}
+        await router(scope, None, None)
+
+    paths = []
+    router = HostRouter(app, lambda host: 9000, server_hosts={"tunnel.example.com"})
+    asyncio.run(run("tunnel.example.com:8080"))
+    asyncio.run(run("app.example.com"))
+    assert paths == ["/api/login", "/proxy/9000/api/login"]
+
+
+def test_server_hostnames_cannot_be_registered(servers):
+    async def run():
+        server = await servers({"SERVER_HOSTNAMES": "tunnel.example.com", "TUNNEL_BASE_DOMAIN": "t.example.com"}).start()
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, server.base_url)
+
+            async def create(domain):
+                async with session.post(f"{server.base_url}/api/tunnels", headers=headers, json={
+                    "local_port": 9, "public_port": free_port(), "custom_domain": domain
+                }) as resp:
+                    return resp.status, (await resp.json()).get("detail")
+
+            assert await create("*.com") == (400, "Invalid custom domain: *.com")
+            for domain in ("tunnel.example.com", "*.example.com", "t.example.com", "localhost"):
+                assert (await create(domain))[0] == 400, domain
+            assert (await create("app.example.com"))[0] == 200
+
+            # 即使 Host 是服务端的主机名, 也不会被转发到隧道
+            async with session.get(f"{server.base_url}/login", headers={"Host": "tunnel.example.com"}) as resp:
+                assert resp.status == 200
+                assert "text/html" in resp.headers["Content-Type"]
+
+        # 客户端注册时同样检查
+        offset = server.log_offset()
+        client = start_client(server.port, 9, free_port(), {"CUSTOM_DOMAIN": "tunnel.example.com"})
+        try:
+            await wait_for_log(server.log_path, "Custom domain tunnel.example.com is reserved", offset)
+        finally:
+            client.terminate()
+            client.wait()
+
+    asyncio.run(run())
@@ -0,0 +1,48 @@
+"""
+路由头部: 截断或缺少路由时抛出 ValueError, 转发内部连接上的流时不会因此留下未结束的流
+"""
+import asyncio
+
+import pytest
+
+from bench import import_server
+from protocol import (
+    FRAME_RESET, Multiplexer, Stream, decode_frame, decode_routed_head, encode_request_head, encode_routed_head
+)
+
+
+def test_routed_head_round_trip():
+    head = encode_request_head("GET", "/", [])
+    for route in ("web", ""):
+        decoded, rest = decode_routed_head(encode_routed_head(route, head))
+        assert (decoded, bytes(rest)) == (route, head)
+
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    b"\x00",
+    b"\x00\x01\x00",
+    b"\x00\x01\x00\x05web",
+    b"\x00\x02\x00\x03web",
+])
+def test_malformed_routed_head(payload):
+    with pytest.raises(ValueError):
+        decode_routed_head(payload)
+
+
+def test_relay_resets_stream_with_malformed_route():
+    relay_peer_stream = import_server().relay_peer_stream
+    frames = []
+
+    async def send(frame):
+        frames.append(decode_frame(frame))
+
+    async def run():
+        mux = Multiplexer(send)
+        stream = mux.streams[1] = Stream(mux, 1)
+        stream._on_head(b"\x00\x01\x00\x05web", True)
+        await relay_peer_stream(stream)
+        return mux
+
+    assert asyncio.run(run()).streams == {}
+    assert [frame[0] for frame in frames] == [FRAME_RESET]
@@ -0,0 +1,86 @@
+"""
+共享注册表: 本地找不到隧道时同步注册表, 读写都不在事件循环的线程中执行, 同时到达的同步合并;
+journal 注册表: 压缩在后台线程中进行, 期间照常追加, 任何时刻崩溃都能恢复
+"""
+import asyncio
+import os
+import shutil
+import threading
+
+import registry
+from bench import import_server
+from registry import JournalTunnelRegistry, open_registry
+
+
+def test_lookup_miss_syncs_in_registry_thread(tmp_path):
+    ConnectionManager = import_server().ConnectionManager
+    path = str(tmp_path / "tunnels.db")
+    first = ConnectionManager(registry=open_registry("sqlite", path))
+    second = ConnectionManager(registry=open_registry("sqlite", path))
+    threads = []
+    changes = second.registry.changes
+
+    def recorded_changes(since):
+        threads.append(threading.current_thread())
+        return changes(since)
+
+    second.registry.changes = recorded_changes
+
+    async def run():
+        await first.register_tunnel("client-a", 9, 9000)
+        assert second.find_tunnel_by_port(9000) is None
+        return await asyncio.gather(*(second.lookup_tunnel_by_port(9000) for _ in range(20)))
+
+    try:
+        found = asyncio.run(run())
+    finally:
+        first.registry.close()
+        second.registry.close()
+    assert all(tunnel is not None and tunnel["tunnel_id"] == "client-a" for tunnel in found)
+    # 第一轮同步开始时其余查找都已到达, 合并为第二轮
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+
+def reopened_tunnels(path):
+    journal = JournalTunnelRegistry(path)
+    tunnels = {tunnel["tunnel_id"]: tunnel for tunnel in journal.load()[1]}
+    journal.close()
+    return tunnels
+
+
+def test_journal_compacts_in_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, "JOURNAL_COMPACT_RECORDS", 10)
+    path = str(tmp_path / "tunnels.journal")
+    journal = JournalTunnelRegistry(path)
+    release = threading.Event()
+    compact = journal._compact
+
+    def blocked_compact(tunnels):
+        release.wait()
+        compact(tunnels)
+
+    journal._compact = blocked_compact
+    expected = {}
+    for i in range(30):
+        tunnel = {"tunnel_id": f"t{i % 5}", "name": None, "public_port": 9000 + i}
+        journal.put_tunnel(tunnel)
+        expected[tunnel["tunnel_id"]] = tunnel
+    journal.delete_tunnel("t0")
+    del expected["t0"]
+    # 快照还没写完, 修改已经追加到新日志
+    assert os.path.exists(journal.compacting_path)
+
+    # 此时崩溃: 按旧快照, 改名的日志和新日志恢复
+    crashed = tmp_path / "crashed"
+    crashed.mkdir()
+    for name in ("tunnels.journal", "tunnels.journal.compacting"):
+        shutil.copy(tmp_path / name, crashed / name)
+    assert reopened_tunnels(str(crashed / "tunnels.journal")) == expected
+    assert not os.path.exists(crashed / "tunnels.journal.compacting")
+
+    release.set()
+    journal.close()
+    assert not os.path.exists(journal.compacting_path)
+    assert os.path.exists(journal.snapshot_path)
+    assert reopened_tunnels(path) == expected
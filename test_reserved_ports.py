@@ -0,0 +1,53 @@
+"""
+隧道不能占用服务端自己的端口: 主端口, 内部连接端口和 RESERVED_PORTS
+"""
+import asyncio
+import errno
+import socket
+
+import aiohttp
+import pytest
+
+from bench import free_port, login, start_client, wait_for_log, wait_for_port
+
+
+def test_reserved_public_ports_are_rejected(servers):
+    async def run():
+        reserved, cluster_port = free_port(), free_port()
+        server = await servers({
+            "RESERVED_PORTS": f"1-1023,{reserved}", "CLUSTER_PORT": str(cluster_port),
+            "TCP_BIND_HOST": "127.0.0.1"
+        }).start()
+        async with aiohttp.ClientSession() as session:
+            headers = await login(session, server.base_url)
+
+            async def create(public_port):
+                async with session.post(f"{server.base_url}/api/tunnels", headers=headers,
+                                        json={"local_port": 9, "public_port": public_port}) as resp:
+                    return resp.status, (await resp.json()).get("detail")
+
+            for port in (server.port, cluster_port, 80, reserved):
+                assert await create(port) == (400, f"Public port {port} is reserved")
+            public_port = free_port()
+            assert (await create(public_port))[0] == 200
+
+        # 客户端注册时同样检查
+        offset = server.log_offset()
+        client = start_client(server.port, 9, server.port)
+        try:
+            await wait_for_log(server.log_path, f"Public port {server.port} is reserved", offset)
+        finally:
+            client.terminate()
+            client.wait()
+
+        # 主端口和隧道的 TCP 端口都没有设置 SO_REUSEPORT, 其他进程不能加入
+        await wait_for_port(public_port)
+        for port in (server.port, public_port):
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            with pytest.raises(OSError) as e:
+                sock.bind(("127.0.0.1", port))
+            sock.close()
+            assert e.value.errno == errno.EADDRINUSE
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+"""
+经 /proxy 流式转发请求体和响应体: 大小正确, 且服务端的峰值内存不随请求体大小增长
+"""
+import asyncio
+
+import aiohttp
+
+from bench import create_tunnel, free_port, login, peak_rss_mb, start_stream_upstream
+
+WARMUP_SIZE = 8 * 1024 * 1024
+# 转发 LARGE_SIZE 的请求体和响应体, 服务端峰值 RSS 的增长不能超过 RSS_BOUND
+LARGE_SIZE = 256 * 1024 * 1024
+RSS_BOUND_MB = 64
+
+
+async def upload_body(size):
+    chunk = b"u" * 65536
+    for _ in range(size // len(chunk)):
+        yield chunk
+
+
+async def download(session, url, size):
+    async with session.get(f"{url}/bytes?n={size}") as resp:
+        assert resp.status == 200
+        received = 0
+        async for chunk in resp.content.iter_any():
+            received += len(chunk)
+        return received
+
+
+async def upload(session, url, size):
+    # 分块上传, 没有 Content-Length
+    async with session.post(f"{url}/upload", data=upload_body(size)) as resp:
+        assert resp.status == 200
+        return (await resp.json())["received"]
+
+
+def test_streams_large_bodies_both_ways(servers):
+    async def run():
+        upstream_port = free_port()
+        upstream = await start_stream_upstream(upstream_port)
+        server = await servers().start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                headers = await login(session, server.base_url)
+                public_port = free_port()
+                await create_tunnel(session, server.base_url, headers, upstream_port, public_port)
+                url = f"{server.base_url}/proxy/{public_port}"
+
+                # 先以较小的请求体走一遍, 连接池和缓冲区都已建立后再取基线
+                assert await download(session, url, WARMUP_SIZE) == WARMUP_SIZE
+                assert await upload(session, url, WARMUP_SIZE) == WARMUP_SIZE
+                baseline = peak_rss_mb(server.proc.pid)
+
+                assert await download(session, url, LARGE_SIZE) == LARGE_SIZE
+                assert await upload(session, url, LARGE_SIZE) == LARGE_SIZE
+                growth = peak_rss_mb(server.proc.pid) - baseline
+                assert growth < RSS_BOUND_MB, f"peak RSS grew by {growth:.1f}MB"
+        finally:
+            await upstream.cleanup()
+
+    asyncio.run(run())
+
+
+def test_unknown_tunnel_is_not_found(servers):
+    async def run():
+        server = await servers().start()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{server.base_url}/proxy/{free_port()}/bytes?n=1") as resp:
+                assert resp.status == 404
+
+    asyncio.run(run())
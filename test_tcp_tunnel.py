@@ -0,0 +1,58 @@
+"""
+TCP 隧道经多路复用流转发时, 客户端拒绝, 超时或响应头损坏都不能把流留在连接上
+"""
+import asyncio
+import socket
+
+import pytest
+
+import tcp_tunnel
+from protocol import Multiplexer, encode_response_head
+from tcp_tunnel import TcpListeners
+
+
+def connected_multiplexers(on_stream):
+    """背靠背连接的两个 Multiplexer, 返回服务端一侧; 客户端一侧由 on_stream 处理新建的流"""
+    async def to_client(frame):
+        client.feed(frame)
+
+    async def to_server(frame):
+        server.feed(frame)
+
+    server = Multiplexer(to_client)
+    client = Multiplexer(to_server, on_stream, first_stream_id=2)
+    return server
+
+
+async def refuse(stream):
+    await stream.send_head(encode_response_head(502, []), end_stream=True)
+
+
+async def malformed(stream):
+    await stream.send_head(b"\x00", end_stream=True)
+
+
+async def ignore(stream):
+    await stream.wait_head()
+
+
+@pytest.mark.parametrize("respond", [refuse, malformed, ignore])
+def test_failed_open_releases_stream(monkeypatch, respond):
+    monkeypatch.setattr(tcp_tunnel, "TCP_CONNECT_TIMEOUT", 0.2)
+
+    async def run():
+        mux = connected_multiplexers(respond)
+
+        async def resolve(public_port):
+            return mux.open_stream, None, None
+
+        visitor, sock = socket.socketpair()
+        sock.setblocking(False)
+        try:
+            await TcpListeners(resolve)._handle(9000, sock)
+            await asyncio.sleep(0)
+            assert mux.streams == {}
+        finally:
+            visitor.close()
+
+    asyncio.run(run())
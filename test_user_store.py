@@ -0,0 +1,40 @@
+"""
+用户存储: 并发写入后重新打开, 内容与内存中一致
+"""
+import asyncio
+
+import pytest
+
+from user_store import BACKENDS
+
+
+def initial_users():
+    return {"admin": {"username": "admin", "hashed_password": "x", "disabled": False, "admin": False}}
+
+
+@pytest.mark.parametrize("kind", sorted(BACKENDS))
+def test_concurrent_writes_survive_reopen(tmp_path, kind):
+    cls, default_path = BACKENDS[kind]
+    path = str(tmp_path / default_path)
+
+    async def run():
+        store = cls(path).open(initial_users)
+        users = [
+            {"username": f"user{i}", "hashed_password": "x", "disabled": False, "admin": False}
+            for i in range(500)
+        ]
+        await asyncio.gather(*(store.create(user) for user in users))
+        # 写线程提交的同时, 事件循环继续增删用户
+        await asyncio.gather(
+            *(store.delete(f"user{i}") for i in range(0, 500, 2)),
+            *(store.update({**users[i], "disabled": True}) for i in range(1, 500, 4)),
+        )
+        expected = dict(store.users)
+        await store.close()
+        return expected
+
+    expected = asyncio.run(run())
+    assert len(expected) == 251
+    reopened = cls(path)
+    assert reopened._load() == expected
+    reopened._shutdown()
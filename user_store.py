@@ -0,0 +1,309 @@
+"""
+用户存储
+
+所有用户在启动时载入内存, get() 直接查字典, 不做任何 I/O.
+写入交给后台线程: 已排队的写入合并为一次提交 (group commit),
+协程等到数据真正落盘后才返回. 删除以带 "deleted" 标记的记录写入.
+用户发生变化时依次调用 listeners 中的回调, 参数为用户名.
+
+后端:
+    sqlite  SQLite (WAL), username 为主键
+    log     追加写的 JSON 行日志, 同一用户以最后一条为准, 启动时按需压缩
+    json    兼容原来的 users.json, 每批写入原子替换整个文件
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# 一次提交最多合并的写入数
+GROUP_COMMIT_MAX = 1024
+
+
+def _resolve(future: asyncio.Future, error: Exception | None):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class UserStore:
+    """用户存储基类, 子类实现 _load 和 _commit"""
+    def __init__(self, path: str):
+        self.path = path
+        self.users: Dict[str, dict] = {}
+        self.listeners: List[Callable[[str], None]] = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name="user-store-writer", daemon=True)
+
+    def open(self, initial_users: Callable[[], Dict[str, dict]]):
+        """载入用户; 存储为空时写入 initial_users() 的结果"""
+        self.users = self._load()
+        if not self.users:
+            self.users = initial_users()
+            self._commit(list(self.users.values()))
+        self._thread.start()
+        logger.info("Loaded %s users from %s", len(self.users), self.path)
+        return self
+
+    def get(self, username: str) -> dict | None:
+        return self.users.get(username)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.users
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    async def create(self, user: dict):
+        """新增用户, 用户名已存在时抛出 ValueError"""
+        username = user["username"]
+        if username in self.users:
+            raise ValueError("Username already registered")
+        # 先占位, 并发注册同名用户时后到者立即失败
+        self.users[username] = user
+        try:
+            await self._write(user)
+        except Exception:
+            self.users.pop(username, None)
+            raise
+
+    async def update(self, user: dict):
+        """新增或覆盖用户"""
+        self.users[user["username"]] = user
+        self._notify(user["username"])
+        await self._write(user)
+
+    async def delete(self, username: str):
+        if self.users.pop(username, None) is None:
+            return
+        self._notify(username)
+        await self._write({"username": username, "deleted": True})
+
+    def _notify(self, username: str):
+        for listener in self.listeners:
+            listener(username)
+
+    async def close(self):
+        """等待排队中的写入完成后停止后台线程"""
+        self._queue.put(None)
+        await asyncio.to_thread(self._thread.join)
+
+    async def _write(self, user: dict):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((dict(user), loop, future))
+        await future
+
+    def _writer(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # 把已经排队的写入合并成一次提交
+            while len(batch) < GROUP_COMMIT_MAX:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            error = None
+            try:
+                self._commit([user for user, _, _ in batch])
+            except Exception as e:
+                logger.error("Failed to write users to %s: %s", self.path, e)
+                error = e
+            for _, loop, future in batch:
+                loop.call_soon_threadsafe(_resolve, future, error)
+        self._shutdown()
+
+    def _load(self) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    def _commit(self, users: List[dict]):
+        raise NotImplementedError
+
+    def _shutdown(self):
+        pass
+
+
+class SqliteUserStore(UserStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        # 载入在主线程, 之后只由写线程使用
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "username TEXT PRIMARY KEY, "
+            "hashed_password TEXT NOT NULL, "
+            "disabled INTEGER NOT NULL DEFAULT 0, "
+            "limits TEXT, "
+            "admin INTEGER NOT NULL DEFAULT 0)"
+        )
+        # 旧数据库没有 limits 列 (用户限额, JSON) 和 admin 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if "limits" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN limits TEXT")
+        if "admin" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN admin INTEGER NOT NULL DEFAULT 0")
+
+    def _load(self):
+        rows = self._conn.execute("SELECT username, hashed_password, disabled, limits, admin FROM users")
+        users = {}
+        for username, hashed_password, disabled, limits, admin in rows:
+            user = {
+                "username": username,
+                "hashed_password": hashed_password,
+                "disabled": bool(disabled),
+                "admin": bool(admin)
+            }
+            if limits:
+                user["limits"] = json.loads(limits)
+            users[username] = user
+        return users
+
+    def _commit(self, users):
+        # 同一批内按顺序执行, 先删后建的情况以最后一条为准
+        with self._conn:
+            for u in users:
+                if u.get("deleted"):
+                    self._conn.execute("DELETE FROM users WHERE username = ?", (u["username"],))
+                else:
+                    self._conn.execute(
+                        "INSERT INTO users (username, hashed_password, disabled, limits, admin) "
+                        "VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(username) DO UPDATE SET "
+                        "hashed_password = excluded.hashed_password, disabled = excluded.disabled, "
+                        "limits = excluded.limits, admin = excluded.admin",
+                        (
+                            u["username"], u["hashed_password"], int(bool(u.get("disabled"))),
+                            json.dumps(u["limits"]) if u.get("limits") else None,
+                            int(bool(u.get("admin")))
+                        )
+                    )
+
+    def _shutdown(self):
+        self._conn.close()
+
+
+class LogUserStore(UserStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._file = None
+
+    def _load(self):
+        users = {}
+        records = 0
+        good_offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        user = json.loads(line)
+                    except ValueError:
+                        # 崩溃时写了一半的最后一行, 丢弃
+                        logger.warning("Discarding torn record at offset %s in %s", good_offset, self.path)
+                        break
+                    if user.get("deleted"):
+                        users.pop(user["username"], None)
+                    else:
+                        users[user["username"]] = user
+                    records += 1
+                    good_offset += len(line)
+            with open(self.path, "r+b") as f:
+                f.truncate(good_offset)
+        # 被覆盖的旧记录过多时压缩日志
+        if records > 2 * len(users):
+            self._rewrite(users)
+        self._file = open(self.path, "ab")
+        return users
+
+    def _rewrite(self, users):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for user in users.values():
+                f.write(json.dumps(user).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _commit(self, users):
+        self._file.write(b"".join(json.dumps(u).encode() + b"\n" for u in users))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _shutdown(self):
+        self._file.close()
+
+
+class JsonUserStore(UserStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        # 写线程自己的副本, 只按批次中的记录更新; self.users 由事件循环修改, 写线程不读它
+        self._saved: Dict[str, dict] = {}
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                users = json.load(f)
+        except FileNotFoundError:
+            users = {}
+        self._saved = dict(users)
+        return users
+
+    def _commit(self, users):
+        saved = dict(self._saved)
+        for u in users:
+            if u.get("deleted"):
+                saved.pop(u["username"], None)
+            else:
+                saved[u["username"]] = u
+        # 先写临时文件再替换, 崩溃时不会留下写了一半的文件
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(saved, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # 写入失败时不更新, 下一批仍从上次落盘的内容开始
+        self._saved = saved
+
+
+BACKENDS = {
+    "sqlite": (SqliteUserStore, "users.db"),
+    "log": (LogUserStore, "users.log"),
+    "json": (JsonUserStore, "users.json"),
+}
+
+
+def open_user_store(kind: str, path: str | None, default_users: Callable[[], Dict[str, dict]]) -> UserStore:
+    """打开用户存储; 新建的存储优先导入旧的 users.json, 否则使用 default_users()"""
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown user store: {kind}")
+    cls, default_path = BACKENDS[kind]
+
+    def initial_users():
+        if kind != "json" and os.path.exists("users.json"):
+            with open("users.json", "r") as f:
+                users = json.load(f)
+            logger.info("Imported %s users from users.json", len(users))
+            return users
+        return default_users()
+
+    return cls(path or default_path).open(initial_users)
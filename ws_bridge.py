@@ -0,0 +1,225 @@
+"""
+WebSocket 转发
+
+公网一侧的 WebSocket 升级请求到达后, 服务端先与上游建立 WebSocket, 握手成功后再接受
+公网连接, 之后在两端之间逐条转发消息. 上游可以是本机端口 (aiohttp 直连), 也可以是
+客户端: 此时打开一个方法为 WEBSOCKET 的多路复用流, 客户端连接本地服务后回复 101,
+消息按下面的格式写入流中:
+
+    +---------+-----------+-------------
+    | kind: 1 | length: 4 | payload ...
+    +---------+-----------+-------------
+
+TEXT/BINARY 为消息内容, CLOSE 的内容是关闭码 (u16) 加原因, 写出 CLOSE 后结束流.
+
+背压: 每一端都是收到一条消息、发送完成后再读取下一条, 经客户端转发时由流的发送窗口限速.
+心跳: 公网一侧由 uvicorn 发送 ping (--ws-ping-interval), 到本地服务的一侧由 aiohttp
+按 WS_PROXY_HEARTBEAT 发送 ping, 服务端与客户端之间的隧道连接有自己的 ping.
+关闭: 任意一端关闭或断开时, 另一端以相同的关闭码关闭.
+"""
+import asyncio
+import os
+import struct
+from typing import List, Tuple
+
+import aiohttp
+
+from protocol import HOP_BY_HOP_HEADERS, Stream, StreamReset
+
+WS_PROXY_HEARTBEAT = float(os.getenv("WS_PROXY_HEARTBEAT", 20)) or None  # 为 0 时不发送 ping
+WS_MAX_MESSAGE_SIZE = int(os.getenv("WS_MAX_MESSAGE_SIZE", 16 * 1024 * 1024))
+
+# 经客户端转发 WebSocket 时流的请求方法
+WEBSOCKET_METHOD = "WEBSOCKET"
+
+MSG_TEXT = 1
+MSG_BINARY = 2
+MSG_CLOSE = 8
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_ABNORMAL = 1006  # 没有收到关闭帧, 不能出现在关闭帧中
+CLOSE_INTERNAL_ERROR = 1011
+
+# 任一端断开时收发抛出的异常
+_DISCONNECTED = (StreamReset, aiohttp.ClientError, OSError)
+
+_MESSAGE_HEADER = struct.Struct("!BI")
+_CLOSE_CODE = struct.Struct("!H")
+
+# 由各自的 WebSocket 实现重新生成的握手头部
+_HANDSHAKE_HEADERS = {
+    "host", "sec-websocket-key", "sec-websocket-version", "sec-websocket-extensions",
+    "sec-websocket-accept", "sec-websocket-protocol"
+}
+
+
+def handshake_headers(headers) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """返回 (需要转发给上游的头部, 请求的子协议)"""
+    forwarded = []
+    protocols = []
+    for name, value in headers:
+        name = name.lower()
+        if name == "sec-websocket-protocol":
+            protocols.extend(p.strip() for p in value.split(",") if p.strip())
+        elif name not in HOP_BY_HOP_HEADERS and name not in _HANDSHAKE_HEADERS:
+            forwarded.append((name, value))
+    return forwarded, protocols
+
+
+def close_code(code: int | None) -> int:
+    """1005/1006/1015 只表示状态, 转发给另一端时换成可以发送的关闭码"""
+    if code is None or code in (1005, 1006, 1015):
+        return CLOSE_GOING_AWAY
+    return code
+
+
+# 以下三种端点都提供 receive() 和 send(kind, data), close 以 (关闭码, 原因) 为内容;
+# 上游一侧的端点另有 release(), 转发结束或出错后释放连接
+class StarletteEndpoint:
+    """公网一侧, 已接受的 starlette WebSocket; 客户端不依赖 starlette, 这里不导入它"""
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    async def receive(self):
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return MSG_CLOSE, (message.get("code", CLOSE_NORMAL), message.get("reason") or "")
+        if message.get("text") is not None:
+            return MSG_TEXT, message["text"]
+        return MSG_BINARY, message.get("bytes") or b""
+
+    async def send(self, kind, data):
+        if kind == MSG_TEXT:
+            await self.websocket.send_text(data)
+        elif kind == MSG_BINARY:
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.close(close_code(data[0]), data[1])
+
+
+class AiohttpEndpoint:
+    """aiohttp 建立的到本地服务的 WebSocket"""
+    def __init__(self, ws: aiohttp.ClientWebSocketResponse):
+        self.ws = ws
+
+    async def receive(self):
+        message = await self.ws.receive()
+        if message.type == aiohttp.WSMsgType.TEXT:
+            return MSG_TEXT, message.data
+        if message.type == aiohttp.WSMsgType.BINARY:
+            return MSG_BINARY, message.data
+        # CLOSE, CLOSED 或 ERROR
+        code = self.ws.close_code if message.type != aiohttp.WSMsgType.ERROR else CLOSE_INTERNAL_ERROR
+        reason = message.extra if message.type == aiohttp.WSMsgType.CLOSE and message.extra else ""
+        return MSG_CLOSE, (code or CLOSE_ABNORMAL, reason)
+
+    async def send(self, kind, data):
+        if kind == MSG_TEXT:
+            await self.ws.send_str(data)
+        elif kind == MSG_BINARY:
+            await self.ws.send_bytes(data)
+        else:
+            await self.ws.close(code=close_code(data[0]), message=data[1].encode("utf-8"))
+
+    async def release(self):
+        if not self.ws.closed:
+            await self.ws.close(code=CLOSE_GOING_AWAY)
+
+
+class StreamEndpoint:
+    """多路复用流, 服务端和客户端各持有一端"""
+    def __init__(self, stream: Stream):
+        self.stream = stream
+        self._buffer = bytearray()
+
+    async def receive(self):
+        header_size = _MESSAGE_HEADER.size
+        while True:
+            if len(self._buffer) >= header_size:
+                kind, size = _MESSAGE_HEADER.unpack_from(self._buffer)
+                if size > WS_MAX_MESSAGE_SIZE:
+                    raise StreamReset(f"message too large: {size}")
+                if len(self._buffer) >= header_size + size:
+                    payload = bytes(self._buffer[header_size:header_size + size])
+                    del self._buffer[:header_size + size]
+                    return self._decode(kind, payload)
+            chunk = await self.stream.read()
+            if not chunk:
+                # 流没有 CLOSE 就结束了, 视为异常断开
+                return MSG_CLOSE, (CLOSE_ABNORMAL, "")
+            self._buffer += chunk
+
+    @staticmethod
+    def _decode(kind, payload):
+        if kind == MSG_TEXT:
+            return kind, payload.decode("utf-8")
+        if kind == MSG_CLOSE:
+            code, = _CLOSE_CODE.unpack_from(payload)
+            return kind, (code, payload[_CLOSE_CODE.size:].decode("utf-8", "replace"))
+        return MSG_BINARY, payload
+
+    async def send(self, kind, data):
+        if kind == MSG_TEXT:
+            data = data.encode("utf-8")
+        elif kind == MSG_CLOSE:
+            data = _CLOSE_CODE.pack(close_code(data[0])) + data[1].encode("utf-8")
+        await self.stream.write(_MESSAGE_HEADER.pack(kind, len(data)) + data)
+        if kind == MSG_CLOSE:
+            await self.stream.end()
+
+    async def release(self):
+        """转发结束后释放流: 对端已正常结束时补发 END_STREAM, 否则重置"""
+        stream = self.stream
+        try:
+            if stream.remote_closed and stream.error is None:
+                await stream.end()
+            elif not (stream.local_closed and stream.remote_closed):
+                await stream.reset("websocket closed")
+        except StreamReset:
+            pass
+
+
+async def _pump(source, target, counter=None, shape=None):
+    """逐条转发直到 source 关闭, 返回 source 的关闭码和原因"""
+    while True:
+        kind, data = await source.receive()
+        if kind == MSG_CLOSE:
+            return data
+        if counter is not None:
+            counter.inc(len(data))
+        if shape is not None:
+            await shape(len(data))
+        await target.send(kind, data)
+
+
+async def bridge(public, upstream, received=None, sent=None, shape=None):
+    """在两个端点之间双向转发消息, 一端关闭后以相同的关闭码关闭另一端
+
+    received/sent: 可选的字节计数器, 分别统计公网发往上游和上游发往公网的消息内容
+    shape: 可选的带宽整形协程函数, 以消息长度调用, 两个方向共用
+    返回 (关闭码, 原因)
+    """
+    inbound = asyncio.create_task(_pump(public, upstream, received, shape))
+    outbound = asyncio.create_task(_pump(upstream, public, sent, shape))
+    try:
+        done, _ = await asyncio.wait((inbound, outbound), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        inbound.cancel()
+        outbound.cancel()
+    first = done.pop()
+    try:
+        code, reason = first.result()
+        # 另一端仍然正常, 以相同的关闭码关闭它
+        targets = (upstream if first is inbound else public,)
+    except _DISCONNECTED as e:
+        # 收发任一方向出错时不确定是哪一端断开, 两端都关闭
+        code, reason = CLOSE_INTERNAL_ERROR, str(e)[:120]
+        targets = (public, upstream)
+    for endpoint in targets:
+        try:
+            await endpoint.send(MSG_CLOSE, (code, reason))
+        except (*_DISCONNECTED, RuntimeError):
+            # 这一端也已经断开
+            pass
+    return code, reason